@@ -1,21 +1,63 @@
+import hashlib
 import json
+import click
 from db import db, User, Restaurant, Dish, Order, Driver, Review
-from flask import Flask, request
+from flask import Flask, Response, request, stream_with_context
 import dao
-from datetime import datetime
+from datetime import datetime, timedelta
 import users_dao
+import instrumentation
+import cache
+import auth
+import hashing
+import engine
+import seed
+import bulk
+import dispatch
+import events
+import jobs
+import archive
+import ledger
+import encoding
 import os
+import upgrade
+import time
 
 app = Flask(__name__)
 db_filename = "delivery.db"
 
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % db_filename
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///%s" % db_filename)
+app.config["SQLALCHEMY_POOL_SIZE"] = int(os.environ.get("DB_POOL_SIZE", 8))
+if os.environ.get("DATABASE_REPLICA_URL"):
+    app.config["DATABASE_REPLICA_URL"] = os.environ["DATABASE_REPLICA_URL"]
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
-
+app.config["SQLALCHEMY_ECHO"] = os.environ.get("SQLALCHEMY_ECHO") == "true"
+app.config["MAX_PAGE_SIZE"] = 1000
+app.config["MAX_BATCH_IDS"] = 100
+app.config["DEFAULT_PAGE_SIZE"] = 20
+app.config["CACHE_BACKEND"] = os.environ.get("CACHE_BACKEND", "memory")
+app.config["EVENTS_BACKEND"] = os.environ.get("EVENTS_BACKEND", "memory")
+app.config["JOBS_WORKERS"] = int(os.environ.get("JOBS_WORKERS", 2))
+if os.environ.get("ORDERS_ARCHIVE_DAYS"):
+    app.config["ORDERS_ARCHIVE_DAYS"] = int(os.environ["ORDERS_ARCHIVE_DAYS"])
+app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY")
+app.config["SESSION_TOKEN_MODE"] = os.environ.get("SESSION_TOKEN_MODE", "opaque")
+app.config["BCRYPT_ROUNDS"] = int(os.environ.get("BCRYPT_ROUNDS", 13))
+
+engine.init_app(app)
 db.init_app(app)
+instrumentation.init_app(app)
+cache.init_app(app)
+auth.init_app(app)
+hashing.init_app(app)
+dispatch.init_app(app)
+events.init_app(app)
+jobs.init_app(app)
+archive.init_app(app)
+ledger.init_app(app)
+encoding.init_app(app)
 with app.app_context():
-    db.create_all()
+    upgrade.upgrade()
 
 def extract_token(request):
     auth_header = request.headers.get("Authorization")
@@ -28,22 +70,143 @@ def extract_token(request):
     return True, bearer_token
 
 def success_response(data, code=200):
-    return json.dumps({"success": True, "data": data}), code
+    return encoding.envelope(data), code
 
 def failure_response(message, code=404):
     return json.dumps({"success": False, "error": message}), code
 
+def busy_response():
+    return json.dumps({"error": "Server busy, try again later."}), 503, {"Retry-After": str(hashing.RETRY_AFTER)}
+
+# Reads the keyset cursor (?after=<id>) and page size (?limit=) of a collection request
+def page_args():
+    after = request.args.get("after", type=int)
+    limit = request.args.get("limit", type=int)
+    if limit is not None:
+        limit = max(1, min(limit, app.config["MAX_PAGE_SIZE"]))
+    return after, limit
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+# Parses the dishes of an order write ([{"dish_id": 3, "quantity": 2}, ...],
+# quantity defaulting to 1) into {dish id: quantity}, summed per dish. Ids
+# and quantities must be positive integers; with removals, quantities may
+# also be negative. Raises ValueError otherwise.
+def parse_items(items, removals=False):
+    if not isinstance(items, list):
+        raise ValueError("Invalid dishes; give a list of dish_id and quantity.")
+    quantities = {}
+    for item in items:
+        dish_id = item.get("dish_id") if isinstance(item, dict) else None
+        if not is_int(dish_id) or dish_id < 1:
+            raise ValueError("Invalid dish_id %r." % (dish_id,))
+        quantity = item.get("quantity", 1)
+        if not is_int(quantity) or quantity == 0 or quantity < 0 and not removals:
+            raise ValueError("Invalid quantity for dish %d." % dish_id)
+        quantities[dish_id] = quantities.get(dish_id, 0) + quantity
+    return quantities
+
+# Parses ?fields=id,name,menu.price into a fields tree ({"id": None, "name": None,
+# "menu": {"price": None}}), where None selects every field of that key
+def parse_fields(value):
+    tree = {}
+    for path in value.split(","):
+        names = [name for name in path.strip().split(".") if name]
+        node = tree
+        for name in names[:-1]:
+            if name in node and node[name] is None:
+                break
+            node = node.setdefault(name, {})
+        else:
+            if names:
+                node[names[-1]] = None
+    return tree
+
+# Reads the sparse fieldset (?fields=) and relationship depth (?expand=) of a read
+def projection_args():
+    fields = request.args.get("fields")
+    depth = request.args.get("expand", type=int)
+    return (parse_fields(fields) if fields else None), depth
+
+# Writes the success envelope item by item so memory stays flat for any table size
+def stream_envelope(items, limit):
+    yield '{"success": true, "data": ['
+    last_id, count = None, 0
+    for item in items:
+        yield (", " if count else "") + encoding.text(item)
+        last_id, count = item_id(item), count + 1
+    if limit is None:
+        yield "]}"
+    else:
+        yield '], "next": %s}' % json.dumps(last_id if count == limit else None)
+
+def item_id(item):
+    return item.id if isinstance(item, encoding.Fragment) else item["id"]
+
+# Responds with a collection, paginated when ?limit= is given and streamed when ?stream=true
+def collection_response(items, limit):
+    if request.args.get("stream") == "true":
+        return Response(stream_with_context(stream_envelope(items, limit)), mimetype="application/json")
+    data = list(items)
+    if limit is None:
+        return success_response(data)
+    next_id = item_id(data[-1]) if len(data) == limit else None
+    return encoding.envelope(data, next=next_id), 200
+
+# Answers a multi-get (?ids=3,1,2, at most MAX_BATCH_IDS of them): data
+# holds the entities in the order asked for, with null for ids that were
+# not found, which are also listed under "missing"
+def batch_response(load):
+    try:
+        ids = [int(id) for id in request.args.get("ids", "").split(",") if id.strip()]
+    except ValueError:
+        ids = None
+    if not ids or len(ids) > app.config["MAX_BATCH_IDS"]:
+        return failure_response("Invalid ids; give 1 to %d comma separated ids." % app.config["MAX_BATCH_IDS"], 400)
+    data = load(ids, *projection_args())
+    return encoding.envelope(data, missing=[id for id, item in zip(ids, data) if item is None]), 200
+
+# The ETag of a version as served to this request. The body depends on
+# ?fields= and ?expand= too, so a projected one gets "<version>-<hash of
+# the projection>".
+def projection_etag(version):
+    fields, depth = projection_args()
+    if fields is None and depth is None:
+        return str(version)
+    return "%d-%s" % (version, hashlib.sha1(json.dumps([fields, depth], sort_keys=True).encode()).hexdigest()[:12])
+
+# Serves a restaurant, dish or order with an ETag taken from its version.
+# When If-None-Match already holds that ETag the answer is an empty 304,
+# found with one primary key lookup before anything is loaded or serialized.
+# load gets the version, so the body it returns matches the ETag.
+def versioned_response(model, id, load, message):
+    version = dao.get_version(model, id)
+    if version is None:
+        return failure_response(message)
+    etag = projection_etag(version)
+    headers = {"ETag": '"%s"' % etag}
+    if request.if_none_match.contains_weak(etag):
+        return "", 304, headers
+    data = load(version)
+    if data is None:
+        return failure_response(message)
+    return success_response(data) + (headers,)
+
 @app.route("/")
 def header():
     return ("Ding-Dong: backend for a simplified version of a food delivery app")
 
 @app.route("/users/")
 def get_all_users():
-    return success_response(dao.get_all_users())
+    if "ids" in request.args:
+        return batch_response(dao.get_users_by_ids)
+    after, limit = page_args()
+    return collection_response(dao.get_all_users(after, limit, *projection_args()), limit)
 
 @app.route("/user/<int:user_id>/")
 def get_user_by_id(user_id):
-    user = dao.get_user_by_id(user_id)
+    user = dao.get_user_by_id(user_id, *projection_args())
     if user is None:
         return failure_response("User not found.")
     return success_response(user)
@@ -53,8 +216,7 @@ def add_to_balance(user_id):
     successful, session_token = extract_token(request)
     if not successful:
         return session_token
-    user = users_dao.get_user_by_session_token(session_token)
-    if not user or not user.verify_session_token(session_token):
+    if users_dao.verify_session(session_token) is None:
         return json.dumps({"error": "Invalid session token."})
     
     body = json.loads(request.data)
@@ -69,8 +231,7 @@ def update_user(user_id):
     successful, session_token = extract_token(request)
     if not successful:
         return session_token
-    user = users_dao.get_user_by_session_token(session_token)
-    if not user or not user.verify_session_token(session_token):
+    if users_dao.verify_session(session_token) is None:
         return json.dumps({"error": "Invalid session token."})
 
     body = json.loads(request.data)
@@ -84,8 +245,7 @@ def delete_user(user_id):
     successful, session_token = extract_token(request)
     if not successful:
         return session_token
-    user = users_dao.get_user_by_session_token(session_token)
-    if not user or not user.verify_session_token(session_token):
+    if users_dao.verify_session(session_token) is None:
         return json.dumps({"error": "Invalid session token."})
 
     user = dao.delete_user(user_id)
@@ -95,7 +255,10 @@ def delete_user(user_id):
 
 @app.route("/restaurants/")
 def get_all_restaurants():
-    return success_response(dao.get_all_restaurants())
+    if "ids" in request.args:
+        return batch_response(dao.get_restaurants_by_ids)
+    after, limit = page_args()
+    return collection_response(dao.get_all_restaurants(after, limit, *projection_args()), limit)
 
 @app.route("/restaurant/", methods=["POST"])
 def create_restaurant():
@@ -107,10 +270,24 @@ def create_restaurant():
 
 @app.route("/restaurant/<int:restaurant_id>/")
 def get_restaurant_by_id(restaurant_id):
-    restaurant = dao.get_restaurant_by_id(restaurant_id)
-    if restaurant is None:
+    return versioned_response(Restaurant, restaurant_id,
+        lambda version: dao.get_restaurant_by_id(restaurant_id, *projection_args(), version=version), "Restaurant not found.")
+
+# The restaurant page (rating summary, categories and menu) from its
+# snapshot, one primary key read whether or not it ends in a 304
+@app.route("/restaurant/<int:restaurant_id>/menu/")
+def get_restaurant_page(restaurant_id):
+    page = dao.get_restaurant_page(restaurant_id)
+    if page is None:
         return failure_response("Restaurant not found.")
-    return success_response(restaurant)
+    version, data = page
+    if version is None:
+        return success_response(data)
+    etag = str(version)
+    headers = {"ETag": '"%s"' % etag}
+    if request.if_none_match.contains_weak(etag):
+        return "", 304, headers
+    return success_response(data) + (headers,)
 
 @app.route("/restaurant/<int:restaurant_id>/", methods=["POST"])
 def update_restaurant(restaurant_id):
@@ -129,7 +306,10 @@ def delete_restaurant(restaurant_id):
 
 @app.route("/dishes/")
 def get_all_dishes():
-    return success_response(dao.get_all_dishes())
+    if "ids" in request.args:
+        return batch_response(dao.get_dishes_by_ids)
+    after, limit = page_args()
+    return collection_response(dao.get_all_dishes(after, limit, *projection_args()), limit)
 
 @app.route("/restaurants/<int:restaurant_id>/dish/", methods=["POST"])
 def create_dish_for_restaurant(restaurant_id):
@@ -145,10 +325,7 @@ def create_dish_for_restaurant(restaurant_id):
 
 @app.route("/dish/<int:dish_id>/")
 def get_dish_by_id(dish_id):
-    dish = dao.get_dish_by_id(dish_id)
-    if dish is None:
-        return failure_response("Dish not found.")
-    return success_response(dish)
+    return versioned_response(Dish, dish_id, lambda version: dao.get_dish_by_id(dish_id, *projection_args(), version=version), "Dish not found.")
 
 @app.route("/dish/<int:dish_id>/", methods=["POST"])
 def update_dish(dish_id):
@@ -165,12 +342,55 @@ def delete_dish(dish_id):
         return failure_response("Dish not found.")
     return success_response(dish)
 
+# Reads an order history request: the "<date_time>:<id>" cursor returned as
+# "next" (?after=), ?limit=, the [?since=, ?until=) window of ISO dates or
+# times and ?delivered=true|false. Raises ValueError on a malformed one.
+# ISO dates and times accepted by ?since= and ?until=
+DATETIME_FORMATS = ["%Y-%m-%d"] + [
+    "%Y-%m-%d" + separator + time for separator in ("T", " ") for time in ("%H:%M", "%H:%M:%S", "%H:%M:%S.%f")
+]
+
+# datetime.fromisoformat only exists from Python 3.7 on
+def parse_datetime(value):
+    for format in DATETIME_FORMATS:
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError("Invalid date: %s" % value)
+
+def history_args():
+    _, limit = page_args()
+    after = request.args.get("after")
+    if after is not None:
+        date_time, order_id = after.rsplit(":", 1)
+        after = date_time, int(order_id)
+    since, until = [
+        parse_datetime(request.args[name]) if name in request.args else None
+        for name in ("since", "until")
+    ]
+    delivered = request.args.get("delivered")
+    if delivered is not None:
+        delivered = {"true": True, "false": False}[delivered]
+    return after, limit or app.config["DEFAULT_PAGE_SIZE"], since, until, delivered
+
+# Pages through an account's orders, newest first
+def history_response(load, message):
+    try:
+        args = history_args()
+    except (ValueError, KeyError):
+        return failure_response("Invalid cursor, date or delivered flag.", 400)
+    page = load(*(args + projection_args()))
+    if page is None:
+        return failure_response(message)
+    orders, next_cursor = page
+    if next_cursor is not None:
+        next_cursor = "%s:%d" % next_cursor
+    return encoding.envelope(orders, next=next_cursor), 200
+
 @app.route("/user/<int:user_id>/orders/")
 def get_orders_of_user(user_id):
-    orders = dao.get_orders_of_user(user_id)
-    if orders is None:
-        return failure_response("User does not exist.")
-    return success_response(orders)
+    return history_response(lambda *args: dao.get_orders_of_user(user_id, *args), "User does not exist.")
 
 @app.route("/user/<int:user_id>/restaurant/<int:restaurant_id>/order/", methods=["POST"])
 def create_order(user_id, restaurant_id):
@@ -182,30 +402,147 @@ def create_order(user_id, restaurant_id):
         driver_id = body.get("driver_id")
     )
     if order is None:
-        return failure_response("User or restaurant not found.")
+        return failure_response("User, restaurant or driver not found.")
     return success_response(order)
 
+@app.route("/user/<int:user_id>/restaurant/<int:restaurant_id>/checkout/", methods=["POST"])
+def checkout(user_id, restaurant_id):
+    body = json.loads(request.data)
+    try:
+        quantities = parse_items(body.get("dishes", []))
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    try:
+        order = dao.checkout(
+            date_time = datetime.now(),
+            user_id = user_id,
+            restaurant_id = restaurant_id,
+            driver_id = body.get("driver_id"),
+            quantities = quantities
+        )
+    except dao.CheckoutError as e:
+        return failure_response(str(e), e.code)
+    return success_response(order, 201)
+
 @app.route("/order/<int:order_id>/add/", methods=["POST"])
 def add_dish_to_order(order_id):
     body = json.loads(request.data)
-    order = dao.add_dish_to_order(order_id, body)
+    try:
+        changes = parse_items([{"dish_id": body.get("dish_id")}])
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    order = dao.update_order_dishes(order_id, changes)
+    if order is None:
+        return failure_response("Order or dish not found.")
+    return success_response(order)
+
+@app.route("/order/<int:order_id>/dishes/", methods=["POST"])
+def update_order_dishes(order_id):
+    body = json.loads(request.data)
+    try:
+        changes = parse_items(body.get("dishes", []), removals=True)
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    order = dao.update_order_dishes(order_id, changes)
     if order is None:
         return failure_response("Order or dish not found.")
     return success_response(order)
 
+@app.route("/orders/")
+def get_orders_by_ids():
+    return batch_response(dao.get_orders_by_ids)
+
 @app.route("/order/<int:order_id>/")
 def get_order_by_id(order_id):
-    order = dao.get_order_by_id(order_id)
-    if order is None:
+    return versioned_response(Order, order_id, lambda version: dao.get_order_by_id(order_id, *projection_args()), "Order not found.")
+
+def subscribers_full_response():
+    return json.dumps({"error": "Too many event subscribers, try again later."}), 503, {"Retry-After": "5"}
+
+def status_event(status):
+    return "id: %d\nevent: status\ndata: %s\n\n" % (status["version"], json.dumps(status))
+
+# Server-sent events of an order's status (paid, delivered, driver): the
+# current status first, unless Last-Event-ID shows the client has it, then
+# every change until the order is delivered or EVENTS_STREAM_SECONDS pass,
+# with a comment line every EVENTS_HEARTBEAT_SECONDS to keep it open
+@app.route("/order/<int:order_id>/events/")
+def order_events(order_id):
+    try:
+        subscription = events.subscribe(order_id, engine._client())
+    except events.TooManySubscribers:
+        return subscribers_full_response()
+    status = dao.get_order_status(order_id)
+    if status is None:
+        events.hub.unsubscribe(subscription)
         return failure_response("Order not found.")
-    return success_response(order)
+    last_version = request.headers.get("Last-Event-ID", type=int)
+
+    def stream():
+        version = last_version
+        yield "retry: 3000\n\n"
+        if version is None or status["version"] > version:
+            version = status["version"]
+            yield status_event(status)
+        if status["delivered"]:
+            return
+        deadline = time.monotonic() + events.STREAM_SECONDS
+        while time.monotonic() < deadline:
+            event = subscription.get(min(events.HEARTBEAT_SECONDS, deadline - time.monotonic()))
+            if event is None:
+                yield ": heartbeat\n\n"
+            elif event["version"] > version:
+                version = event["version"]
+                yield status_event(event)
+                if event["delivered"]:
+                    return
+
+    response = Response(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+    response.call_on_close(lambda: events.hub.unsubscribe(subscription))
+    return response
+
+# Long-poll fallback of the event stream. Answers at once with the status
+# and its ETag; when If-None-Match holds the current ETag, waits up to
+# ?wait= seconds (at most EVENTS_LONG_POLL_SECONDS) for a change, then
+# answers 304 if there was none.
+@app.route("/order/<int:order_id>/status/")
+def get_order_status(order_id):
+    wait = min(request.args.get("wait", 0, type=float), events.LONG_POLL_SECONDS)
+    subscription = None
+    if wait > 0 and request.if_none_match:
+        try:
+            subscription = events.subscribe(order_id, engine._client())
+        except events.TooManySubscribers:
+            return subscribers_full_response()
+    try:
+        status = dao.get_order_status(order_id)
+        if status is None:
+            return failure_response("Order not found.")
+        if request.if_none_match.contains_weak(str(status["version"])):
+            if subscription is None:
+                return "", 304, {"ETag": '"%d"' % status["version"]}
+            # Hold no pooled connection while waiting
+            db.session.close()
+            deadline = time.monotonic() + wait
+            event = None
+            while event is None and time.monotonic() < deadline:
+                event = subscription.get(deadline - time.monotonic())
+                if event is not None and event["version"] <= status["version"]:
+                    event = None
+            if event is None:
+                return "", 304, {"ETag": '"%d"' % status["version"]}
+            status = event
+        return success_response(status) + ({"ETag": '"%d"' % status["version"]},)
+    finally:
+        if subscription is not None:
+            events.hub.unsubscribe(subscription)
 
 @app.route("/order/<int:order_id>/", methods=["POST"])
 def update_order(order_id):
     body = json.loads(request.data)
     order = dao.update_order(order_id, body)
     if order is None:
-        return failure_response("Order not found or has been delivered.")
+        return failure_response("Order or driver not found, or the order has been delivered.")
     return success_response(order)
 
 @app.route("/order/<int:order_id>/", methods=["DELETE"])
@@ -217,16 +554,20 @@ def delete_order(order_id):
 
 @app.route("/driver/<int:driver_id>/")
 def get_driver_by_id(driver_id):
-    driver = dao.get_driver_by_id(driver_id)
+    driver = dao.get_driver_by_id(driver_id, *projection_args())
     if driver is None:
         return failure_response("Driver does not exist.")
     return success_response(driver)
 
+@app.route("/driver/<int:driver_id>/orders/")
+def get_orders_of_driver(driver_id):
+    return history_response(lambda *args: dao.get_orders_of_driver(driver_id, *args), "Driver does not exist.")
+
 @app.route("/order/<int:order_id>/driver/")
 def get_driver_of_order(order_id):
-    driver = dao.get_driver_of_order(order_id)
+    driver = dao.get_driver_of_order(order_id, *projection_args())
     if driver is None:
-        return failure_response("Order not found.")
+        return failure_response("Order not found or not assigned to a driver yet.")
     return success_response(driver)
 
 @app.route("/driver/", methods=["POST"])
@@ -235,6 +576,11 @@ def create_driver():
     driver = dao.create_driver(body)
     return success_response(driver)
 
+# Assigns drivers to the orders waiting for one, at most ?limit= of them
+@app.route("/orders/dispatch/", methods=["POST"])
+def dispatch_backlog():
+    return success_response({"assigned": dao.dispatch_backlog(request.args.get("limit", type=int))})
+
 @app.route("/driver/<int:driver_id>/", methods=["DELETE"])
 def delete_driver(driver_id):
     driver = dao.delete_driver(driver_id)
@@ -244,14 +590,14 @@ def delete_driver(driver_id):
 
 @app.route("/user/<int:user_id>/reviews/")
 def get_reviews_by_user(user_id):
-    reviews = dao.get_reviews_by_user(user_id)
+    reviews = dao.get_reviews_by_user(user_id, projection_args()[0])
     if reviews is None:
         return failure_response("User does not exist.")
     return success_response(reviews)
 
 @app.route("/restaurant/<int:restaurant_id>/reviews/")
 def get_reviews_of_restaurant(restaurant_id):
-    reviews = dao.get_reviews_of_restaurant(restaurant_id)
+    reviews = dao.get_reviews_of_restaurant(restaurant_id, projection_args()[0])
     if reviews is None:
         return failure_response("Restaurant does not exist.")
     return success_response(reviews)
@@ -266,7 +612,7 @@ def create_review_for_restaurant(restaurant_id):
 
 @app.route("/review/<int:review_id>/")
 def get_review_by_id(review_id):
-    review = dao.get_review_by_id(review_id)
+    review = dao.get_review_by_id(review_id, projection_args()[0])
     if review is None:
         return failure_response("Review not found.")
     return success_response(review)
@@ -288,7 +634,8 @@ def delete_review(review_id):
 
 @app.route("/categories/")
 def get_all_categories():
-    return success_response(dao.get_all_categories())
+    after, limit = page_args()
+    return collection_response(dao.get_all_categories(after, limit, *projection_args()), limit)
 
 @app.route("/category/", methods=["POST"])
 def create_category():
@@ -298,11 +645,37 @@ def create_category():
 
 @app.route("/category/<int:category_id>/")
 def get_category_by_id(category_id):
-    category = dao.get_category_by_id(category_id)
+    category = dao.get_category_by_id(category_id, projection_args()[0])
     if category is None:
         return failure_response("Category not found.")
     return success_response(category)
 
+# Lists a category's restaurants by rating; ?after= takes the "<rating>:<id>"
+# cursor returned as "next" by the previous page. Restaurants come without
+# their nested collections unless fields or expand asks for them.
+@app.route("/category/<int:category_id>/restaurants/")
+def get_restaurants_in_category(category_id):
+    _, limit = page_args()
+    fields, depth = projection_args()
+    if fields is None and depth is None:
+        depth = 0
+    after = request.args.get("after")
+    if after is not None:
+        try:
+            rating, restaurant_id = after.split(":")
+            after = float(rating), int(restaurant_id)
+        except ValueError:
+            return failure_response("Invalid cursor.", 400)
+    page = dao.get_restaurants_in_category(
+        category_id, after, limit or app.config["DEFAULT_PAGE_SIZE"], fields, depth
+    )
+    if page is None:
+        return failure_response("Category not found.")
+    restaurants, next_cursor = page
+    if next_cursor is not None:
+        next_cursor = "%r:%d" % next_cursor
+    return encoding.envelope(restaurants, next=next_cursor), 200
+
 @app.route("/category/<int:category_id>/add/", methods=["POST"])
 def add_restaurant_to_category(category_id):
     body = json.loads(request.data)
@@ -318,6 +691,72 @@ def delete_category(category_id):
         return failure_response("Category not found.")
     return success_response(category)
 
+@app.route("/search/")
+def search():
+    text = request.args.get("q", "")
+    kinds = [kind for kind in request.args.get("type", "").split(",") if kind]
+    if any(kind not in ("dish", "restaurant", "category") for kind in kinds):
+        return failure_response("Invalid type.", 400)
+    _, limit = page_args()
+    results = dao.search(
+        text,
+        kinds = kinds,
+        include_sold_out = request.args.get("available") != "true",
+        boost = request.args.get("boost", 0, type=float),
+        limit = limit or app.config["DEFAULT_PAGE_SIZE"],
+        offset = max(request.args.get("offset", 0, type=int), 0)
+    )
+    return success_response(results)
+
+# Reads ?format= (ndjson or csv), falling back to the request's content type
+def transfer_format():
+    format = request.args.get("format")
+    if format is None:
+        format = "csv" if "csv" in (request.content_type or "") else "ndjson"
+    return format if format in bulk.FORMATS else None
+
+def import_response(kind, restaurant_id=None):
+    format = transfer_format()
+    if format is None:
+        return failure_response("Invalid format.", 400)
+    try:
+        counts = bulk.import_records(
+            kind,
+            bulk.read_records(request.stream, format),
+            restaurant_id = restaurant_id,
+            upsert = request.args.get("mode") == "upsert"
+        )
+    except bulk.RecordError as e:
+        return failure_response(str(e), 400)
+    if counts is None:
+        return failure_response("Restaurant not found.")
+    return success_response(counts, 201)
+
+def export_response(kind, restaurant_id=None):
+    format = transfer_format()
+    if format is None:
+        return failure_response("Invalid format.", 400)
+    mimetype = "text/csv" if format == "csv" else "application/x-ndjson"
+    return Response(stream_with_context(bulk.export_records(kind, format, restaurant_id)), mimetype=mimetype)
+
+@app.route("/<any(restaurants, categories, drivers):kind>/import/", methods=["POST"])
+def import_records(kind):
+    return import_response(kind)
+
+@app.route("/<any(restaurants, categories, drivers):kind>/export/")
+def export_records(kind):
+    return export_response(kind)
+
+@app.route("/restaurant/<int:restaurant_id>/menu/import/", methods=["POST"])
+def import_menu(restaurant_id):
+    return import_response("menu", restaurant_id)
+
+@app.route("/restaurant/<int:restaurant_id>/menu/export/")
+def export_menu(restaurant_id):
+    if dao.get_restaurant_by_id(restaurant_id, {"id": None}) is None:
+        return failure_response("Restaurant not found.")
+    return export_response("menu", restaurant_id)
+
 @app.route("/register/", methods=["POST"])
 def register_account():
     body = json.loads(request.data)
@@ -329,7 +768,10 @@ def register_account():
     if name is None or username is None or email is None or password is None:
         return json.dumps({"error": "Invalid name, username, email or password."})
     
-    created, user = users_dao.create_user(name, username, email, password)
+    try:
+        created, user = users_dao.create_user(name, username, email, password)
+    except hashing.PoolFull:
+        return busy_response()
     if not created:
         return json.dumps({"error": "User already exists."})
 
@@ -347,7 +789,10 @@ def login():
     if email is None or password is None:
         return json.dumps({"error": "Invalid email or password."})
 
-    successful, user = users_dao.verify_credentials(email, password)
+    try:
+        successful, user = users_dao.verify_credentials(email, password)
+    except hashing.PoolFull:
+        return busy_response()
     if not successful:
         return json.dumps({"error": "Incorrect email or password."})
 
@@ -384,14 +829,145 @@ def secret_message():
     if not successful:
         return session_token
 
-    user = users_dao.get_user_by_session_token(session_token)
-    if not user or not user.verify_session_token(session_token):
+    if users_dao.verify_session(session_token) is None:
         return json.dumps({"error": "Invalid session token."})
     
     return json.dumps({
         "message": "You have successfully implemented sessions"}
     )
 
+@app.route("/metrics")
+def metrics():
+    return Response(instrumentation.render_metrics(), mimetype="text/plain; version=0.0.4")
+
+@app.cli.command("recompute-ratings")
+def recompute_ratings():
+    """Rebuild restaurant rating aggregates from the review table."""
+    print("Updated %d restaurants." % dao.recompute_ratings())
+
+@app.cli.command("upgrade-db")
+def upgrade_db():
+    """Bring a database written by an earlier release up to the current schema."""
+    rebuilt = upgrade.upgrade()
+    print("Rebuilt %s." % ", ".join(rebuilt) if rebuilt else "Already up to date.")
+
+@app.cli.command("dispatch")
+@click.option("--limit", type=int, help="Assign at most this many orders.")
+def dispatch_orders(limit):
+    """Assign the least-loaded drivers to undelivered orders without one."""
+    print("Assigned %d orders." % dao.dispatch_backlog(limit))
+
+@app.cli.command("jobs")
+@click.option("--watch", is_flag=True, help="Keep running queued jobs until interrupted.")
+@click.option("--workers", default=2, help="Worker threads with --watch.")
+def run_jobs(watch, workers):
+    """Run due background jobs, e.g. with JOBS_WORKERS=0 in the web processes."""
+    if watch:
+        jobs.queue.start(workers)
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            jobs.queue.stop()
+        return
+    print("Ran %d jobs." % jobs.queue.drain())
+
+@app.cli.command("archive-orders")
+@click.option("--days", type=int, help="Archive delivered orders older than this; defaults to ORDERS_ARCHIVE_DAYS.")
+def archive_orders(days):
+    """Move delivered orders past the retention window to the order archive."""
+    days = days if days is not None else archive.ARCHIVE_DAYS
+    if days is None:
+        raise click.UsageError("Give --days or set ORDERS_ARCHIVE_DAYS.")
+    cutoff = datetime.now() - timedelta(days=days)
+    after, count = 0, 0
+    while True:
+        moved = archive.archive_orders(cutoff, after)
+        if moved is None:
+            break
+        after, count = moved[0], count + moved[1]
+    print("Archived %d orders." % count)
+
+@app.cli.command("reconcile-balances")
+def reconcile_balances():
+    """Check every balance against the ledger, resetting the ones that drifted from it."""
+    after, count, reset = 0, 0, 0
+    while True:
+        checked = ledger.reconcile(after)
+        if checked is None:
+            break
+        after, count, reset = checked[0], count + checked[1], reset + len(checked[2])
+    print("Checked %d balances, reset %d." % (count, reset))
+
+@app.cli.command("seed")
+@click.option("--scale", default=1.0, help="Multiplies every default row count.")
+@click.option("--seed", "random_seed", default=0, help="Random seed; the same seed gives the same rows.")
+@click.option("--users", type=int)
+@click.option("--drivers", type=int)
+@click.option("--restaurants", type=int)
+@click.option("--categories", type=int)
+@click.option("--dishes", type=int)
+@click.option("--orders", type=int)
+@click.option("--reviews", type=int)
+def seed_database(scale, random_seed, **counts):
+    """Bulk-generate synthetic users, restaurants, dishes, orders and reviews."""
+    ids = seed.seed(seed.scaled_counts(scale, **counts), random_seed)
+    for name, (first, last) in sorted(ids.items()):
+        print("%s: ids %d to %d" % (name, first, last))
+
+@app.cli.command("import")
+@click.argument("kind", type=click.Choice(sorted(bulk.KINDS)))
+@click.argument("source", type=click.File("rb"))
+@click.option("--restaurant", "restaurant_id", type=int, help="Restaurant whose menu is imported.")
+@click.option("--format", type=click.Choice(bulk.FORMATS), help="Defaults to csv for .csv files, else ndjson.")
+@click.option("--upsert", is_flag=True, help="Update rows with the same name instead of adding duplicates.")
+def import_file(kind, source, restaurant_id, format, upsert):
+    """Bulk-import menus, restaurants, categories or drivers from NDJSON or CSV."""
+    if kind == "menu" and restaurant_id is None:
+        raise click.UsageError("Importing a menu needs --restaurant.")
+    format = format or ("csv" if source.name.endswith(".csv") else "ndjson")
+    try:
+        counts = bulk.import_records(kind, bulk.read_records(source, format), restaurant_id, upsert)
+    except bulk.RecordError as e:
+        raise click.ClickException(str(e))
+    if counts is None:
+        raise click.ClickException("Restaurant not found.")
+    print("Inserted %(inserted)d, updated %(updated)d." % counts)
+
+@app.cli.command("export")
+@click.argument("kind", type=click.Choice(sorted(bulk.KINDS)))
+@click.argument("target", type=click.File("w"), default="-")
+@click.option("--restaurant", "restaurant_id", type=int, help="Restaurant whose menu is exported.")
+@click.option("--format", type=click.Choice(bulk.FORMATS), default="ndjson")
+def export_file(kind, target, restaurant_id, format):
+    """Export menus, restaurants, categories or drivers as NDJSON or CSV."""
+    if kind == "menu" and restaurant_id is None:
+        raise click.UsageError("Exporting a menu needs --restaurant.")
+    for chunk in bulk.export_records(kind, format, restaurant_id):
+        target.write(chunk)
+
+@app.cli.command("check-foreign-keys")
+def check_foreign_keys():
+    """Report rows whose foreign keys point at missing rows, e.g. written before they were enforced."""
+    violations = dao.foreign_key_violations()
+    for (table, parent), rowids in sorted(violations.items()):
+        print("%s: %d rows point at missing %s rows, e.g. rowids %s" % (
+            table, len(rowids), parent, ", ".join(str(rowid) for rowid in rowids[:10])
+        ))
+    if violations:
+        raise click.ClickException("Repoint or delete these rows; writes to them fail while foreign keys are enforced.")
+    print("No foreign key violations.")
+
+@app.cli.command("rebuild-snapshots")
+def rebuild_snapshots():
+    """Rebuild every restaurant's page snapshot from its menu, categories and rating."""
+    print("Rebuilt %d restaurant pages." % dao.rebuild_snapshots())
+
+@app.cli.command("rebuild-search-index")
+def rebuild_search_index():
+    """Refill the full-text search index from dishes, restaurants and categories."""
+    dao.rebuild_search_index()
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
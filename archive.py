@@ -0,0 +1,81 @@
+import json
+import time
+from datetime import datetime, timedelta
+from db import db, Order, OrderArchive, Restaurant, association_order_dishes
+import dao
+import jobs
+
+# Days after which delivered orders leave the order table; None keeps them
+ARCHIVE_DAYS = None
+INTERVAL_SECONDS = 3600
+BATCH_SIZE = 500
+
+# Moves at most batch (default BATCH_SIZE) delivered orders placed before
+# cutoff, with ids above after, to order_archive in one transaction. Returns
+# the last id moved and how many were moved, or None when there were none.
+# Restaurants embed their orders, so theirs get a new version.
+def archive_orders(cutoff, after=0, batch=None):
+    rows = db.session.query(
+        Order.id, Order.date_time, Order.total_cents, Order.paid, Order.user_id, Order.restaurant_id, Order.driver_id
+    ).filter(Order.id > after, Order.delivered == True, Order.date_time < cutoff).order_by(Order.id).limit(batch or BATCH_SIZE).all()
+    if not rows:
+        db.session.rollback()
+        return None
+    order_ids = [row.id for row in rows]
+    link = association_order_dishes
+    items = {}
+    for order_id, dish_id, quantity in db.session.query(link.c.order_id, link.c.dish_id, link.c.quantity).filter(
+        link.c.order_id.in_(order_ids)
+    ):
+        items.setdefault(order_id, []).append({"dish_id": dish_id, "quantity": quantity})
+    now = time.time()
+    db.session.execute(OrderArchive.__table__.insert(), [{
+        "id": row.id,
+        "date_time": row.date_time,
+        "total_cents": row.total_cents,
+        "paid": row.paid,
+        "user_id": row.user_id,
+        "restaurant_id": row.restaurant_id,
+        "driver_id": row.driver_id,
+        "items": json.dumps(items.get(row.id, [])),
+        "archived_at": now,
+    } for row in rows])
+    db.session.execute(link.delete().where(link.c.order_id.in_(order_ids)))
+    db.session.execute(Order.__table__.delete().where(Order.id.in_(order_ids)))
+    restaurant_ids = list(set(row.restaurant_id for row in rows))
+    dao._bump(Restaurant, *restaurant_ids)
+    db.session.commit()
+    dao._invalidate(Restaurant, *restaurant_ids)
+    return order_ids[-1], len(order_ids)
+
+# Archives one batch per job, so no job holds the write lock for long. A
+# full batch queues the next one straight away; otherwise the next pass
+# starts over from the first order INTERVAL_SECONDS later.
+@jobs.handler("archive_orders")
+def archive_batch(after=0):
+    if ARCHIVE_DAYS is None:
+        return
+    moved = archive_orders(datetime.now() - timedelta(days=ARCHIVE_DAYS), after)
+    if moved is not None and moved[1] == BATCH_SIZE:
+        jobs.enqueue("archive_orders", [{"after": moved[0]}], dedupe_on="after")
+    else:
+        jobs.enqueue("archive_orders", [{"after": 0}], dedupe_on="after", delay=INTERVAL_SECONDS)
+    db.session.commit()
+
+# Queues the first pass, unless one is already pending
+def schedule():
+    if ARCHIVE_DAYS is None:
+        return
+    jobs.enqueue("archive_orders", [{"after": 0}], dedupe_on="after")
+    db.session.commit()
+
+def init_app(app):
+    global ARCHIVE_DAYS, INTERVAL_SECONDS, BATCH_SIZE
+    app.config.setdefault("ORDERS_ARCHIVE_DAYS", None)
+    app.config.setdefault("ORDERS_ARCHIVE_INTERVAL_SECONDS", 3600)
+    app.config.setdefault("ORDERS_ARCHIVE_BATCH_SIZE", 500)
+
+    ARCHIVE_DAYS = app.config["ORDERS_ARCHIVE_DAYS"]
+    INTERVAL_SECONDS = app.config["ORDERS_ARCHIVE_INTERVAL_SECONDS"]
+    BATCH_SIZE = app.config["ORDERS_ARCHIVE_BATCH_SIZE"]
+    app.before_first_request(schedule)
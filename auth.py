@@ -0,0 +1,129 @@
+import datetime
+import threading
+import time
+from itsdangerous import BadData, URLSafeSerializer
+from cache import LRUCache
+from db import db, RevokedSession
+
+# session token -> (user id, session expiration) of sessions already
+# checked against the database
+sessions = LRUCache()
+# session token -> expiration (epoch seconds) of revoked tokens. Revocations
+# are written to the revoked_session table, and every process reads the new
+# ones at most every REVOCATION_POLL_SECONDS: a revoked signed token is
+# refused and a revoked opaque token leaves the session cache, in every
+# worker and across restarts.
+revoked = {}
+REVOCATION_POLL_SECONDS = 1
+REVOCATION_PRUNE_SECONDS = 60
+_serializer = None
+_read_at = None
+_pruned_at = 0
+_last_id = 0
+_read_lock = threading.Lock()
+
+def init_app(app):
+    global sessions, revoked, REVOCATION_POLL_SECONDS, _serializer, _read_at, _last_id
+    app.config.setdefault("SESSION_TOKEN_MODE", "opaque")
+    app.config.setdefault("SESSION_CACHE_SIZE", 100000)
+    app.config.setdefault("SESSION_CACHE_TTL", 300)
+    app.config.setdefault("SESSION_REVOCATION_POLL_SECONDS", 1)
+
+    sessions = LRUCache(app.config["SESSION_CACHE_SIZE"], app.config["SESSION_CACHE_TTL"])
+    revoked, _read_at, _last_id = {}, None, 0
+    REVOCATION_POLL_SECONDS = app.config["SESSION_REVOCATION_POLL_SECONDS"]
+    mode = app.config["SESSION_TOKEN_MODE"]
+    if mode == "signed":
+        if not app.config.get("SECRET_KEY"):
+            raise RuntimeError("SESSION_TOKEN_MODE = 'signed' requires a SECRET_KEY.")
+        _serializer = URLSafeSerializer(app.config["SECRET_KEY"], salt="session")
+    elif mode == "opaque":
+        _serializer = None
+    else:
+        raise ValueError("Unknown SESSION_TOKEN_MODE %r." % mode)
+
+# In signed mode, replaces a freshly renewed random session token with one
+# carrying the user id and expiration, keeping the random token as a nonce
+def issue(user):
+    if _serializer is not None:
+        expiration = time.mktime(user.session_expiration.timetuple())
+        user.session_token = _serializer.dumps([user.id, expiration, user.session_token])
+
+# Returns the id of the user the session token belongs to, or None if it is
+# invalid or expired. load(token) fetches (user id, expiration) from the
+# database and is only called for opaque tokens missing from the cache.
+def verify(session_token, load):
+    _read_revocations()
+    if _serializer is not None:
+        try:
+            user_id, expiration, _ = _serializer.loads(session_token)
+        except (BadData, ValueError):
+            pass
+        else:
+            if expiration < time.time() or session_token in revoked:
+                return None
+            return user_id
+
+    entry = sessions.get(session_token)
+    if entry is None:
+        entry = load(session_token)
+        if entry is None:
+            return None
+        sessions.set(session_token, entry)
+    user_id, expiration = entry
+    if expiration < datetime.datetime.now():
+        sessions.delete(session_token)
+        return None
+    return user_id
+
+# Forgets a session token after the session is renewed, its user deleted or
+# its password changed, in this process at once and in the others on their
+# next read. Commits the revocation, so call it after the write's commit.
+def revoke(session_token):
+    now = time.time()
+    expires_at = _expiration(session_token) or now + sessions.ttl
+    sessions.delete(session_token)
+    revoked[session_token] = expires_at
+    table = RevokedSession.__table__
+    db.session.execute(table.delete().where(table.c.expires_at < now))
+    db.session.execute(table.insert().values(token=session_token, expires_at=expires_at))
+    db.session.commit()
+
+# A signed token's expiration, or None for opaque tokens; revocations of
+# opaque tokens only matter while a process may still have them cached
+def _expiration(session_token):
+    if _serializer is None:
+        return None
+    try:
+        return _serializer.loads(session_token)[1]
+    except (BadData, ValueError, IndexError, TypeError):
+        return None
+
+# Reads the revocations made since the last read, by any process; the first
+# read loads every one that has not expired. Expired ones are dropped every
+# REVOCATION_PRUNE_SECONDS. A thread that finds another one reading goes on
+# without waiting.
+def _read_revocations():
+    global _read_at, _last_id, _pruned_at
+    if _read_at is not None and time.monotonic() - _read_at < REVOCATION_POLL_SECONDS:
+        return
+    if not _read_lock.acquire(False):
+        return
+    try:
+        now = time.time()
+        table = RevokedSession.__table__
+        query = db.select([table.c.id, table.c.token, table.c.expires_at]).where(
+            db.and_(table.c.id > _last_id, table.c.expires_at > now)
+        ).order_by(table.c.id)
+        for id, token, expires_at in db.session.execute(query):
+            revoked[token] = expires_at
+            sessions.delete(token)
+            _last_id = id
+        _read_at = time.monotonic()
+        if _read_at - _pruned_at > REVOCATION_PRUNE_SECONDS:
+            for token, expires_at in list(revoked.items()):
+                if expires_at < now:
+                    revoked.pop(token, None)
+            _pruned_at = _read_at
+    finally:
+        _read_lock.release()
@@ -0,0 +1,128 @@
+"""Concurrent read/write throughput of the database layer.
+
+Runs the same mixed workload of DAO reads and writes (balance top-ups of
+one cent) from several threads against a scratch SQLite database, once per
+engine profile, and counts top-ups that committed but are missing from the
+final balances:
+
+- legacy: rollback journal, no pragmas, a new connection per checkout
+  (how the app ran before the engine profile existed)
+- unrouted: the engine profile, with every statement on the primary
+- tuned: the default profile from engine.py, reads on a read-only engine
+
+Usage: python benchmarks/concurrency.py [--threads 16] [--seconds 10]
+"""
+import argparse
+import datetime
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from flask import Flask
+from sqlalchemy.exc import OperationalError
+import dao
+import engine
+from db import db, User, Restaurant, Dish
+
+PROFILES = {
+    "legacy": {"SQLALCHEMY_POOL_SIZE": 0, "SQLITE_PRAGMAS": (), "DATABASE_REPLICA_URL": None},
+    "unrouted": {"DATABASE_REPLICA_URL": None},
+    "tuned": {},
+}
+
+def make_app(path, profile):
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % path
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config.update(PROFILES[profile])
+    engine.init_app(app)
+    db.init_app(app)
+    return app
+
+def seed(app, users, dishes):
+    with app.app_context():
+        db.create_all()
+        db.session.execute(User.__table__.insert(), [{
+            "name": "user %d" % i, "username": "user%d" % i, "balance_cents": 0, "email": "user%d@example.com" % i,
+            "password_digest": "x", "session_token": "s%d" % i, "update_token": "u%d" % i,
+            "session_expiration": datetime.datetime(2100, 1, 1)
+        } for i in range(users)])
+        db.session.execute(Restaurant.__table__.insert(), [{"name": "restaurant", "rating": 0, "rating_sum": 0, "rating_count": 0}])
+        db.session.execute(Dish.__table__.insert(), [{
+            "name": "dish %d" % i, "price_cents": 100 + i, "restaurant_id": 1, "sold_out": False
+        } for i in range(dishes)])
+        db.session.commit()
+
+def worker(app, users, write_ratio, deadline, results):
+    ops = errors = top_ups = 0
+    latencies = []
+    rng = random.Random()
+    with app.app_context():
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            try:
+                if rng.random() < write_ratio:
+                    dao.add_to_balance(rng.randint(1, users), 0.01)
+                    top_ups += 1
+                elif rng.random() < 0.5:
+                    dao.get_user_by_id(rng.randint(1, users))
+                else:
+                    list(dao.get_all_dishes(after=rng.randint(0, 1000), limit=20))
+                ops += 1
+                latencies.append(time.monotonic() - started)
+            except OperationalError:
+                db.session.rollback()
+                errors += 1
+            finally:
+                db.session.remove()
+    results.append((ops, errors, latencies, top_ups))
+
+def run(profile, threads, seconds, write_ratio, users, dishes):
+    directory = tempfile.mkdtemp()
+    try:
+        app = make_app(os.path.join(directory, "bench.db"), profile)
+        seed(app, users, dishes)
+        results = []
+        deadline = time.monotonic() + seconds
+        pool = [threading.Thread(target=worker, args=(app, users, write_ratio, deadline, results)) for _ in range(threads)]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        with app.app_context():
+            balances = db.session.query(db.func.sum(User.balance_cents)).scalar()
+            db.session.remove()
+            db.get_engine(app).dispose()
+    finally:
+        shutil.rmtree(directory)
+
+    ops = sum(r[0] for r in results)
+    errors = sum(r[1] for r in results)
+    latencies = sorted(l for r in results for l in r[2]) or [0]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    lost = sum(r[3] for r in results) - balances
+    print("%-8s %8d ops %8.0f ops/s %6d errors  p50 %6.1f ms  p99 %7.1f ms %6d lost top-ups" % (
+        profile, ops, ops / seconds, errors, latencies[len(latencies) // 2] * 1000, p99 * 1000, lost))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--dishes", type=int, default=5000)
+    parser.add_argument("--profile", choices=sorted(PROFILES), action="append")
+    args = parser.parse_args()
+
+    print("%d threads, %.0f%% writes, %.0fs per profile" % (args.threads, args.write_ratio * 100, args.seconds))
+    for profile in args.profile or ["legacy", "unrouted", "tuned"]:
+        run(profile, args.threads, args.seconds, args.write_ratio, args.users, args.dishes)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Driver dispatch under a simulated dinner rush.
+
+Seeds a scratch database with users, restaurants and drivers, then replays
+a rush through the Flask test client: orders arrive as a Poisson process
+whose rate climbs from a tenth of --peak-rate to --peak-rate and back over
+--minutes simulated minutes, and each is delivered 20 to 40 simulated
+minutes after it was placed. Simulated time runs as fast as requests
+complete. The same arrivals are replayed once per strategy:
+
+- random: the caller picks any driver (how orders were assigned before
+  the dispatcher)
+- query: the caller picks the least-loaded driver with a GROUP BY over
+  the order table
+- dispatcher: no driver is given and dispatch.py picks one
+
+and the report shows order creation latency (including picking the
+driver) and how evenly open orders were spread over drivers.
+
+Usage: python benchmarks/dispatch.py [--drivers 500] [--peak-rate 60] [--minutes 120]
+"""
+import argparse
+import heapq
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+STRATEGIES = ("random", "query", "dispatcher")
+# Simulated minutes between samples of the load spread
+SAMPLE_MINUTES = 5
+
+def arrivals(rng, peak_rate, minutes):
+    times = []
+    now = 0.0
+    while True:
+        # Triangular rush: a tenth of the peak at both ends, the peak midway
+        rate = peak_rate * (0.1 + 0.9 * (1 - abs(2 * now / minutes - 1)))
+        now += rng.expovariate(rate)
+        if now >= minutes:
+            return times
+        times.append(now)
+
+def least_loaded(db, Driver, Order):
+    load = db.func.count(Order.id)
+    return db.session.query(Driver.id).outerjoin(
+        Order, db.and_(Order.driver_id == Driver.id, Order.delivered == False)
+    ).group_by(Driver.id).order_by(load, Driver.id).limit(1).scalar()
+
+def spread(db, Order, drivers):
+    loads = [count for _, count in db.session.query(Order.driver_id, db.func.count(Order.id)).filter(
+        Order.delivered == False, Order.driver_id.isnot(None)
+    ).group_by(Order.driver_id)]
+    loads += [0] * (drivers - len(loads))
+    mean = float(sum(loads)) / len(loads)
+    return max(loads), (sum((load - mean) ** 2 for load in loads) / len(loads)) ** 0.5
+
+def run(strategy, app, client, ids, times, rng):
+    from db import db, Driver, Order
+    import dispatch
+    with app.app_context():
+        dispatch.dispatcher.reset()
+    drivers = ids["drivers"][1] - ids["drivers"][0] + 1
+    # (simulated minute, kind, order id): kind 0 delivers, 1 places, 2 samples
+    events = [(minute, 1, None) for minute in times]
+    events += [(minute, 2, None) for minute in range(SAMPLE_MINUTES, int(times[-1]) + 1, SAMPLE_MINUTES)]
+    heapq.heapify(events)
+    latencies, max_loads, deviations = [], [], []
+    while events:
+        minute, kind, order_id = heapq.heappop(events)
+        if kind == 0:
+            client.post("/order/%d/" % order_id, data=json.dumps({"delivered": True}))
+        elif kind == 2:
+            with app.app_context():
+                max_load, deviation = spread(db, Order, drivers)
+            max_loads.append(max_load)
+            deviations.append(deviation)
+        else:
+            started = time.perf_counter()
+            body = {}
+            if strategy == "random":
+                body["driver_id"] = rng.randint(*ids["drivers"])
+            elif strategy == "query":
+                with app.app_context():
+                    body["driver_id"] = least_loaded(db, Driver, Order)
+            response = client.post("/user/%d/restaurant/%d/order/" % (rng.randint(*ids["users"]), rng.randint(*ids["restaurants"])),
+                data=json.dumps(body))
+            latencies.append(time.perf_counter() - started)
+            order_id = json.loads(response.data)["data"]["id"]
+            heapq.heappush(events, (minute + rng.uniform(20, 40), 0, order_id))
+    latencies.sort()
+    print("%-10s %7d orders  p50 %6.2f ms  p95 %6.2f ms  peak max load %3d  mean load stddev %5.2f" % (
+        strategy, len(latencies), latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.95)] * 1000,
+        max(max_loads), sum(deviations) / len(deviations)))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--drivers", type=int, default=500)
+    parser.add_argument("--peak-rate", type=float, default=60, help="orders per simulated minute at the height of the rush")
+    parser.add_argument("--minutes", type=float, default=120, help="simulated length of the rush")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--strategy", choices=STRATEGIES, action="append")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = "sqlite:///%s" % os.path.join(directory, "bench.db")
+    try:
+        import app as application
+        import seed
+        app = application.app
+        with app.app_context():
+            counts = seed.scaled_counts(0.01, drivers=args.drivers, orders=0, reviews=0)
+            ids = seed.seed(counts, args.seed, log=lambda message: None)
+        times = arrivals(random.Random(args.seed), args.peak_rate, args.minutes)
+        print("%d drivers, %d orders over %.0f simulated minutes, peaking at %.0f per minute" % (
+            args.drivers, len(times), args.minutes, args.peak_rate))
+        for strategy in args.strategy or STRATEGIES:
+            run(strategy, app, app.test_client(), ids, times, random.Random(args.seed))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Response encoding of restaurants with large menus.
+
+Builds restaurants in memory (no database) with --dishes dishes each and
+an order for every tenth dish, then times turning one into the body of a
+GET /restaurant/<id>/ response:
+
+- serialize: restaurant.serialize() and json.dumps, as before encoding.py
+- cold: encoding.encode with an empty fragment cache
+- warm: the restaurant's version changed (a rename, a new review) but its
+  dishes and orders did not, so their fragments are spliced in as they are
+- hot: the restaurant's fragment is cached
+
+once with the json module and once with orjson when it is installed.
+
+Usage: python benchmarks/encoding.py [--dishes 100,1000,10000] [--repeat 20]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+def build(dishes, rng):
+    from db import Restaurant, Dish, Order, OrderItem
+    restaurant = Restaurant(name="Restaurant", rating=4.2)
+    restaurant.id, restaurant.version = 1, 1
+    restaurant.menu = []
+    for i in range(dishes):
+        dish = Dish(name="Dish number %d" % i, price=rng.randint(300, 3000) / 100.0, sold_out=rng.random() < 0.1, restaurant_id=1)
+        dish.id, dish.version = i + 1, 1
+        restaurant.menu.append(dish)
+    restaurant.orders = []
+    for i in range(dishes // 10):
+        order = Order(date_time="2024-01-01 12:00:00.000000", paid=True, delivered=True, user_id=1, restaurant_id=1)
+        order.id, order.version = i + 1, 1
+        order.dishes = rng.sample(restaurant.menu, min(3, dishes))
+        order.items = []
+        for dish in order.dishes:
+            item = OrderItem()
+            item.dish_id, item.quantity = dish.id, rng.randint(1, 3)
+            order.items.append(item)
+        order.total = sum(dish.price * item.quantity for dish, item in zip(order.dishes, order.items))
+        restaurant.orders.append(order)
+    return restaurant
+
+def measure(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    times.sort()
+    return times[len(times) // 2] * 1000
+
+def run(restaurant, repeat):
+    import encoding
+
+    def serialize():
+        return json.dumps({"success": True, "data": restaurant.serialize()})
+
+    def cold():
+        encoding.fragments.clear()
+        return encoding.envelope(encoding.encode(restaurant))
+
+    def warm():
+        restaurant.version += 1
+        return encoding.envelope(encoding.encode(restaurant))
+
+    def hot():
+        return encoding.envelope(encoding.encode(restaurant))
+
+    assert json.loads(cold()) == json.loads(serialize())
+    hot()
+    return [measure(fn, repeat) for fn in (serialize, cold, warm, hot)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dishes", default="100,1000,10000", help="comma separated menu sizes")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    import encoding
+    encoding.fragments.max_size = 10 ** 6
+    orjson = encoding.orjson
+    encoders = [("json", None)] + ([("orjson", orjson)] if orjson is not None else [])
+    print("%-7s %6s %12s %10s %10s %10s" % ("encoder", "dishes", "serialize", "cold", "warm", "hot"))
+    for size in [int(size) for size in args.dishes.split(",")]:
+        restaurant = build(size, random.Random(0))
+        for name, module in encoders:
+            encoding.orjson = module
+            print("%-7s %6d %9.2f ms %7.2f ms %7.2f ms %7.3f ms" % ((name, size) + tuple(run(restaurant, args.repeat))))
+    encoding.orjson = orjson
+
+if __name__ == "__main__":
+    main()
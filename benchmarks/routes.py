@@ -0,0 +1,275 @@
+"""Latency and throughput of every route, against a seeded scratch database.
+
+Seeds a scratch SQLite database with seed.py, then drives each route of
+app.py through the Flask test client and reports requests per second and
+p50/p95/p99 latency. Routes that change or delete rows get fresh rows made
+for them, outside the timed request.
+
+Compare against a baseline (exits 1 when a route's p50 or p95 got slower
+by more than --tolerance):
+    python benchmarks/routes.py --baseline benchmarks/baseline.json
+Record a new baseline:
+    python benchmarks/routes.py --save-baseline benchmarks/baseline.json
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+class Context(object):
+    def __init__(self, app, client, ids, menus, rng):
+        self.app = app
+        self.client = client
+        self.ids = ids
+        self.menus = menus
+        self.rng = rng
+        self.created = 0
+        self.token = None
+
+    def id(self, kind):
+        return self.rng.randint(*self.ids[kind])
+
+    def restaurant_with_menu(self):
+        return self.rng.choice(list(self.menus))
+
+    def name(self, prefix):
+        self.created += 1
+        return "%s %d %d" % (prefix, os.getpid(), self.created)
+
+    def auth(self):
+        return {"Authorization": "Bearer " + self.token}
+
+    def post(self, path, body, headers=None):
+        response = self.client.post(path, data=json.dumps(body), headers=headers)
+        return json.loads(response.data)
+
+    def new_restaurant(self):
+        return self.post("/restaurant/", {"name": self.name("Bench Restaurant")})["data"]["id"]
+
+    def new_order(self):
+        restaurant = self.restaurant_with_menu()
+        order = self.post("/user/%d/restaurant/%d/order/" % (self.id("users"), restaurant), {"driver_id": self.id("drivers")})
+        return order["data"]["id"], restaurant
+
+# Each scenario returns (method, path, body[, headers]) for one request, the
+# body being JSON-encoded unless it is already a string; anything it does
+# first is setup and is not timed
+SCENARIOS = {
+    "header": lambda ctx: ("GET", "/", None),
+    "get_all_users": lambda ctx: ("GET", "/users/?limit=20&after=%d" % ctx.id("users"), None),
+    "get_users_by_ids": lambda ctx: ("GET", "/users/?ids=%s" % _ids(ctx, "users"), None),
+    "get_user_by_id": lambda ctx: ("GET", "/user/%d/" % ctx.id("users"), None),
+    "add_to_balance": lambda ctx: ("POST", "/user/%d/balance/" % ctx.id("users"), {"amount": 5}, ctx.auth()),
+    "update_user": lambda ctx: ("POST", "/user/%d/" % ctx.id("users"), {"username": ctx.name("user")}, ctx.auth()),
+    "delete_user": lambda ctx: ("DELETE", "/user/%d/" % _new_user(ctx), None, ctx.auth()),
+    "get_all_restaurants": lambda ctx: ("GET", "/restaurants/?limit=20&after=%d" % ctx.id("restaurants"), None),
+    "create_restaurant": lambda ctx: ("POST", "/restaurant/", {"name": ctx.name("Bench Restaurant")}),
+    "get_restaurants_by_ids": lambda ctx: ("GET", "/restaurants/?ids=%s" % _ids(ctx, "restaurants"), None),
+    "get_restaurant_by_id": lambda ctx: ("GET", "/restaurant/%d/" % ctx.id("restaurants"), None),
+    "get_restaurant_page": lambda ctx: ("GET", "/restaurant/%d/menu/" % ctx.id("restaurants"), None),
+    "update_restaurant": lambda ctx: ("POST", "/restaurant/%d/" % ctx.id("restaurants"), {"name": ctx.name("Renamed")}),
+    "delete_restaurant": lambda ctx: ("DELETE", "/restaurant/%d/" % ctx.new_restaurant(), None),
+    "get_all_dishes": lambda ctx: ("GET", "/dishes/?limit=20&after=%d" % ctx.id("dishes"), None),
+    "create_dish_for_restaurant": lambda ctx: (
+        "POST", "/restaurants/%d/dish/" % ctx.id("restaurants"), {"name": ctx.name("dish"), "price": 9.5}),
+    "get_dishes_by_ids": lambda ctx: ("GET", "/dishes/?ids=%s" % _ids(ctx, "dishes"), None),
+    "get_dish_by_id": lambda ctx: ("GET", "/dish/%d/" % ctx.id("dishes"), None),
+    "update_dish": lambda ctx: ("POST", "/dish/%d/" % ctx.id("dishes"), {"price": ctx.rng.randint(300, 3000) / 100.0}),
+    "delete_dish": lambda ctx: ("DELETE", "/dish/%d/" % ctx.post(
+        "/restaurants/%d/dish/" % ctx.id("restaurants"), {"name": ctx.name("dish"), "price": 1})["data"]["id"], None),
+    "get_orders_of_user": lambda ctx: ("GET", "/user/%d/orders/" % ctx.id("users"), None),
+    "create_order": lambda ctx: (
+        "POST", "/user/%d/restaurant/%d/order/" % (ctx.id("users"), ctx.id("restaurants")), {"driver_id": ctx.id("drivers")}),
+    "checkout": lambda ctx: _checkout(ctx),
+    "add_dish_to_order": lambda ctx: _add_dish(ctx),
+    "update_order_dishes": lambda ctx: _update_dishes(ctx),
+    "get_order_status": lambda ctx: ("GET", "/order/%d/status/" % ctx.id("orders"), None),
+    "order_events": lambda ctx: ("GET", "/order/%d/events/" % _delivered_order(ctx), None),
+    "get_orders_by_ids": lambda ctx: ("GET", "/orders/?ids=%s" % _ids(ctx, "orders"), None),
+    "get_order_by_id": lambda ctx: ("GET", "/order/%d/" % ctx.id("orders"), None),
+    "update_order": lambda ctx: ("POST", "/order/%d/" % ctx.new_order()[0], {"paid": True}),
+    "delete_order": lambda ctx: ("DELETE", "/order/%d/" % ctx.new_order()[0], None),
+    "dispatch_backlog": lambda ctx: ("POST", "/orders/dispatch/?limit=100", None),
+    "get_driver_by_id": lambda ctx: ("GET", "/driver/%d/" % ctx.id("drivers"), None),
+    "get_orders_of_driver": lambda ctx: ("GET", "/driver/%d/orders/?delivered=false" % ctx.id("drivers"), None),
+    "get_driver_of_order": lambda ctx: ("GET", "/order/%d/driver/" % ctx.id("orders"), None),
+    "create_driver": lambda ctx: ("POST", "/driver/", {"name": ctx.name("Driver"), "license_plate_number": "BEN0001"}),
+    "delete_driver": lambda ctx: ("DELETE", "/driver/%d/" % ctx.post(
+        "/driver/", {"name": ctx.name("Driver"), "license_plate_number": "BEN0001"})["data"]["id"], None),
+    "get_reviews_by_user": lambda ctx: ("GET", "/user/%d/reviews/" % ctx.id("users"), None),
+    "get_reviews_of_restaurant": lambda ctx: ("GET", "/restaurant/%d/reviews/" % ctx.id("restaurants"), None),
+    "create_review_for_restaurant": lambda ctx: (
+        "POST", "/restaurant/%d/review/" % ctx.id("restaurants"), {"user_id": ctx.id("users"), "rating": 4, "content": "fine"}),
+    "get_review_by_id": lambda ctx: ("GET", "/review/%d/" % ctx.id("reviews"), None),
+    "update_review": lambda ctx: ("POST", "/review/%d/" % ctx.id("reviews"), {"rating": ctx.rng.randint(1, 5)}),
+    "delete_review": lambda ctx: ("DELETE", "/review/%d/" % ctx.post(
+        "/restaurant/%d/review/" % ctx.id("restaurants"), {"user_id": ctx.id("users"), "rating": 3, "content": "x"})["data"]["id"], None),
+    "get_all_categories": lambda ctx: ("GET", "/categories/", None),
+    "create_category": lambda ctx: ("POST", "/category/", {"description": ctx.name("Category")}),
+    "get_category_by_id": lambda ctx: ("GET", "/category/%d/" % ctx.id("categories"), None),
+    "get_restaurants_in_category": lambda ctx: ("GET", "/category/%d/restaurants/" % ctx.id("categories"), None),
+    "add_restaurant_to_category": lambda ctx: (
+        "POST", "/category/%d/add/" % ctx.id("categories"), {"restaurant_id": ctx.id("restaurants")}),
+    "delete_category": lambda ctx: ("DELETE", "/category/%d/" % ctx.post(
+        "/category/", {"description": ctx.name("Category")})["data"]["id"], None),
+    "import_records": lambda ctx: ("POST", "/restaurants/import/", _ndjson(
+        {"name": ctx.name("Imported Restaurant")} for _ in range(100))),
+    "export_records": lambda ctx: ("GET", "/drivers/export/", None),
+    "import_menu": lambda ctx: ("POST", "/restaurant/%d/menu/import/?mode=upsert" % ctx.restaurant_with_menu(), _ndjson(
+        {"name": ctx.name("Imported Dish"), "price": ctx.rng.randint(300, 3000) / 100.0} for _ in range(100))),
+    "export_menu": lambda ctx: ("GET", "/restaurant/%d/menu/export/?format=csv" % ctx.restaurant_with_menu(), None),
+    "search": lambda ctx: ("GET", "/search/?q=%s" % ctx.rng.choice(["pad thai", "ramen", "spicy", "golden kitchen", "tacos"]), None),
+    "register_account": lambda ctx: ("POST", "/register/", _credentials(ctx, ctx.name("bench"))),
+    "login": lambda ctx: ("POST", "/login/", {"email": "user%d@example.com" % ctx.id("users"), "password": "password"}),
+    "update_session": lambda ctx: _renew(ctx),
+    "secret_message": lambda ctx: ("GET", "/secret/", None, ctx.auth()),
+    "metrics": lambda ctx: ("GET", "/metrics", None),
+}
+
+# A cart's or feed's worth of ids, as one multi-get would take them
+def _ids(ctx, kind):
+    return ",".join(str(ctx.id(kind)) for _ in range(30))
+
+def _ndjson(records):
+    return "".join(json.dumps(record) + "\n" for record in records)
+
+# Its event stream ends right after the current status
+def _delivered_order(ctx):
+    order_id = ctx.new_order()[0]
+    ctx.post("/order/%d/" % order_id, {"delivered": True})
+    return order_id
+
+def _credentials(ctx, name):
+    return {"name": name, "username": name, "email": "%s@bench.example.com" % name.replace(" ", "."), "password": "password"}
+
+def _new_user(ctx):
+    from db import User
+    body = _credentials(ctx, ctx.name("doomed"))
+    ctx.post("/register/", body)
+    with ctx.app.app_context():
+        return User.query.filter_by(email=body["email"]).first().id
+
+def _renew(ctx):
+    body = _credentials(ctx, ctx.name("renewing"))
+    tokens = ctx.post("/register/", body)
+    return "POST", "/session/", None, {"Authorization": "Bearer " + tokens["update_token"]}
+
+def _checkout(ctx):
+    restaurant = ctx.restaurant_with_menu()
+    user = ctx.id("users")
+    ctx.post("/user/%d/balance/" % user, {"amount": 1000}, ctx.auth())
+    dishes = [{"dish_id": dish, "quantity": 1} for dish in ctx.menus[restaurant][:2]]
+    return "POST", "/user/%d/restaurant/%d/checkout/" % (user, restaurant), {"driver_id": ctx.id("drivers"), "dishes": dishes}
+
+def _add_dish(ctx):
+    order, restaurant = ctx.new_order()
+    return "POST", "/order/%d/add/" % order, {"dish_id": ctx.rng.choice(ctx.menus[restaurant])}
+
+def _update_dishes(ctx):
+    order, restaurant = ctx.new_order()
+    dishes = [{"dish_id": dish, "quantity": 2} for dish in ctx.menus[restaurant][:3]]
+    return "POST", "/order/%d/dishes/" % order, {"dishes": dishes}
+
+def percentile(latencies, fraction):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+def measure(ctx, endpoint, iterations, warmup):
+    latencies = []
+    statuses = set()
+    for i in range(warmup + iterations):
+        request = SCENARIOS[endpoint](ctx)
+        method, path, body = request[:3]
+        headers = request[3] if len(request) > 3 else None
+        data = body if body is None or isinstance(body, str) else json.dumps(body)
+        started = time.perf_counter()
+        response = ctx.client.open(path, method=method, data=data, headers=headers)
+        response.get_data()
+        response.close()
+        if i >= warmup:
+            latencies.append(time.perf_counter() - started)
+            statuses.add(response.status_code)
+    latencies.sort()
+    return {
+        "requests_per_second": round(len(latencies) / sum(latencies), 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "statuses": sorted(statuses),
+    }
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for endpoint, result in sorted(results.items()):
+        before = baseline.get("routes", {}).get(endpoint)
+        if before is None:
+            continue
+        for key in ("p50_ms", "p95_ms"):
+            if result[key] > before[key] * (1 + tolerance):
+                regressions.append("%s %s: %.2f ms -> %.2f ms" % (endpoint, key, before[key], result[key]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", type=float, default=0.01, help="seed.py scale of the scratch database")
+    parser.add_argument("--iterations", type=int, default=30, help="requests per route")
+    parser.add_argument("--warmup", type=int, default=5, help="untimed requests per route first")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--route", action="append", help="only benchmark these endpoints")
+    parser.add_argument("--baseline", help="JSON baseline to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed slowdown before a route counts as regressed")
+    parser.add_argument("--save-baseline", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = "sqlite:///%s" % os.path.join(directory, "bench.db")
+    os.environ.setdefault("BCRYPT_ROUNDS", "4")
+    try:
+        import app as application
+        import seed
+        from db import db, Dish
+        app = application.app
+
+        with app.app_context():
+            ids = seed.seed(seed.scaled_counts(args.scale), args.seed, log=lambda message: None)
+            menus = {}
+            for restaurant_id, dish_id in db.session.query(Dish.restaurant_id, Dish.id).filter_by(sold_out=False).order_by(Dish.id):
+                menus.setdefault(restaurant_id, []).append(dish_id)
+
+        missing = sorted(rule.endpoint for rule in app.url_map.iter_rules()
+            if rule.endpoint != "static" and rule.endpoint not in SCENARIOS)
+        if missing:
+            parser.error("no benchmark scenario for: %s" % ", ".join(missing))
+
+        ctx = Context(app, app.test_client(), ids, menus, random.Random(args.seed))
+        ctx.token = ctx.post("/login/", {"email": "user%d@example.com" % ids["users"][0], "password": "password"})["session_token"]
+        results = {}
+        print("%-30s %10s %9s %9s %9s  %s" % ("route", "req/s", "p50 ms", "p95 ms", "p99 ms", "status"))
+        for endpoint in args.route or sorted(SCENARIOS):
+            result = results[endpoint] = measure(ctx, endpoint, args.iterations, args.warmup)
+            print("%-30s %10.0f %9.2f %9.2f %9.2f  %s" % (endpoint, result["requests_per_second"], result["p50_ms"],
+                result["p95_ms"], result["p99_ms"], ",".join(str(status) for status in result["statuses"])))
+    finally:
+        shutil.rmtree(directory)
+
+    report = {"scale": args.scale, "iterations": args.iterations, "routes": results}
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
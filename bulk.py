@@ -0,0 +1,212 @@
+import csv
+import io
+import json
+from db import db, Restaurant, Dish, Order, Driver, Category, association_order_dishes, to_cents
+from engine import read_only
+import dao
+import dispatch
+
+# Rows per executemany batch and per name lookup; stays under SQLite's
+# default limit of 999 bound parameters per statement
+CHUNK_SIZE = 500
+FORMATS = ("ndjson", "csv")
+
+class RecordError(Exception):
+    def __init__(self, message, line=None):
+        super(RecordError, self).__init__(message if line is None else "Line %d: %s" % (line, message))
+
+def _text(value, field):
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError("Missing %s." % field)
+    return value.strip()
+
+def _price(value):
+    try:
+        price = float(value)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid price %r." % (value,))
+    if price < 0:
+        raise ValueError("Invalid price %r." % (value,))
+    return to_cents(price)
+
+def _bool(value):
+    if isinstance(value, bool):
+        return value
+    if value is None or str(value).strip().lower() in ("", "0", "false", "no"):
+        return False
+    if str(value).strip().lower() in ("1", "true", "yes"):
+        return True
+    raise ValueError("Invalid boolean %r." % (value,))
+
+# What can be imported and exported: the model, the column a row is matched
+# on in upsert mode, the exported columns (name, column, column -> value),
+# how an input record becomes column values, and values only new rows get
+KINDS = {
+    "menu": {
+        "model": Dish,
+        "key": "name",
+        "columns": (("id", "id", None), ("name", "name", None), ("price", "price_cents", lambda cents: cents / 100.0),
+            ("sold_out", "sold_out", None)),
+        "parse": lambda record: {
+            "name": _text(record.get("name"), "name"),
+            "price_cents": _price(record.get("price")),
+            "sold_out": _bool(record.get("sold_out")),
+        },
+    },
+    "restaurants": {
+        "model": Restaurant,
+        "key": "name",
+        "columns": (("id", "id", None), ("name", "name", None), ("rating", "rating", None)),
+        "parse": lambda record: {"name": _text(record.get("name"), "name")},
+        "defaults": {"rating": 0, "rating_sum": 0, "rating_count": 0},
+    },
+    "categories": {
+        "model": Category,
+        "key": "description",
+        "columns": (("id", "id", None), ("description", "description", None)),
+        "parse": lambda record: {"description": _text(record.get("description"), "description")},
+    },
+    "drivers": {
+        "model": Driver,
+        "key": "name",
+        "columns": (("id", "id", None), ("name", "name", None), ("license_plate_number", "license_plate_number", None)),
+        "parse": lambda record: {
+            "name": _text(record.get("name"), "name"),
+            "license_plate_number": _text(record.get("license_plate_number"), "license_plate_number"),
+        },
+    },
+}
+
+# Yields (line number, record) from a binary stream of NDJSON or CSV with a
+# header row, without reading it all into memory
+def read_records(stream, format):
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    if format == "csv":
+        reader = csv.DictReader(text)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line, raw in enumerate(text, 1):
+        if not raw.strip():
+            continue
+        try:
+            record = json.loads(raw)
+        except ValueError:
+            raise RecordError("Invalid JSON.", line)
+        if not isinstance(record, dict):
+            raise RecordError("Expected a JSON object.", line)
+        yield line, record
+
+def _chunks(records):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# Inserts the records in CHUNK_SIZE executemany batches, all in one
+# transaction. With upsert, records whose key (name, or description for
+# categories) matches an existing row update it instead; within a menu,
+# matching is limited to the restaurant's dishes. Returns
+# {"inserted": n, "updated": n}, or None if the restaurant does not exist.
+def import_records(kind, records, restaurant_id=None, upsert=False):
+    spec = KINDS[kind]
+    table = spec["model"].__table__
+    key = table.c[spec["key"]]
+    scope = {}
+    if kind == "menu":
+        if Restaurant.query.filter_by(id=restaurant_id).count() == 0:
+            return None
+        scope = {"restaurant_id": restaurant_id}
+
+    # One expanding parameter instead of a bound parameter per key, which
+    # would cost a compile per chunk
+    lookup = db.select([key, table.c.id]).where(key.in_(db.bindparam("keys", expanding=True)))
+    for column, value in scope.items():
+        lookup = lookup.where(table.c[column] == value)
+    inserted = updated = 0
+    updated_ids = []
+    try:
+        for chunk in _chunks(records):
+            rows = {} if upsert else []
+            for line, record in chunk:
+                try:
+                    row = spec["parse"](record)
+                except ValueError as e:
+                    raise RecordError(str(e), line)
+                row.update(scope)
+                if upsert:
+                    rows[row[spec["key"]]] = row
+                else:
+                    rows.append(row)
+            if upsert:
+                existing = dict(db.session.execute(lookup, {"keys": list(rows)}).fetchall())
+                changes = [dict(row, _id=existing[name]) for name, row in rows.items() if name in existing]
+                rows = [row for name, row in rows.items() if name not in existing]
+                # The key and scope already match; leaving them out of SET
+                # also keeps the search index triggers from firing
+                columns = [column for column in (changes[0] if changes else ())
+                    if column != "_id" and column != spec["key"] and column not in scope]
+                if columns:
+                    values = dict((column, db.bindparam(column)) for column in columns)
+                    # Drivers and categories carry no version
+                    if "version" in table.c:
+                        values["version"] = table.c.version + 1
+                    db.session.execute(table.update().where(table.c.id == db.bindparam("_id")).values(**values), changes)
+                updated += len(changes)
+                updated_ids.extend(change["_id"] for change in changes)
+            if rows:
+                db.session.execute(table.insert(), [dict(spec.get("defaults", {}), **row) for row in rows])
+                inserted += len(rows)
+        restaurant_ids = set()
+        if kind == "menu":
+            restaurant_ids.add(restaurant_id)
+            # Restaurants whose serialized orders embed an updated dish
+            for start in range(0, len(updated_ids), CHUNK_SIZE):
+                restaurant_ids.update(rid for rid, in db.session.query(Order.restaurant_id).filter(
+                    Order.id == association_order_dishes.c.order_id,
+                    association_order_dishes.c.dish_id.in_(updated_ids[start:start + CHUNK_SIZE])
+                ).distinct())
+            dao._bump(Restaurant, *restaurant_ids)
+            dao._bump_orders_containing(*updated_ids)
+            dao._rebuild_snapshots(restaurant_id)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    if kind == "menu":
+        dao._invalidate(Restaurant, *restaurant_ids)
+        dao._invalidate(Dish, *updated_ids)
+    elif kind == "drivers":
+        dispatch.dispatcher.reset()
+    return {"inserted": inserted, "updated": updated}
+
+# Yields the rows of a kind (a restaurant's dishes for menus) as NDJSON
+# lines or CSV rows, reading YIELD_PER rows at a time
+@read_only
+def export_records(kind, format, restaurant_id=None):
+    spec = KINDS[kind]
+    model = spec["model"]
+    columns = spec["columns"]
+    query = db.session.query(*[getattr(model, column) for _, column, _ in columns]).order_by(model.id)
+    if kind == "menu":
+        query = query.filter(Dish.restaurant_id == restaurant_id)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if format == "csv":
+        writer.writerow([name for name, _, _ in columns])
+    for row in query.yield_per(dao.YIELD_PER):
+        values = [value if convert is None else convert(value) for (_, _, convert), value in zip(columns, row)]
+        if format == "csv":
+            writer.writerow(values)
+        else:
+            buffer.write(json.dumps(dict(zip([name for name, _, _ in columns], values))) + "\n")
+        if buffer.tell() >= 65536:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
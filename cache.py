@@ -0,0 +1,167 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# Bounded in-process cache: least recently used entries are evicted once
+# max_size is reached, and entries older than ttl seconds are never served.
+# With max_bytes, the values' total len() is bounded too, and a value longer
+# than max_bytes on its own is not kept.
+class LRUCache(object):
+    def __init__(self, max_size=10000, ttl=300, max_bytes=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = self.expirations = self.oversized = 0
+
+    def _size(self, value):
+        return 0 if self.max_bytes is None else len(value)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.bytes -= self._size(value)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = self._size(value)
+        with self._lock:
+            self._pop(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                self.oversized += 1
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self.bytes += size
+            while len(self._entries) > self.max_size or (self.max_bytes is not None and self.bytes > self.max_bytes):
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.bytes -= self._size(evicted)
+                self.evictions += 1
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= self._size(entry[1])
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        stats = {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "size": len(self._entries),
+        }
+        if self.max_bytes is not None:
+            stats.update(bytes=self.bytes, oversized=self.oversized)
+        return stats
+
+# Cache kept in an out-of-process store through a Redis-style client
+# (get/setex/delete). Values are stored as JSON; size bounds and evictions
+# are the store's business.
+class ClientCache(object):
+    def __init__(self, client, ttl=300, prefix="dingdong:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        with self._lock:
+            if raw is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(raw)
+
+    def set(self, key, value):
+        self.client.setex(self.prefix + key, self.ttl, json.dumps(value))
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": 0, "expirations": 0}
+
+# In-process stand-in for a Redis client, so the client backend can run
+# without a server
+class LocalClient(object):
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                return None
+            return entry[1]
+
+    def setex(self, key, ttl, value):
+        with self._lock:
+            self._values[key] = (time.monotonic() + ttl, value)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._values.pop(key, None)
+
+    def scan_iter(self, pattern):
+        prefix = pattern.rstrip("*")
+        with self._lock:
+            return [key for key in self._values if key.startswith(prefix)]
+
+# Encoded JSON of restaurants, dishes and categories, keyed "<kind>:<id>"
+entities = LRUCache()
+
+def init_app(app):
+    global entities
+    app.config.setdefault("CACHE_BACKEND", "memory")
+    app.config.setdefault("CACHE_MAX_SIZE", 10000)
+    app.config.setdefault("CACHE_TTL", 300)
+    app.config.setdefault("CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+    backend = app.config["CACHE_BACKEND"]
+    ttl = app.config["CACHE_TTL"]
+    if backend == "memory":
+        entities = LRUCache(app.config["CACHE_MAX_SIZE"], ttl)
+    elif backend == "local":
+        entities = ClientCache(LocalClient(), ttl)
+    elif backend == "redis":
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_BACKEND = 'redis' requires the redis package.")
+        entities = ClientCache(redis.Redis.from_url(app.config["CACHE_REDIS_URL"]), ttl)
+    else:
+        raise ValueError("Unknown CACHE_BACKEND %r." % backend)
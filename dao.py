@@ -1,56 +1,305 @@
-from db import db, User, Restaurant, Dish, Order, Driver, Review, Category
-
-def get_all_users():
-    return [u.serialize() for u in User.query.all()]
-
-def get_user_by_id(user_id):
-    user = User.query.filter_by(id=user_id).first()
+import json
+import re
+import time
+from db import db, to_cents, User, Restaurant, RestaurantSnapshot, Dish, Order, Driver, Review, Category
+from db import association_order_dishes, association_restaurant_categories
+from db import SEARCH_KINDS, SEARCH_SOURCES
+import cache
+import encoding
+import auth
+import dispatch
+import events
+import jobs
+import ledger
+from engine import read_only
+
+# Loads a single entity together with everything its projection serializes
+def _get(model, id, fields=None, depth=None):
+    return model.query.options(*model.serialize_options(fields, depth)).filter_by(id=id).first()
+
+# What a read returns for an entity: its encoded JSON fragment for the
+# default projection, a dict to be encoded with the response otherwise
+def _payload(entity, fields=None, depth=None):
+    if fields is None and depth is None:
+        return encoding.encode(entity)
+    return entity.serialize(fields, depth)
+
+# Entities by id in the order asked for, None for ids that do not exist,
+# loaded with one IN query. In the default projection, restaurants, dishes
+# and orders first look up their versions with one IN query over the
+# primary key, and only the ones without a cached fragment are loaded.
+def _get_many(model, ids, fields=None, depth=None):
+    found = {}
+    missing = list(set(ids))
+    if fields is None and depth is None and "version" in model.__table__.c:
+        versions = db.session.query(model.id, model.version).filter(model.id.in_(missing)).all()
+        missing = []
+        for id, version in versions:
+            fragment = encoding.cached(model, id, version)
+            if fragment is None:
+                missing.append(id)
+            else:
+                found[id] = fragment
+    if missing:
+        for entity in model.query.options(*model.serialize_options(fields, depth)).filter(model.id.in_(missing)):
+            found[entity.id] = _payload(entity, fields, depth)
+    return [found.get(id) for id in ids]
+
+# Serves an entity's encoded JSON from the cache when the default projection
+# is asked for; projected reads go straight to the database. The body is
+# cached with the entity's version, and a caller that has just read the
+# version (to send it as an ETag) passes it in: a body cached at any other
+# version, say by a process that missed another one's invalidation, is
+# treated as a miss.
+def _read_through(model, id, fields=None, depth=None, version=None):
+    if fields is not None or depth is not None:
+        entity = _get(model, id, fields, depth)
+        return None if entity is None else entity.serialize(fields, depth)
+    key = "%s:%d" % (model.__tablename__, id)
+    cached = cache.entities.get(key)
+    if cached is None or (version is not None and cached[0] != version):
+        entity = _get(model, id)
+        if entity is None:
+            return None
+        cached = [getattr(entity, "version", None), str(encoding.encode(entity))]
+        cache.entities.set(key, cached)
+    return encoding.Fragment(cached[1])
+
+# Drops cached entities after a write that changed what they serialize to
+def _invalidate(model, *ids):
+    cache.entities.delete(*["%s:%d" % (model.__tablename__, id) for id in ids])
+
+# Bumps the version of rows matching the condition, inside the write's own
+# transaction, so their ETags change together with their payload
+def _bump_where(model, condition):
+    model.query.filter(condition).update({model.version: model.version + 1}, synchronize_session=False)
+
+def _bump(model, *ids):
+    for start in range(0, len(ids), YIELD_PER):
+        _bump_where(model, model.id.in_(ids[start:start + YIELD_PER]))
+
+# Orders whose serialized dishes include any of the given dishes
+def _bump_orders_containing(*dish_ids):
+    link = association_order_dishes
+    for start in range(0, len(dish_ids), YIELD_PER):
+        _bump_where(Order, Order.id.in_(
+            db.select([link.c.order_id]).where(link.c.dish_id.in_(dish_ids[start:start + YIELD_PER]))
+        ))
+
+# The version of a restaurant, dish or order, looked up by primary key
+# without loading the row; None if it does not exist
+@read_only
+def get_version(model, id):
+    return db.session.query(model.version).filter(model.id == id).scalar()
+
+# Restaurants whose serialized orders embed the given dish
+def _restaurants_ordering(dish_id):
+    rows = db.session.query(Order.restaurant_id).filter(
+        Order.id == association_order_dishes.c.order_id,
+        association_order_dishes.c.dish_id == dish_id
+    ).distinct()
+    return [restaurant_id for restaurant_id, in rows]
+
+# The page documents of restaurants, encoded by SQLite in one statement
+# (other databases build them in Python with _page_documents):
+# {"id", "name", "rating": {"average", "count"}, "categories": [{"id",
+# "description"}], "menu": [{"id", "name", "price", "sold_out"}]}
+PAGE_DOCUMENTS = """
+    SELECT r.id, json_object(
+        'id', r.id,
+        'name', r.name,
+        'rating', json_object('average', round(r.rating, 2), 'count', r.rating_count),
+        'categories', (SELECT json_group_array(json_object('id', c.id, 'description', c.description)) FROM (
+            SELECT category.id, category.description FROM association_restaurant_categories l
+            JOIN category ON category.id = l.category_id
+            WHERE l.restaurant_id = r.id ORDER BY category.id
+        ) c),
+        'menu', (SELECT json_group_array(json_object(
+            'id', d.id, 'name', d.name, 'price', d.price_cents / 100.0,
+            'sold_out', json(CASE WHEN d.sold_out THEN 'true' ELSE 'false' END)
+        )) FROM (
+            SELECT id, name, price_cents, sold_out FROM dish WHERE restaurant_id = r.id ORDER BY id
+        ) d)
+    ) AS document FROM restaurant r WHERE r.id IN :ids
+"""
+SELECT_PAGES = db.text(PAGE_DOCUMENTS).bindparams(db.bindparam("ids", expanding=True))
+SNAPSHOT_UPSERT = db.text(
+    "INSERT INTO restaurant_snapshot (restaurant_id, document, built_at, version) SELECT id, document, :now, 1 FROM (%s) WHERE 1 "
+    "ON CONFLICT (restaurant_id) DO UPDATE SET version = version + 1, document = excluded.document, built_at = excluded.built_at"
+    % PAGE_DOCUMENTS
+).bindparams(db.bindparam("ids", expanding=True))
+
+# Whether the database encodes page documents itself: SQLite's JSON
+# functions and upsert are not portable
+def _pages_in_sql():
+    return db.engine.dialect.name == "sqlite"
+
+# The documents PAGE_DOCUMENTS encodes, as {restaurant id: encoded JSON},
+# built in Python from three queries
+def _page_documents(restaurant_ids):
+    documents = {}
+    for id, name, rating, count in db.session.query(
+        Restaurant.id, Restaurant.name, Restaurant.rating, Restaurant.rating_count
+    ).filter(Restaurant.id.in_(restaurant_ids)):
+        documents[id] = {
+            "id": id, "name": name, "rating": {"average": round(rating, 2), "count": count}, "categories": [], "menu": []
+        }
+    link = association_restaurant_categories
+    for restaurant_id, id, description in db.session.query(link.c.restaurant_id, Category.id, Category.description).filter(
+        Category.id == link.c.category_id, link.c.restaurant_id.in_(restaurant_ids)
+    ).order_by(Category.id):
+        documents[restaurant_id]["categories"].append({"id": id, "description": description})
+    for restaurant_id, id, name, price_cents, sold_out in db.session.query(
+        Dish.restaurant_id, Dish.id, Dish.name, Dish.price_cents, Dish.sold_out
+    ).filter(Dish.restaurant_id.in_(restaurant_ids)).order_by(Dish.id):
+        documents[restaurant_id]["menu"].append({"id": id, "name": name, "price": price_cents / 100.0, "sold_out": sold_out})
+    return {id: json.dumps(document, separators=(",", ":")) for id, document in documents.items()}
+
+# Rewrites the page snapshots of the given restaurants inside the write's
+# own transaction, so a page never lags behind a committed menu change.
+# Only the touched restaurants are rebuilt, each from its own rows.
+def _rebuild_snapshots(*restaurant_ids):
+    db.session.flush()
+    now = time.time()
+    for start in range(0, len(restaurant_ids), YIELD_PER):
+        ids = list(restaurant_ids[start:start + YIELD_PER])
+        if _pages_in_sql():
+            db.session.execute(SNAPSHOT_UPSERT, {"ids": ids, "now": now})
+        else:
+            _write_snapshots(_page_documents(ids), now)
+
+def _write_snapshots(documents, now):
+    table = RestaurantSnapshot.__table__
+    existing = set(id for id, in db.session.query(table.c.restaurant_id).filter(table.c.restaurant_id.in_(list(documents))))
+    updates = [{"rid": id, "document": document} for id, document in documents.items() if id in existing]
+    inserts = [{"restaurant_id": id, "document": document, "built_at": now, "version": 1}
+        for id, document in documents.items() if id not in existing]
+    if updates:
+        db.session.execute(table.update().where(table.c.restaurant_id == db.bindparam("rid")).values(
+            document=db.bindparam("document"), built_at=now, version=table.c.version + 1
+        ), updates)
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+
+# Rows fetched per round trip when walking a whole table
+YIELD_PER = 500
+
+# Keyset page over a table ordered by id; iterating it streams rows in
+# YIELD_PER batches instead of materializing the whole result
+def _page(model, after=None, limit=None, fields=None, depth=None):
+    query = model.query.options(*model.serialize_options(fields, depth)).order_by(model.id)
+    if after is not None:
+        query = query.filter(model.id > after)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.yield_per(YIELD_PER)
+
+@read_only
+def get_all_users(after=None, limit=None, fields=None, depth=None):
+    return (_payload(u, fields, depth) for u in _page(User, after, limit, fields, depth))
+
+@read_only
+def get_user_by_id(user_id, fields=None, depth=None):
+    user = _get(User, user_id, fields, depth)
     if user is None:
         return None
-    return user.serialize()
+    return _payload(user, fields, depth)
+
+@read_only
+def get_users_by_ids(ids, fields=None, depth=None):
+    return _get_many(User, ids, fields, depth)
 
 def add_to_balance(user_id, amount):
-    user = User.query.filter_by(id=user_id).first()
-    if user is None:
+    if not ledger.record(user_id, to_cents(amount), ledger.TOP_UP):
+        db.session.rollback()
         return None
-    user.balance += amount
     db.session.commit()
-    return user.serialize()
+    return _get(User, user_id).serialize()
 
 def update_user(user_id, body):
     user = User.query.filter_by(id=user_id).first()
     if user is None:
         return None
     user.username = body.get("username", user.username)
-    user.balance = body.get("balance", user.balance)
+    # Recorded as the difference from the balance read above and added
+    # atomically, so a concurrent top-up is not overwritten
+    if "balance" in body and to_cents(body["balance"]) != user.balance_cents:
+        ledger.record(user_id, to_cents(body["balance"]) - user.balance_cents, ledger.ADJUSTMENT)
     user.password_digest = body.get("password_digest", user.password_digest)
     db.session.commit()
-    return user.serialize()
+    if "password_digest" in body:
+        auth.revoke(user.session_token)
+    return _get(User, user_id).serialize()
 
+# Deletes the user with their orders and reviews in set-based statements;
+# the pages of the restaurants they reviewed are rebuilt by jobs
 def delete_user(user_id):
-    user = User.query.filter_by(id=user_id).first()
+    user = _get(User, user_id)
     if user is None:
         return None
-    db.session.delete(user)
+    data = user.serialize()
+    session_token = user.session_token
+    reviewed = db.session.query(
+        Review.restaurant_id, db.func.sum(Review.rating), db.func.count(Review.id)
+    ).filter(Review.user_id == user_id).group_by(Review.restaurant_id).all()
+    orders = db.session.query(Order.restaurant_id, Order.driver_id, Order.delivered).filter(Order.user_id == user_id).all()
+    restaurant_ids = list(set(r for r, _, _ in reviewed) | set(o.restaurant_id for o in orders))
+    open_orders = [o.driver_id for o in orders if not o.delivered]
+    order_ids = db.select([Order.id]).where(Order.user_id == user_id)
+    link = association_order_dishes
+    db.session.execute(link.delete().where(link.c.order_id.in_(order_ids)))
+    db.session.execute(Order.__table__.delete().where(Order.user_id == user_id))
+    db.session.execute(Review.__table__.delete().where(Review.user_id == user_id))
+    db.session.execute(User.__table__.delete().where(User.id == user_id))
+    _bump(Restaurant, *restaurant_ids)
+    for restaurant_id, rating_sum, rating_count in reviewed:
+        update_rating_for_restaurant(restaurant_id, -rating_sum, -rating_count)
+    _queue_snapshot_rebuild(*[r for r, _, _ in reviewed])
     db.session.commit()
-    return user.serialize()
+    for driver_id in open_orders:
+        dispatch.dispatcher.adjust(driver_id, -1)
+    auth.revoke(session_token)
+    _invalidate(Restaurant, *restaurant_ids)
+    return data
+
+@read_only
+def get_all_restaurants(after=None, limit=None, fields=None, depth=None):
+    return (_payload(r, fields, depth) for r in _page(Restaurant, after, limit, fields, depth))
 
-def get_all_restaurants():
-    return [r.serialize() for r in Restaurant.query.all()]
+@read_only
+def get_restaurants_by_ids(ids, fields=None, depth=None):
+    return _get_many(Restaurant, ids, fields, depth)
 
 def create_restaurant(name):
     restaurant = Restaurant(
         name = name
     )
     db.session.add(restaurant)
+    db.session.flush()
+    _rebuild_snapshots(restaurant.id)
     db.session.commit()
     return restaurant.serialize()
 
-def get_restaurant_by_id(restaurant_id):
-    restaurant = Restaurant.query.filter_by(id=restaurant_id).first()
-    if restaurant is None:
-        return None
-    return restaurant.serialize()
+@read_only
+def get_restaurant_by_id(restaurant_id, fields=None, depth=None, version=None):
+    return _read_through(Restaurant, restaurant_id, fields, depth, version)
+
+# A restaurant's page as (version, encoded JSON) with a single primary key
+# read of its snapshot. A restaurant without one yet, e.g. in a database
+# that predates snapshots, gets its page built on the spot and a None
+# version. None if the restaurant does not exist.
+@read_only
+def get_restaurant_page(restaurant_id):
+    row = db.session.query(RestaurantSnapshot.version, RestaurantSnapshot.document).filter(
+        RestaurantSnapshot.restaurant_id == restaurant_id
+    ).first()
+    if row is not None:
+        return row.version, encoding.Fragment(row.document)
+    if not _pages_in_sql():
+        document = _page_documents([restaurant_id]).get(restaurant_id)
+        return None if document is None else (None, encoding.Fragment(document))
+    row = db.session.execute(SELECT_PAGES, {"ids": [restaurant_id]}).first()
+    return None if row is None else (None, encoding.Fragment(row[1]))
 
 def update_restaurant(restaurant_id, body):
     restaurant = Restaurant.query.filter_by(id=restaurant_id).first()
@@ -58,19 +307,50 @@ def update_restaurant(restaurant_id, body):
         return None
     name = body.get("name")
     restaurant.name = name
+    _bump(Restaurant, restaurant_id)
+    _rebuild_snapshots(restaurant_id)
     db.session.commit()
-    return restaurant.serialize()
+    _invalidate(Restaurant, restaurant_id)
+    return _get(Restaurant, restaurant_id).serialize()
 
+# Deletes the restaurant with its dishes, reviews and orders in set-based
+# statements. Other restaurants' orders holding its dishes lose them; their
+# totals are recomputed by jobs.
 def delete_restaurant(restaurant_id):
-    restaurant = Restaurant.query.filter_by(id=restaurant_id).first()
+    restaurant = _get(Restaurant, restaurant_id)
     if restaurant is None:
         return None
-    db.session.delete(restaurant)
+    data = restaurant.serialize()
+    dish_ids = [d.id for d in restaurant.menu]
+    open_orders = [o.driver_id for o in restaurant.orders if not o.delivered]
+    link = association_order_dishes
+    own_orders = db.select([Order.id]).where(Order.restaurant_id == restaurant_id)
+    menu = db.select([Dish.id]).where(Dish.restaurant_id == restaurant_id)
+    affected = db.session.query(Order.id, Order.restaurant_id).filter(
+        Order.id == link.c.order_id,
+        link.c.dish_id.in_(menu),
+        Order.restaurant_id != restaurant_id
+    ).distinct().all()
+    _bump(Order, *[order_id for order_id, _ in affected])
+    _queue_total_refresh(*[order_id for order_id, _ in affected])
+    db.session.execute(link.delete().where(db.or_(link.c.order_id.in_(own_orders), link.c.dish_id.in_(menu))))
+    db.session.execute(Order.__table__.delete().where(Order.restaurant_id == restaurant_id))
+    db.session.execute(Review.__table__.delete().where(Review.restaurant_id == restaurant_id))
+    db.session.execute(Dish.__table__.delete().where(Dish.restaurant_id == restaurant_id))
+    categories = association_restaurant_categories
+    db.session.execute(categories.delete().where(categories.c.restaurant_id == restaurant_id))
+    db.session.execute(RestaurantSnapshot.__table__.delete().where(RestaurantSnapshot.restaurant_id == restaurant_id))
+    db.session.execute(Restaurant.__table__.delete().where(Restaurant.id == restaurant_id))
     db.session.commit()
-    return restaurant.serialize()
+    for driver_id in open_orders:
+        dispatch.dispatcher.adjust(driver_id, -1)
+    _invalidate(Restaurant, restaurant_id, *set(r for _, r in affected))
+    _invalidate(Dish, *dish_ids)
+    return data
 
-def get_all_dishes():
-    return [d.serialize() for d in Dish.query.all()]
+@read_only
+def get_all_dishes(after=None, limit=None, fields=None, depth=None):
+    return (_payload(d, fields, depth) for d in _page(Dish, after, limit, fields, depth))
 
 def create_dish_for_restaurant(name, price, restaurant_id):
     restaurant = Restaurant.query.filter_by(id=restaurant_id).first()
@@ -83,14 +363,19 @@ def create_dish_for_restaurant(name, price, restaurant_id):
         restaurant_id = restaurant_id
     )
     db.session.add(dish)
+    _bump(Restaurant, restaurant_id)
+    _rebuild_snapshots(restaurant_id)
     db.session.commit()
+    _invalidate(Restaurant, restaurant_id)
     return dish.serialize()
 
-def get_dish_by_id(dish_id):
-    dish = Dish.query.filter_by(id=dish_id).first()
-    if dish is None:
-        return None
-    return dish.serialize()
+@read_only
+def get_dish_by_id(dish_id, fields=None, depth=None, version=None):
+    return _read_through(Dish, dish_id, fields, depth, version)
+
+@read_only
+def get_dishes_by_ids(ids, fields=None, depth=None):
+    return _get_many(Dish, ids, fields, depth)
 
 def update_dish(dish_id, body):
     dish = Dish.query.filter_by(id=dish_id).first()
@@ -99,28 +384,80 @@ def update_dish(dish_id, body):
     dish.name = body.get("name", dish.name)
     dish.price = body.get("price", dish.price)
     dish.sold_out = body.get("sold_out", dish.sold_out)
+    restaurant_ids = [dish.restaurant_id] + _restaurants_ordering(dish_id)
+    _bump(Dish, dish_id)
+    _bump(Restaurant, *restaurant_ids)
+    _bump_orders_containing(dish_id)
+    _rebuild_snapshots(dish.restaurant_id)
     db.session.commit()
+    _invalidate(Dish, dish_id)
+    _invalidate(Restaurant, *restaurant_ids)
     return dish.serialize()
 
 def delete_dish(dish_id):
     dish = Dish.query.filter_by(id=dish_id).first()
     if dish is None:
         return None
+    restaurant_ids = [dish.restaurant_id] + _restaurants_ordering(dish_id)
+    _bump(Restaurant, *restaurant_ids)
+    _bump_orders_containing(dish_id)
+    _queue_total_refresh(*[order_id for order_id, in db.session.query(association_order_dishes.c.order_id).filter(
+        association_order_dishes.c.dish_id == dish_id
+    )])
     db.session.delete(dish)
+    _rebuild_snapshots(dish.restaurant_id)
     db.session.commit()
+    _invalidate(Dish, dish_id)
+    _invalidate(Restaurant, *restaurant_ids)
     return dish.serialize()
 
-def get_orders_of_user(user_id):
-    user = User.query.filter_by(id=user_id).first()
-    if user is None:
-        return None
-    return [o.serialize() for o in user.orders]
-
-def create_order(date_time, user_id, restaurant_id, driver_id):
+# One page of at most limit orders matching the condition, newest first,
+# after the (date_time, id) cursor, optionally placed in [since, until) and
+# with the given delivered flag. Returns the page and the next cursor.
+def _order_history(condition, after=None, limit=20, since=None, until=None, delivered=None, fields=None, depth=None):
+    query = Order.query.options(*Order.serialize_options(fields, depth)).filter(condition)
+    if since is not None:
+        query = query.filter(Order.date_time >= since)
+    if until is not None:
+        query = query.filter(Order.date_time < until)
+    if delivered is not None:
+        query = query.filter(Order.delivered == delivered)
+    if after is not None:
+        date_time, order_id = after
+        query = query.filter(db.or_(
+            Order.date_time < date_time,
+            db.and_(Order.date_time == date_time, Order.id < order_id)
+        ))
+    orders = query.order_by(Order.date_time.desc(), Order.id.desc()).limit(limit).all()
+    next_cursor = None
+    if len(orders) == limit:
+        next_cursor = (orders[-1].date_time, orders[-1].id)
+    return [_payload(o, fields, depth) for o in orders], next_cursor
+
+@read_only
+def get_orders_of_user(user_id, after=None, limit=20, since=None, until=None, delivered=None, fields=None, depth=None):
+    if User.query.filter_by(id=user_id).count() == 0:
+        return None
+    return _order_history(Order.user_id == user_id, after, limit, since, until, delivered, fields, depth)
+
+@read_only
+def get_orders_of_driver(driver_id, after=None, limit=20, since=None, until=None, delivered=None, fields=None, depth=None):
+    if Driver.query.filter_by(id=driver_id).count() == 0:
+        return None
+    return _order_history(Order.driver_id == driver_id, after, limit, since, until, delivered, fields, depth)
+
+# Without a driver_id the order goes to the least-loaded driver, or waits in
+# the backlog (driver_id null) when there are no drivers
+def create_order(date_time, user_id, restaurant_id, driver_id=None):
     user = User.query.filter_by(id=user_id).first()
     restaurant = Restaurant.query.filter_by(id=restaurant_id).first()
     if user is None or restaurant is None:
         return None
+    chosen = driver_id is not None
+    if chosen and Driver.query.filter_by(id=driver_id).count() == 0:
+        return None
+    if not chosen:
+        driver_id, = dispatch.dispatcher.assign()
     order = Order(
         date_time = date_time,
         paid = False,
@@ -130,70 +467,217 @@ def create_order(date_time, user_id, restaurant_id, driver_id):
         driver_id = driver_id
     )
     db.session.add(order)
+    _bump(Restaurant, restaurant_id)
     db.session.commit()
+    if chosen:
+        dispatch.dispatcher.adjust(driver_id, 1)
+    _invalidate(Restaurant, restaurant_id)
     return order.serialize()
 
-def add_dish_to_order(order_id, body):
-    dish_id = body.get("dish_id")
-    dish = Dish.query.filter_by(id=dish_id).first()
-    if dish is None:
-        return None
+# Raised when a checkout cannot go through; code is the HTTP status to answer with
+class CheckoutError(Exception):
+    def __init__(self, message, code=400):
+        Exception.__init__(self, message)
+        self.code = code
+
+# Checks the dishes ({dish id: quantity}), debits the user and creates a
+# paid order with all of its dishes in a single transaction. Without a
+# driver_id the order is dispatched like in create_order.
+def checkout(date_time, user_id, restaurant_id, driver_id, quantities):
+    if Restaurant.query.filter_by(id=restaurant_id).count() == 0:
+        raise CheckoutError("Restaurant not found.", 404)
+    if driver_id is not None and Driver.query.filter_by(id=driver_id).count() == 0:
+        raise CheckoutError("Driver not found.", 404)
+    if not quantities:
+        raise CheckoutError("No dishes to order.")
+
+    dishes = Dish.query.filter(Dish.id.in_(quantities)).all()
+    if len(dishes) < len(quantities):
+        raise CheckoutError("Dish not found.", 404)
+    for dish in dishes:
+        if dish.restaurant_id != restaurant_id:
+            raise CheckoutError("Dish %d is not from this restaurant." % dish.id)
+        if dish.sold_out:
+            raise CheckoutError("Dish %d is sold out." % dish.id)
+    total_cents = sum(dish.price_cents * quantities[dish.id] for dish in dishes)
+
+    total = total_cents / 100.0
+    if not ledger.apply(user_id, -total_cents, minimum=0):
+        db.session.rollback()
+        if User.query.filter_by(id=user_id).count() == 0:
+            raise CheckoutError("User not found.", 404)
+        raise CheckoutError("Insufficient balance.")
+
+    chosen = driver_id is not None
+    if not chosen:
+        driver_id, = dispatch.dispatcher.assign()
+    order = Order(
+        date_time = date_time,
+        total = total,
+        paid = True,
+        delivered = False,
+        user_id = user_id,
+        restaurant_id = restaurant_id,
+        driver_id = driver_id
+    )
+    db.session.add(order)
+    db.session.flush()
+    db.session.execute(
+        association_order_dishes.insert(),
+        [{"order_id": order.id, "dish_id": dish_id, "quantity": quantity} for dish_id, quantity in quantities.items()]
+    )
+    ledger.append(user_id, -total_cents, ledger.CHECKOUT, order.id)
+    _bump(Restaurant, restaurant_id)
+    db.session.commit()
+    if chosen:
+        dispatch.dispatcher.adjust(driver_id, 1)
+    _invalidate(Restaurant, restaurant_id)
+    return _get(Order, order.id).serialize()
+
+# Adds (positive quantity) or removes (negative quantity) many dishes, given
+# as {dish id: quantity}, in one transaction. Additions move the order total
+# by their price; a batch that removes dishes re-sums the total from the
+# remaining rows instead, as a dish's price may have changed since it was
+# added.
+def update_order_dishes(order_id, changes):
     order = Order.query.filter_by(id=order_id).first()
     if order is None:
         return None
-    order.dishes.append(dish)
-    calculate_total(order_id)
+    prices = dict(db.session.query(Dish.id, Dish.price_cents).filter(Dish.id.in_(changes)))
+    if len(prices) < len(changes):
+        return None
+    quantities = dict(
+        db.session.query(association_order_dishes.c.dish_id, association_order_dishes.c.quantity)
+        .filter(association_order_dishes.c.order_id == order_id)
+    )
+
+    inserts, updates, deletes = [], [], []
+    delta, removed = 0, False
+    for dish_id, change in changes.items():
+        old = quantities.get(dish_id, 0)
+        new = max(old + change, 0)
+        delta += (new - old) * prices[dish_id]
+        removed = removed or new < old
+        row = {"o": order_id, "d": dish_id, "q": new}
+        if old == 0 and new > 0:
+            inserts.append(row)
+        elif old > 0 and new == 0:
+            deletes.append(row)
+        elif old != new:
+            updates.append(row)
+
+    table = association_order_dishes
+    match = db.and_(table.c.order_id == db.bindparam("o"), table.c.dish_id == db.bindparam("d"))
+    if inserts:
+        db.session.execute(table.insert().values(order_id=db.bindparam("o"), dish_id=db.bindparam("d"), quantity=db.bindparam("q")), inserts)
+    if updates:
+        db.session.execute(table.update().where(match).values(quantity=db.bindparam("q")), updates)
+    if deletes:
+        db.session.execute(table.delete().where(match), deletes)
+    if removed:
+        total = db.select([db.func.coalesce(db.func.sum(Dish.price_cents * table.c.quantity), 0)]).where(
+            db.and_(table.c.order_id == order_id, table.c.dish_id == Dish.id)
+        ).as_scalar()
+        Order.query.filter_by(id=order_id).update({Order.total_cents: total}, synchronize_session=False)
+    elif delta:
+        Order.query.filter_by(id=order_id).update({Order.total_cents: Order.total_cents + delta}, synchronize_session=False)
+    _bump(Order, order_id)
+    _bump(Restaurant, order.restaurant_id)
     db.session.commit()
-    return order.serialize()
+    _invalidate(Restaurant, order.restaurant_id)
+    return _get(Order, order_id).serialize()
 
+# Recomputes an order total from scratch, to repair one that drifted; also
+# run by jobs for orders that lost dishes
+@jobs.handler("order_total")
 def calculate_total(order_id):
     order = Order.query.filter_by(id=order_id).first()
     if order is None:
         return None
-    dishes = order.dishes
-    total = 0
-    for dish in dishes:
-        total = total + dish.price
-    order.total = total
+    total = db.session.query(
+        db.func.coalesce(db.func.sum(Dish.price_cents * association_order_dishes.c.quantity), 0)
+    ).filter(
+        association_order_dishes.c.order_id == order_id,
+        association_order_dishes.c.dish_id == Dish.id
+    ).scalar()
+    order.total_cents = total
+    _bump(Order, order_id)
+    _bump(Restaurant, order.restaurant_id)
     db.session.commit()
+    _invalidate(Restaurant, order.restaurant_id)
 
-def get_order_by_id(order_id):
-    order = Order.query.filter_by(id=order_id).first()
+@read_only
+def get_order_by_id(order_id, fields=None, depth=None):
+    order = _get(Order, order_id, fields, depth)
     if order is None:
         return None
-    return order.serialize()
+    return _payload(order, fields, depth)
+
+@read_only
+def get_orders_by_ids(ids, fields=None, depth=None):
+    return _get_many(Order, ids, fields, depth)
+
+# What order status events carry
+def _order_status(order_id, paid, delivered, driver_id, version):
+    return {"id": order_id, "paid": paid, "delivered": delivered, "driver_id": driver_id, "version": version}
+
+STATUS_COLUMNS = (Order.id, Order.paid, Order.delivered, Order.driver_id, Order.version)
+
+# An order's status alone, with nothing of its dishes loaded
+@read_only
+def get_order_status(order_id):
+    row = db.session.query(*STATUS_COLUMNS).filter(Order.id == order_id).first()
+    return None if row is None else _order_status(*row)
 
 def update_order(order_id, body):
     order = Order.query.filter_by(id=order_id).first()
     if order is None or order.delivered is True:
         return None
+    if body.get("driver_id") is not None and Driver.query.filter_by(id=body["driver_id"]).count() == 0:
+        return None
+    status = (order.paid, order.delivered, order.driver_id)
+    driver_id = order.driver_id
     order.driver_id = body.get("driver_id", order.driver_id)
     order.paid = body.get("paid", order.paid)
     order.delivered = body.get("delivered", order.delivered)
+    _bump(Order, order_id)
+    _bump(Restaurant, order.restaurant_id)
     db.session.commit()
-    return order.serialize()
+    if order.delivered or order.driver_id != driver_id:
+        dispatch.dispatcher.adjust(driver_id, -1)
+        if not order.delivered:
+            dispatch.dispatcher.adjust(order.driver_id, 1)
+    if (order.paid, order.delivered, order.driver_id) != status:
+        events.publish(_order_status(order.id, order.paid, order.delivered, order.driver_id, order.version))
+    _invalidate(Restaurant, order.restaurant_id)
+    return _get(Order, order_id).serialize()
 
 def delete_order(order_id):
-    order = Order.query.filter_by(id=order_id).first()
+    order = _get(Order, order_id)
     if order is None:
         return None
+    _bump(Restaurant, order.restaurant_id)
     db.session.delete(order)
     db.session.commit()
+    if not order.delivered:
+        dispatch.dispatcher.adjust(order.driver_id, -1)
+    _invalidate(Restaurant, order.restaurant_id)
     return order.serialize()
 
-def get_driver_by_id(driver_id):
-    driver = Driver.query.filter_by(id=driver_id).first()
+@read_only
+def get_driver_by_id(driver_id, fields=None, depth=None):
+    driver = _get(Driver, driver_id, fields, depth)
     if driver is None:
         return None
-    return driver.serialize()
+    return _payload(driver, fields, depth)
 
-def get_driver_of_order(order_id):
+@read_only
+def get_driver_of_order(order_id, fields=None, depth=None):
     order = Order.query.filter_by(id=order_id).first()
-    if order is None:
+    if order is None or order.driver_id is None:
         return None
-    driver_id = order.driver_id
-    driver = Driver.query.filter_by(id=driver_id).first()
-    return driver.serialize()
+    driver = _get(Driver, order.driver_id, fields, depth)
+    return _payload(driver, fields, depth)
 
 def create_driver(body):
     driver = Driver(
@@ -202,27 +686,75 @@ def create_driver(body):
     )
     db.session.add(driver)
     db.session.commit()
+    dispatch.dispatcher.adjust(driver.id, 0)
     return driver.serialize()
 
+# The driver's open orders lose their driver and join the backlog
+# Deletes the driver, leaving their orders without one: one UPDATE clears
+# them and bumps their versions, and their new status is published
 def delete_driver(driver_id):
-    driver = Driver.query.filter_by(id=driver_id).first()
+    driver = _get(Driver, driver_id)
     if driver is None:
         return None
-    db.session.delete(driver)
+    data = driver.serialize()
+    affected = db.session.query(Order.id, Order.restaurant_id).filter(Order.driver_id == driver_id).all()
+    restaurant_ids = list(set(restaurant_id for _, restaurant_id in affected))
+    orders = Order.__table__
+    db.session.execute(orders.update().where(orders.c.driver_id == driver_id).values(
+        driver_id=None, version=orders.c.version + 1
+    ))
+    _bump(Restaurant, *restaurant_ids)
+    db.session.execute(Driver.__table__.delete().where(Driver.id == driver_id))
     db.session.commit()
-    return driver.serialize()
+    dispatch.dispatcher.remove(driver_id)
+    _invalidate(Restaurant, *restaurant_ids)
+    _publish_statuses([order_id for order_id, _ in affected])
+    return data
+
+# Publishes the current status of the given orders, read YIELD_PER at a time
+def _publish_statuses(order_ids):
+    for start in range(0, len(order_ids), YIELD_PER):
+        events.publish(*[_order_status(*row) for row in db.session.query(*STATUS_COLUMNS).filter(
+            Order.id.in_(order_ids[start:start + YIELD_PER])
+        )])
+
+# Gives undelivered orders without a driver, oldest first and at most limit
+# of them, to the least-loaded drivers, with one executemany UPDATE. Returns
+# how many orders got a driver.
+def dispatch_backlog(limit=None):
+    query = db.session.query(Order.id).filter(Order.driver_id.is_(None), Order.delivered == False).order_by(Order.id)
+    if limit is not None:
+        query = query.limit(limit)
+    order_ids = [order_id for order_id, in query]
+    rows = [
+        {"oid": order_id, "did": driver_id}
+        for order_id, driver_id in zip(order_ids, dispatch.dispatcher.assign(len(order_ids)))
+        if driver_id is not None
+    ]
+    if rows:
+        table = Order.__table__
+        db.session.execute(table.update().where(table.c.id == db.bindparam("oid")).values(
+            driver_id=db.bindparam("did"), version=table.c.version + 1
+        ), rows)
+    db.session.commit()
+    _publish_statuses([row["oid"] for row in rows])
+    return len(rows)
 
-def get_reviews_by_user(user_id):
+@read_only
+def get_reviews_by_user(user_id, fields=None):
     user = User.query.filter_by(id=user_id).first()
     if user is None:
         return None
-    return [r.serialize() for o in user.reviews_posted]
+    reviews = Review.query.options(*Review.serialize_options(fields)).filter_by(user_id=user_id)
+    return [_payload(r, fields) for r in reviews]
 
-def get_reviews_of_restaurant(restaurant_id):
+@read_only
+def get_reviews_of_restaurant(restaurant_id, fields=None):
     restaurant = Restaurant.query.filter_by(id=restaurant_id).first()
     if restaurant is None:
         return None
-    return [r.serialize() for r in restaurant.reviews]
+    reviews = Review.query.options(*Review.serialize_options(fields)).filter_by(restaurant_id=restaurant_id)
+    return [_payload(r, fields) for r in reviews]
 
 def create_review_for_restaurant(restaurant_id, body):
     user_id = body.get("user_id")
@@ -236,53 +768,109 @@ def create_review_for_restaurant(restaurant_id, body):
         user_id = user_id,
         restaurant_id = restaurant_id
     )
-    update_rating_for_restaurant(restaurant_id, body.get("rating"), len(restaurant.reviews))
     db.session.add(review)
+    update_rating_for_restaurant(restaurant_id, review.rating, 1)
+    _queue_snapshot_rebuild(restaurant_id)
     db.session.commit()
-    
+    _invalidate(Restaurant, restaurant_id)
     return review.serialize()
 
-def update_rating_for_restaurant(restaurant_id, new_rating, num_reviews):
-    restaurant = Restaurant.query.filter_by(id=restaurant_id).first()
-    if restaurant is None:
-        return None
-    curr_rating = restaurant.rating
-    rating = (curr_rating*num_reviews + new_rating)/(num_reviews+1)
-    restaurant.rating = rating
+# Moves a restaurant's rating aggregates (and its version, as its reviews
+# changed) with one atomic UPDATE, in the same transaction as the review
+# write that caused it
+def update_rating_for_restaurant(restaurant_id, sum_delta, count_delta):
+    rating_sum = Restaurant.rating_sum + sum_delta
+    rating_count = Restaurant.rating_count + count_delta
+    Restaurant.query.filter_by(id=restaurant_id).update({
+        Restaurant.rating_sum: rating_sum,
+        Restaurant.rating_count: rating_count,
+        Restaurant.rating: db.case([(rating_count > 0, db.cast(rating_sum, db.Float) / rating_count)], else_=0),
+        Restaurant.version: Restaurant.version + 1,
+    }, synchronize_session=False)
+
+# Rebuilds a restaurant's page snapshot after its rating moved. Review
+# writes queue it as a job rather than running it, and a burst of reviews
+# for one restaurant (one pending job per restaurant) is folded into a
+# single rebuild.
+@jobs.handler("restaurant_snapshot")
+def refresh_snapshot(restaurant_id):
+    _rebuild_snapshots(restaurant_id)
     db.session.commit()
 
-def get_review_by_id(review_id):
-    review = Review.query.filter_by(id=review_id).first()
+def _queue_snapshot_rebuild(*restaurant_ids):
+    jobs.enqueue("restaurant_snapshot", [{"restaurant_id": id} for id in restaurant_ids], dedupe_on="restaurant_id")
+
+def _queue_total_refresh(*order_ids):
+    jobs.enqueue("order_total", [{"order_id": id} for id in order_ids], dedupe_on="order_id")
+
+# Rebuilds every restaurant's rating aggregates from the review table, e.g.
+# after reviews were edited outside the DAO
+def recompute_ratings():
+    totals = {
+        restaurant_id: (rating_sum, rating_count)
+        for restaurant_id, rating_sum, rating_count in db.session.query(
+            Review.restaurant_id, db.func.sum(Review.rating), db.func.count(Review.id)
+        ).group_by(Review.restaurant_id)
+    }
+    rows = []
+    for restaurant_id, rating_sum, rating_count in db.session.query(Restaurant.id, Restaurant.rating_sum, Restaurant.rating_count):
+        expected = totals.get(restaurant_id, (0, 0))
+        if (rating_sum, rating_count) != expected:
+            rows.append({
+                "rid": restaurant_id,
+                "s": expected[0],
+                "n": expected[1],
+                "r": float(expected[0]) / expected[1] if expected[1] else 0,
+            })
+    if rows:
+        table = Restaurant.__table__
+        db.session.execute(
+            table.update().where(table.c.id == db.bindparam("rid")).values(
+                rating_sum=db.bindparam("s"), rating_count=db.bindparam("n"), rating=db.bindparam("r"),
+                version=table.c.version + 1
+            ),
+            rows
+        )
+        _rebuild_snapshots(*[row["rid"] for row in rows])
+    db.session.commit()
+    _invalidate(Restaurant, *[row["rid"] for row in rows])
+    return len(rows)
+
+@read_only
+def get_review_by_id(review_id, fields=None):
+    review = _get(Review, review_id, fields)
     if review is None:
         return None
-    return review.serialize()
+    return _payload(review, fields)
 
 def update_review(review_id, body):
     review = Review.query.filter_by(id=review_id).first()
     if review is None:
         return None
-    restaurant = Restaurant.query.filter_by(id=review.restaurant_id).first()
-    num_reviews = len(restaurant.reviews)
-    restaurant.rating = (restaurant.rating*num_reviews-review.rating)/(num_reviews-1)
+    old_rating = review.rating
     review.rating = body.get("rating", review.rating)
     review.content = body.get("content", review.content)
-    update_rating_for_restaurant(review.restaurant_id, review.rating, num_reviews-1)
+    update_rating_for_restaurant(review.restaurant_id, review.rating - old_rating, 0)
+    if review.rating != old_rating:
+        _queue_snapshot_rebuild(review.restaurant_id)
     db.session.commit()
+    _invalidate(Restaurant, review.restaurant_id)
     return review.serialize()
 
 def delete_review(review_id):
     review = Review.query.filter_by(id=review_id).first()
     if review is None:
         return None
-    restaurant = Restaurant.query.filter_by(id=review.restaurant_id).first()
-    num_reviews = len(restaurant.reviews)
-    restaurant.rating = (restaurant.rating*num_reviews-review.rating)/(num_reviews-1)
     db.session.delete(review)
+    update_rating_for_restaurant(review.restaurant_id, -review.rating, -1)
+    _queue_snapshot_rebuild(review.restaurant_id)
     db.session.commit()
+    _invalidate(Restaurant, review.restaurant_id)
     return review.serialize()
 
-def get_all_categories():
-    return [c.serialize() for c in Category.query.all()]
+@read_only
+def get_all_categories(after=None, limit=None, fields=None, depth=None):
+    return (_payload(c, fields, depth) for c in _page(Category, after, limit, fields, depth))
 
 def create_category(body):
     category = Category(
@@ -292,11 +880,34 @@ def create_category(body):
     db.session.commit()
     return category.serialize()
 
-def get_category_by_id(category_id):
-    category = Category.query.filter_by(id=category_id).first()
-    if category is None:
-        return None
-    return category.serialize()
+@read_only
+def get_category_by_id(category_id, fields=None):
+    return _read_through(Category, category_id, fields)
+
+# Restaurants of a category, best rated first, as one page of at most limit
+# rows after the (rating, id) cursor. Returns the page and the next cursor.
+# The link table's copy of the rating and its (category_id, rating,
+# restaurant_id) index give the rows in order without sorting them.
+@read_only
+def get_restaurants_in_category(category_id, after=None, limit=20, fields=None, depth=None):
+    if Category.query.filter_by(id=category_id).count() == 0:
+        return None
+    link = association_restaurant_categories
+    query = Restaurant.query.options(*Restaurant.serialize_options(fields, depth)).filter(
+        link.c.category_id == category_id,
+        link.c.restaurant_id == Restaurant.id
+    ).order_by(link.c.rating.desc(), link.c.restaurant_id.desc())
+    if after is not None:
+        rating, restaurant_id = after
+        query = query.filter(db.or_(
+            link.c.rating < rating,
+            db.and_(link.c.rating == rating, link.c.restaurant_id < restaurant_id)
+        ))
+    restaurants = query.limit(limit).all()
+    next_cursor = None
+    if len(restaurants) == limit:
+        next_cursor = (restaurants[-1].rating, restaurants[-1].id)
+    return [_payload(r, fields, depth) for r in restaurants], next_cursor
 
 def add_restaurant_to_category(category_id, body):
     category = Category.query.filter_by(id=category_id).first()
@@ -306,14 +917,99 @@ def add_restaurant_to_category(category_id, body):
     restaurant = Restaurant.query.filter_by(id=restaurant_id).first()
     if restaurant is None:
         return None
-    category.restaurants.append(restaurant)
+    link = association_restaurant_categories
+    linked = db.session.query(link).filter(
+        link.c.category_id == category_id,
+        link.c.restaurant_id == restaurant_id
+    ).count()
+    if not linked:
+        db.session.execute(link.insert().values(category_id=category_id, restaurant_id=restaurant_id))
+        _bump(Restaurant, restaurant_id)
+        _rebuild_snapshots(restaurant_id)
     db.session.commit()
+    _invalidate(Restaurant, restaurant_id)
     return category.serialize()
 
 def delete_category(category_id):
     category = Category.query.filter_by(id=category_id).first()
     if category is None:
         return None
+    restaurant_ids = [r.id for r in category.restaurants]
+    _bump(Restaurant, *restaurant_ids)
     db.session.delete(category)
+    _rebuild_snapshots(*restaurant_ids)
     db.session.commit()
+    _invalidate(Category, category_id)
+    _invalidate(Restaurant, *restaurant_ids)
     return category.serialize()
+
+# Turns free text into an FTS5 query matching every word, the last one as a
+# prefix, so user input can never be a syntax error
+def _match_query(text):
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    return " ".join('"%s"' % word for word in words) + "*"
+
+# Ranks dishes, restaurants and categories matching the text by BM25, with
+# the restaurant rating (the dish's restaurant for dishes) weighted by boost
+@read_only
+def search(text, kinds=None, include_sold_out=True, boost=0, limit=20, offset=0):
+    match = _match_query(text)
+    if match is None:
+        return []
+    conditions = ["search_index MATCH :match"]
+    if kinds:
+        conditions.append("s.rowid %% 4 IN (%s)" % ", ".join(str(SEARCH_KINDS[kind]) for kind in kinds))
+    if not include_sold_out:
+        conditions.append("(d.sold_out IS NULL OR d.sold_out = 0)")
+    rows = db.session.execute("""
+        SELECT s.rowid %% 4, s.rowid / 4, s.name, r.id, r.rating,
+            bm25(search_index) - :boost * COALESCE(r.rating, 0) AS score
+        FROM search_index s
+        LEFT JOIN dish d ON s.rowid %% 4 = 1 AND d.id = s.rowid / 4
+        LEFT JOIN restaurant r ON r.id = CASE s.rowid %% 4 WHEN 1 THEN d.restaurant_id WHEN 2 THEN s.rowid / 4 END
+        WHERE %s
+        ORDER BY score
+        LIMIT :limit OFFSET :offset
+    """ % " AND ".join(conditions), {"match": match, "boost": boost, "limit": limit, "offset": offset})
+    names = dict((code, kind) for kind, code in SEARCH_KINDS.items())
+    return [
+        {
+            "type": names[kind],
+            "id": ref_id,
+            "name": name,
+            "restaurant_id": restaurant_id,
+            "rating": rating,
+            "score": -score,
+        }
+        for kind, ref_id, name, restaurant_id, rating, score in rows
+    ]
+
+# Refills the search index from the source tables, e.g. for a database that
+# predates it
+def rebuild_search_index():
+    db.session.execute("DELETE FROM search_index")
+    for table, column in SEARCH_SOURCES:
+        db.session.execute("INSERT INTO search_index (rowid, name) SELECT id * 4 + %d, %s FROM %s" % (
+            SEARCH_KINDS[table], column, table
+        ))
+    db.session.commit()
+
+# Rows whose foreign keys point at missing rows, as {(table, parent table):
+# [rowid, ...]}. SQLite only checks foreign keys on writes made with them
+# on, so a database written before engine.py turned them on may hold some,
+# and writes to those rows then fail.
+def foreign_key_violations():
+    violations = {}
+    for table, rowid, parent, _ in db.session.execute("PRAGMA foreign_key_check"):
+        violations.setdefault((table, parent), []).append(rowid)
+    return violations
+
+# Rebuilds every restaurant's page snapshot, e.g. for a database that
+# predates them or rows written outside the DAO. Returns how many.
+def rebuild_snapshots():
+    restaurant_ids = [id for id, in db.session.query(Restaurant.id)]
+    _rebuild_snapshots(*restaurant_ids)
+    db.session.commit()
+    return len(restaurant_ids)
@@ -1,59 +1,170 @@
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
 import datetime
 import hashlib
 import os
-import bcrypt
+import hashing
+from engine import Database
 
-db = SQLAlchemy()
+db = Database()
+
+# Money is stored as integer cents and exposed as dollars
+def to_cents(amount):
+    return int(round(amount * 100))
+
+class Serializable(object):
+    # Keys emitted by serialize(), in order. Names that are relationships are
+    # serialized recursively, and serialize_options() eager loads them.
+    serialize_fields = ()
+    # Fields computed from a differently named column, e.g. {"price": "price_cents"}
+    serialize_columns = {}
+
+    # A projection is a fields tree ({"name": None, "menu": {"price": None}},
+    # None meaning every field) plus a depth limiting how many levels of
+    # relationships are expanded (None meaning all of them). The id is
+    # always kept so rows stay addressable.
+    @classmethod
+    def _projected_fields(cls, fields):
+        if fields is None:
+            return cls.serialize_fields
+        return [name for name in cls.serialize_fields if name == "id" or name in fields]
+
+    def serialize(self, fields=None, depth=None):
+        relationships = self.__mapper__.relationships
+        data = {}
+        for name in self._projected_fields(fields):
+            if name not in relationships:
+                data[name] = getattr(self, name)
+            elif depth is None or depth > 0:
+                subfields = None if fields is None else fields[name]
+                subdepth = None if depth is None else depth - 1
+                data[name] = [v.serialize(subfields, subdepth) for v in getattr(self, name)]
+        return data
+
+    # Loader options that fetch exactly the columns and relationships a
+    # projection serializes, with one batched SELECT per relationship
+    # however many rows are returned
+    @classmethod
+    def serialize_options(cls, fields=None, depth=None, parent=None):
+        relationships = cls.__mapper__.relationships
+        names = cls._projected_fields(fields)
+        options = []
+        if fields is not None:
+            columns = [cls.serialize_columns.get(name, name) for name in names if name not in relationships]
+            options.append(db.load_only(*columns) if parent is None else parent.load_only(*columns))
+        if depth is not None and depth < 1:
+            return options
+        for name in names:
+            if name not in relationships:
+                continue
+            attr = getattr(cls, name)
+            loader = db.selectinload(attr) if parent is None else parent.selectinload(attr)
+            options.append(loader)
+            subfields = None if fields is None else fields[name]
+            subdepth = None if depth is None else depth - 1
+            options.extend(relationships[name].mapper.class_.serialize_options(subfields, subdepth, loader))
+        return options
 
 association_order_dishes = db.Table(
     "association_order_dishes",
     db.Model.metadata,
     db.Column("order_id", db.Integer, db.ForeignKey("order.id")),
-    db.Column("dish_id", db.Integer, db.ForeignKey("dish.id"))
+    db.Column("dish_id", db.Integer, db.ForeignKey("dish.id")),
+    db.Column("quantity", db.Integer, nullable=False, server_default="1"),
+    db.UniqueConstraint("order_id", "dish_id"),
+    # Finds the orders holding a dish, whose versions a dish edit bumps
+    db.Index("ix_order_dishes_dish", "dish_id", "order_id")
 )
 
 association_restaurant_categories = db.Table(
     "association_restaurant_categories",
     db.Model.metadata,
     db.Column("restaurant_id", db.Integer, db.ForeignKey("restaurant.id")),
-    db.Column("category_id", db.Integer, db.ForeignKey("category.id"))
+    db.Column("category_id", db.Integer, db.ForeignKey("category.id")),
+    # A copy of the restaurant's rating, kept in sync by the triggers below,
+    # so a category's restaurants are read best rated first from the index
+    db.Column("rating", db.Float, nullable=False, server_default="0"),
+    db.Index("ix_restaurant_categories_category", "category_id", "restaurant_id", unique=True),
+    db.Index("ix_restaurant_categories_rating", "category_id", "rating", "restaurant_id"),
+    db.Index("ix_restaurant_categories_restaurant", "restaurant_id")
 )
 
+for statement in [
+    """CREATE TRIGGER IF NOT EXISTS restaurant_categories_rating_insert
+    AFTER INSERT ON association_restaurant_categories BEGIN
+        UPDATE association_restaurant_categories SET rating = (SELECT rating FROM restaurant WHERE id = new.restaurant_id)
+        WHERE category_id = new.category_id AND restaurant_id = new.restaurant_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS restaurant_categories_rating_update
+    AFTER UPDATE OF rating ON restaurant WHEN new.rating IS NOT old.rating BEGIN
+        UPDATE association_restaurant_categories SET rating = new.rating WHERE restaurant_id = new.id;
+    END""",
+]:
+    # On the metadata rather than the table, so create_all adds them to tables
+    # that predate them
+    event.listen(db.Model.metadata, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+
+
+# Orders a user or driver embeds, newest first; the rest are paged through
+# /user/<id>/orders/ and /driver/<id>/orders/ from their "orders_next" cursor
+EMBEDDED_ORDERS = 20
+
+# Join condition of the newest EMBEDDED_ORDERS orders whose column (user_id
+# or driver_id) is the owner's id. The limit is per owner, so loading the
+# orders of a page of owners stays one query.
+def _newest_orders(owner, column):
+    newer = db.aliased(Order)
+    return db.and_(getattr(Order, column) == owner.id, Order.id.in_(
+        db.select([newer.id]).where(getattr(newer, column) == getattr(Order, column))
+        .order_by(newer.date_time.desc(), newer.id.desc()).limit(EMBEDDED_ORDERS)
+    ))
+
+# The history cursor of the last embedded order when the list is full, as
+# history pages give it when they are
+def _orders_next(orders):
+    if len(orders) < EMBEDDED_ORDERS:
+        return None
+    return "%s:%d" % (orders[-1].date_time, orders[-1].id)
 
-class User(db.Model):
+class User(Serializable, db.Model):
     __tablename__ = 'user'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     username = db.Column(db.String, nullable=False)
-    balance = db.Column(db.Float, nullable=False)
+    # Changed only through ledger.py, which records every change
+    balance_cents = db.Column(db.Integer, nullable=False)
     email = db.Column(db.String, nullable=False, unique=True)
     password_digest = db.Column(db.String, nullable=False)
-    orders = db.relationship("Order")
+    orders = db.relationship(
+        "Order", primaryjoin=lambda: _newest_orders(User, "user_id"), order_by=lambda: [Order.date_time.desc(), Order.id.desc()], viewonly=True
+    )
     reviews_posted = db.relationship("Review")
 
     session_token = db.Column(db.String, nullable=False, unique=True)
     session_expiration = db.Column(db.DateTime, nullable=False)
     update_token = db.Column(db.String, nullable=False, unique=True)
+    serialize_fields = ("id", "name", "username", "balance", "email", "orders", "orders_next", "reviews_posted")
+    # orders_next is computed from the orders, which are loaded by id
+    serialize_columns = {"balance": "balance_cents", "orders_next": "id"}
 
     def __init__(self, **kwargs):
         self.name = kwargs.get("name", "")
         self.username = kwargs.get("username", "")
         self.balance = kwargs.get("balance", 0)
         self.email = kwargs.get("email")
-        self.password_digest = bcrypt.hashpw(kwargs.get("password").encode("utf8"), bcrypt.gensalt(rounds=13))
+        self.password_digest = kwargs.get("password_digest")
         self.renew_session()
 
-    def serialize(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "username": self.username,
-            "balance": self.balance,
-            "email": self.email,
-            "orders": [o.serialize() for o in self.orders],
-            "reviews_posted": [r.serialize() for r in self.reviews_posted],
-        }
+    @property
+    def balance(self):
+        return self.balance_cents / 100.0
+
+    @balance.setter
+    def balance(self, value):
+        self.balance_cents = to_cents(value)
+
+    @property
+    def orders_next(self):
+        return _orders_next(self.orders)
 
     # Used to randomly generate session/update tokens
     def _urlsafe_base_64(self):
@@ -65,8 +176,9 @@ class User(db.Model):
         self.session_expiration = datetime.datetime.now() + datetime.timedelta(days=1)
         self.update_token = self._urlsafe_base_64()
 
+    # Runs on the hashing pool, so it can raise hashing.PoolFull
     def verify_password(self, password):
-        return bcrypt.checkpw(password.encode("utf8"), self.password_digest)
+        return hashing.check_password(password, self.password_digest)
 
     # Checks if session token is valid and hasn't expired
     def verify_session_token(self, session_token):
@@ -75,39 +187,41 @@ class User(db.Model):
     def verify_update_token(self, update_token):
         return update_token == self.update_token
 
-class Restaurant(db.Model):
+class Restaurant(Serializable, db.Model):
     __tablename__ = "restaurant"
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
-    rating = db.Column(db.Float, nullable=False)
+    rating = db.Column(db.Float, nullable=False, index=True)
+    # Running aggregates of the restaurant's reviews; rating is their average
+    rating_sum = db.Column(db.Integer, nullable=False)
+    rating_count = db.Column(db.Integer, nullable=False)
+    # Bumped by every DAO write that changes what the row serializes to;
+    # ETags are derived from it
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
     categories = db.relationship("Category", secondary=association_restaurant_categories, back_populates="restaurants")
     menu = db.relationship("Dish", cascade="delete")
     reviews = db.relationship("Review", cascade="delete")
     orders = db.relationship("Order")
+    serialize_fields = ("id", "name", "rating", "categories", "menu", "reviews", "orders")
 
     def __init__(self, **kwargs):
         self.name = kwargs.get("name", "")
         self.rating = kwargs.get("rating", 0)
-    
-    def serialize(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "rating": self.rating,
-            "categories": [c.serialize() for c in self.categories],
-            "menu": [m.serialize() for m in self.menu],
-            "reviews": [r.serialize() for r in self.reviews],
-            "orders": [o.serialize() for o in self.orders],
-        }
-
-class Dish(db.Model):
+        self.rating_sum = kwargs.get("rating_sum", 0)
+        self.rating_count = kwargs.get("rating_count", 0)
+
+class Dish(Serializable, db.Model):
     __tablename__ = "dish"
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
-    price = db.Column(db.Float, nullable=False)
+    price_cents = db.Column(db.Integer, nullable=False)
     sold_out = db.Column(db.Boolean, nullable=False)
-    restaurant_id = db.Column(db.Integer, db.ForeignKey("restaurant.id"), nullable=False)
+    restaurant_id = db.Column(db.Integer, db.ForeignKey("restaurant.id"), nullable=False, index=True)
     orders = db.relationship("Order", secondary=association_order_dishes, back_populates="dishes")
+    # See Restaurant.version
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    serialize_fields = ("id", "name", "price", "sold_out")
+    serialize_columns = {"price": "price_cents"}
 
     def __init__(self, **kwargs):
         self.name = kwargs.get("name", "")
@@ -115,25 +229,36 @@ class Dish(db.Model):
         self.sold_out = kwargs.get("sold_out", False)
         self.restaurant_id = kwargs.get("restaurant_id")
 
-    def serialize(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "price": self.price,
-            "sold_out": self.sold_out,
-        }
+    @property
+    def price(self):
+        return self.price_cents / 100.0
+
+    @price.setter
+    def price(self, value):
+        self.price_cents = to_cents(value)
 
-class Order(db.Model):
+class Order(Serializable, db.Model):
     __tablename__ = "order"
     id = db.Column(db.Integer, primary_key=True)
     date_time = db.Column(db.Integer, nullable=False)
     dishes = db.relationship("Dish", secondary=association_order_dishes, back_populates="orders")
-    total = db.Column(db.Float, nullable=False)
+    items = db.relationship("OrderItem", viewonly=True)
+    total_cents = db.Column(db.Integer, nullable=False)
     paid = db.Column(db.Boolean, nullable=False)
     delivered = db.Column(db.Boolean, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    restaurant_id = db.Column(db.Integer, db.ForeignKey("restaurant.id"), nullable=False)
-    driver_id = db.Column(db.Integer, db.ForeignKey("driver.id"), nullable=False)
+    restaurant_id = db.Column(db.Integer, db.ForeignKey("restaurant.id"), nullable=False, index=True)
+    # Null while the order waits for a driver
+    driver_id = db.Column(db.Integer, db.ForeignKey("driver.id"))
+    # See Restaurant.version
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    serialize_fields = ("id", "date_time", "dishes", "items", "total", "paid", "delivered")
+    serialize_columns = {"total": "total_cents"}
+    __table_args__ = (
+        # Order history pages, newest first, of a user and of a driver
+        db.Index("ix_order_user_date_time", "user_id", "date_time"),
+        db.Index("ix_order_driver_delivered", "driver_id", "delivered"),
+    )
 
     def __init__(self, **kwargs):
         self.date_time = kwargs.get("date_time")
@@ -144,42 +269,128 @@ class Order(db.Model):
         self.restaurant_id = kwargs.get("restaurant_id")
         self.driver_id = kwargs.get("driver_id")
 
-    def serialize(self):
-        return {
-            "id": self.id,
-            "date_time": self.date_time,
-            "dishes": [d.serialize() for d in self.dishes],
-            "total": self.total,
-            "paid": self.paid,
-            "delivered": self.delivered,
-        }
-
-class Driver(db.Model):
+    # Kept up to date incrementally by the DAO as dishes are added or removed
+    @property
+    def total(self):
+        return self.total_cents / 100.0
+
+    @total.setter
+    def total(self, value):
+        self.total_cents = to_cents(value)
+
+# Delivered orders moved out of the order table by archive.py; items holds
+# the order's [{"dish_id", "quantity"}] as JSON
+class OrderArchive(db.Model):
+    __tablename__ = "order_archive"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    date_time = db.Column(db.Integer, nullable=False)
+    total_cents = db.Column(db.Integer, nullable=False)
+    paid = db.Column(db.Boolean, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    restaurant_id = db.Column(db.Integer, nullable=False)
+    driver_id = db.Column(db.Integer)
+    items = db.Column(db.String, nullable=False)
+    archived_at = db.Column(db.Float, nullable=False)
+
+# A restaurant's page (name, rating summary, categories and menu) as
+# encoded JSON, rebuilt by the DAO in the transaction of every write that
+# changes it. version counts rebuilds and is the page's ETag.
+class RestaurantSnapshot(db.Model):
+    __tablename__ = "restaurant_snapshot"
+    restaurant_id = db.Column(db.Integer, db.ForeignKey("restaurant.id"), primary_key=True, autoincrement=False)
+    version = db.Column(db.Integer, nullable=False)
+    document = db.Column(db.String, nullable=False)
+    built_at = db.Column(db.Float, nullable=False)
+
+# Append-only record of every change to a user's balance, written by
+# ledger.py in the transaction of the change, so a user's entries always
+# sum to their balance. Entries outlive their user for auditing.
+class BalanceEntry(db.Model):
+    __tablename__ = "balance_ledger"
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    amount_cents = db.Column(db.Integer, nullable=False)
+    # "opening", "top_up", "adjustment" or "checkout"
+    kind = db.Column(db.String, nullable=False)
+    order_id = db.Column(db.Integer)
+    created_at = db.Column(db.Float, nullable=False)
+    __table_args__ = (
+        # Finds a user's opening entry and sums their entries from the index alone
+        db.Index("ix_balance_ledger_user", "user_id", "kind", "amount_cents"),
+    )
+
+# Order status changes, shared between processes by events.DatabaseBroker
+class OrderEvent(db.Model):
+    __tablename__ = "order_event"
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, nullable=False)
+    payload = db.Column(db.String, nullable=False)
+    created_at = db.Column(db.Float, nullable=False, index=True)
+
+# Session tokens revoked before they expire, read by every process through
+# auth.py. Ids are never reused, so readers can tail the table by id while
+# expired rows are deleted.
+class RevokedSession(db.Model):
+    __tablename__ = "revoked_session"
+    id = db.Column(db.Integer, primary_key=True)
+    token = db.Column(db.String, nullable=False)
+    expires_at = db.Column(db.Float, nullable=False, index=True)
+    __table_args__ = {"sqlite_autoincrement": True}
+
+# Derived work queued by the DAO and run by jobs.py workers. At most one
+# pending job exists per kind and key.
+class Job(db.Model):
+    __tablename__ = "job"
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String, nullable=False)
+    key = db.Column(db.String)
+    payload = db.Column(db.String, nullable=False)
+    status = db.Column(db.String, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False)
+    error = db.Column(db.String)
+    created_at = db.Column(db.Float, nullable=False)
+    run_at = db.Column(db.Float, nullable=False)
+    started_at = db.Column(db.Float)
+    finished_at = db.Column(db.Float)
+    __table_args__ = (
+        db.Index("ix_job_pending_key", "kind", "key", unique=True,
+            sqlite_where=db.text("status = 'pending'"), postgresql_where=db.text("status = 'pending'")),
+        db.Index("ix_job_status_run_at", "status", "run_at"),
+    )
+
+# How many of a dish an order holds: one association_order_dishes row
+class OrderItem(Serializable, db.Model):
+    __table__ = association_order_dishes
+    __mapper_args__ = {"primary_key": [association_order_dishes.c.order_id, association_order_dishes.c.dish_id]}
+    serialize_fields = ("dish_id", "quantity")
+
+class Driver(Serializable, db.Model):
     __tablename__ = "driver"
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     license_plate_number = db.Column(db.String, nullable=False)
-    orders = db.relationship("Order")
+    orders = db.relationship(
+        "Order", primaryjoin=lambda: _newest_orders(Driver, "driver_id"), order_by=lambda: [Order.date_time.desc(), Order.id.desc()], viewonly=True
+    )
+    serialize_fields = ("id", "name", "license_plate_number", "orders", "orders_next")
+    serialize_columns = {"orders_next": "id"}
 
     def __init__(self, **kwargs):
         self.name = kwargs.get("name", "")
         self.license_plate_number = kwargs.get("license_plate_number", "")
-        
-    def serialize(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "license_plate_number": self.license_plate_number,
-            "orders": [o.serialize() for o in self.orders],
-        }
-
-class Review(db.Model):
+
+    @property
+    def orders_next(self):
+        return _orders_next(self.orders)
+
+class Review(Serializable, db.Model):
     __tablename__ = "review"
     id = db.Column(db.Integer, primary_key=True)
     rating = db.Column(db.Integer, nullable=False)
     content = db.Column(db.String, nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    restaurant_id = db.Column(db.Integer, db.ForeignKey("restaurant.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False, index=True)
+    restaurant_id = db.Column(db.Integer, db.ForeignKey("restaurant.id"), nullable=False, index=True)
+    serialize_fields = ("id", "rating", "content")
 
     def __init__(self, **kwargs):
         self.rating = kwargs.get("rating")
@@ -187,24 +398,34 @@ class Review(db.Model):
         self.user_id = kwargs.get("user_id")
         self.restaurant_id = kwargs.get("restaurant_id")
 
-    def serialize(self):
-        return {
-            "id": self.id,
-            "rating": self.rating,
-            "content": self.content,
-        }
-
-class Category(db.Model):
+class Category(Serializable, db.Model):
     __tablename__ = "category"
     id = db.Column(db.Integer, primary_key=True)
     description = db.Column(db.String, nullable=False)
     restaurants = db.relationship("Restaurant", secondary=association_restaurant_categories, back_populates="categories")
-    
+    serialize_fields = ("id", "description")
+
     def __init__(self, **kwargs):
         self.description = kwargs.get("description")
 
-    def serialize(self):
-        return {
-            "id": self.id,
-            "description": self.description,
-        }
\ No newline at end of file
+# Full-text index over dish names, restaurant names and category
+# descriptions (SQLite FTS5), kept in sync by triggers. A row's rowid is
+# id * 4 + its kind, so writes find their index row by primary key.
+SEARCH_KINDS = {"dish": 1, "restaurant": 2, "category": 3}
+SEARCH_SOURCES = [("dish", "name"), ("restaurant", "name"), ("category", "description")]
+
+event.listen(db.Model.metadata, "after_create", DDL(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(name, tokenize = 'unicode61 remove_diacritics 2')"
+).execute_if(dialect="sqlite"))
+for table, column in SEARCH_SOURCES:
+    rowid = "%%s.id * 4 + %d" % SEARCH_KINDS[table]
+    for name, statement in [
+        ("insert", "AFTER INSERT ON {table} BEGIN INSERT INTO search_index (rowid, name) VALUES ({new}, new.{column}); END"),
+        ("update", "AFTER UPDATE OF {column} ON {table} BEGIN UPDATE search_index SET name = new.{column} WHERE rowid = {new}; END"),
+        ("delete", "AFTER DELETE ON {table} BEGIN DELETE FROM search_index WHERE rowid = {old}; END"),
+    ]:
+        event.listen(db.Model.metadata, "after_create", DDL(
+            ("CREATE TRIGGER IF NOT EXISTS {table}_search_%s " % name + statement).format(
+                table=table, column=column, new=rowid % "new", old=rowid % "old"
+            )
+        ).execute_if(dialect="sqlite"))
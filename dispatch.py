@@ -0,0 +1,110 @@
+import heapq
+import threading
+import time
+from db import db, Order, Driver
+
+# Least-loaded-first index of drivers, load being a driver's undelivered
+# orders. The heap holds (load, driver_id) entries; a driver's load changes
+# by pushing a new entry, and entries that no longer match the driver's
+# current load are dropped as they reach the top, so assigning and moving
+# load are O(log n). It is rebuilt from the order table on first use and
+# every refresh_seconds after that, which also folds in changes made by
+# other processes.
+class Dispatcher(object):
+    def __init__(self, refresh_seconds=60):
+        self.refresh_seconds = refresh_seconds
+        self._loads = None
+        self._heap = []
+        self._built_at = 0
+        self._lock = threading.Lock()
+        self.assigned = self.unassigned = self.rebuilds = 0
+
+    def _rebuild(self):
+        loads = dict((driver_id, 0) for driver_id, in db.session.query(Driver.id))
+        for driver_id, count in db.session.query(Order.driver_id, db.func.count(Order.id)).filter(
+            Order.driver_id.isnot(None),
+            Order.delivered == False
+        ).group_by(Order.driver_id):
+            if driver_id in loads:
+                loads[driver_id] = count
+        self._loads = loads
+        self._heap = [(load, driver_id) for driver_id, load in loads.items()]
+        heapq.heapify(self._heap)
+        self._built_at = time.monotonic()
+        self.rebuilds += 1
+
+    def _ensure(self):
+        if self._loads is None or time.monotonic() - self._built_at > self.refresh_seconds:
+            self._rebuild()
+
+    def _push(self, driver_id, load):
+        self._loads[driver_id] = load
+        heapq.heappush(self._heap, (load, driver_id))
+        # Stale entries pile up as loads move; drop them once they outnumber
+        # the live ones
+        if len(self._heap) > 2 * len(self._loads) + 64:
+            self._heap = [(load, driver_id) for driver_id, load in self._loads.items()]
+            heapq.heapify(self._heap)
+
+    # Picks the least-loaded drivers (ties go to the lowest id) for count
+    # new orders and charges each pick to its driver. Returns None for the
+    # orders left without a driver when there are no drivers at all.
+    def assign(self, count=1):
+        picks = []
+        with self._lock:
+            self._ensure()
+            while len(picks) < count:
+                while self._heap and self._loads.get(self._heap[0][1]) != self._heap[0][0]:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    picks.extend([None] * (count - len(picks)))
+                    break
+                load, driver_id = self._heap[0]
+                self._loads[driver_id] = load + 1
+                heapq.heapreplace(self._heap, (load + 1, driver_id))
+                picks.append(driver_id)
+            self.assigned += sum(1 for pick in picks if pick is not None)
+            self.unassigned += sum(1 for pick in picks if pick is None)
+        return picks
+
+    # Moves a driver's load by delta, e.g. -1 once one of their orders is
+    # delivered; unknown drivers are added
+    def adjust(self, driver_id, delta):
+        if driver_id is None:
+            return
+        with self._lock:
+            if self._loads is None:
+                return
+            self._push(driver_id, max(0, self._loads.get(driver_id, 0) + delta))
+
+    def remove(self, driver_id):
+        with self._lock:
+            if self._loads is not None:
+                self._loads.pop(driver_id, None)
+
+    # Forgets every load, e.g. after rows were written outside the DAO; the
+    # next assignment rebuilds the index
+    def reset(self):
+        with self._lock:
+            self._loads = None
+            self._heap = []
+
+    def stats(self):
+        with self._lock:
+            loads = list(self._loads.values()) if self._loads is not None else []
+        return {
+            "drivers": len(loads),
+            "active_orders": sum(loads),
+            "max_load": max(loads) if loads else 0,
+            "assigned": self.assigned,
+            "unassigned": self.unassigned,
+            "rebuilds": self.rebuilds,
+        }
+
+dispatcher = Dispatcher()
+
+def init_app(app):
+    global dispatcher
+    app.config.setdefault("DISPATCH_REFRESH_SECONDS", 60)
+
+    dispatcher = Dispatcher(app.config["DISPATCH_REFRESH_SECONDS"])
@@ -0,0 +1,91 @@
+import json
+import cache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# JSON text of a value, through orjson when it is installed
+def dumps(value):
+    if orjson is not None:
+        return orjson.dumps(value).decode()
+    return json.dumps(value)
+
+# Encoded JSON, spliced verbatim into responses by envelope(); id is the
+# entity's id when it is one
+class Fragment(str):
+    id = None
+
+# Encoded default projections of restaurants, dishes and orders, keyed
+# "<table>:<id>:<version>". Every write that changes what an entity
+# serializes to bumps its version, so entries never go stale: the ones of
+# old versions just stop being asked for and age out. Bounded by total
+# encoded length as well as count, since one restaurant's fragment can
+# outweigh thousands of dishes'.
+fragments = cache.LRUCache(100000, 3600, 256 * 1024 * 1024)
+
+def _key(model, id, version):
+    return "%s:%d:%d" % (model.__tablename__, id, version)
+
+# The cached fragment of a version of an entity, or None
+def cached(model, id, version):
+    return fragments.get(_key(model, id, version))
+
+# Model -> (whether it is versioned, template of its JSON object with the
+# keys already encoded and a %s per value or None when it has no
+# relationships, [(field, is_relationship)])
+_plans = {}
+
+def _plan(model):
+    plan = _plans.get(model)
+    if plan is None:
+        relationships = model.__mapper__.relationships
+        template = None
+        if any(name in relationships for name in model.serialize_fields):
+            template = "{%s}" % ", ".join("%s: %%s" % json.dumps(name) for name in model.serialize_fields)
+        fields = [(name, name in relationships) for name in model.serialize_fields]
+        plan = _plans[model] = "version" in model.__table__.c, template, fields
+    return plan
+
+# What json.dumps(entity.serialize()) would give, with every embedded
+# restaurant, dish and order taken from, or added to, the fragment cache
+def encode(entity):
+    versioned, template, fields = _plan(type(entity))
+    if versioned:
+        key = _key(type(entity), entity.id, entity.version)
+        fragment = fragments.get(key)
+        if fragment is not None:
+            return fragment
+    if template is None:
+        fragment = Fragment(dumps(entity.serialize()))
+    else:
+        fragment = Fragment(template % tuple(
+            "[%s]" % ", ".join(encode(child) for child in getattr(entity, name)) if relationship else dumps(getattr(entity, name))
+            for name, relationship in fields
+        ))
+    fragment.id = getattr(entity, "id", None)
+    if versioned:
+        fragments.set(key, fragment)
+    return fragment
+
+# JSON text of a payload that may be, or be a list holding, fragments
+def text(data):
+    if isinstance(data, Fragment):
+        return data
+    if isinstance(data, list) and any(isinstance(item, Fragment) for item in data):
+        return "[%s]" % ", ".join(item if isinstance(item, Fragment) else dumps(item) for item in data)
+    return dumps(data)
+
+# The {"success": true, "data": ...} envelope, with any extra top-level keys
+def envelope(data, **extra):
+    return '{"success": true, "data": %s%s}' % (
+        text(data), "".join(", %s: %s" % (json.dumps(key), dumps(value)) for key, value in extra.items())
+    )
+
+def init_app(app):
+    global fragments
+    app.config.setdefault("FRAGMENT_CACHE_SIZE", 100000)
+    app.config.setdefault("FRAGMENT_CACHE_BYTES", 256 * 1024 * 1024)
+
+    fragments = cache.LRUCache(app.config["FRAGMENT_CACHE_SIZE"], 3600, app.config["FRAGMENT_CACHE_BYTES"])
@@ -0,0 +1,188 @@
+import functools
+import sqlite3
+import threading
+import types
+from contextlib import contextmanager
+from urllib.request import pathname2url
+from flask import g, has_app_context, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool, StaticPool
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.expression import SelectBase
+from cache import LRUCache
+
+# Run on every new SQLite connection, in order. WAL lets readers proceed
+# while one writer commits, and busy_timeout makes a second writer wait for
+# the lock instead of failing with "database is locked".
+DEFAULT_SQLITE_PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("mmap_size", 256 * 1024 * 1024),
+    ("cache_size", -64 * 1024),
+    ("busy_timeout", 5000),
+    ("foreign_keys", "ON"),
+)
+
+# Bind key of the engine read-only DAO functions run on
+REPLICA = "replica"
+
+pragmas = DEFAULT_SQLITE_PRAGMAS
+# Clients that committed a write recently; their reads stay on the primary
+# for READ_YOUR_WRITES_WINDOW seconds, in case the replica lags behind
+recent_writers = LRUCache(100000, 5)
+# Statements by where they were routed: reads sent to the replica, reads
+# kept on the primary, and everything else
+routing_counts = {"replica_reads": 0, "primary_reads": 0, "writes": 0}
+_lock = threading.Lock()
+
+def init_app(app):
+    global pragmas, recent_writers
+    app.config.setdefault("SQLALCHEMY_DATABASE_URI", "sqlite:///delivery.db")
+    app.config.setdefault("SQLALCHEMY_POOL_SIZE", 8)
+    app.config.setdefault("SQLALCHEMY_MAX_OVERFLOW", 8)
+    app.config.setdefault("SQLALCHEMY_POOL_TIMEOUT", 10)
+    app.config.setdefault("SQLITE_PRAGMAS", DEFAULT_SQLITE_PRAGMAS)
+    app.config.setdefault("SQLITE_STATEMENT_CACHE_SIZE", 256)
+    app.config.setdefault("DATABASE_REPLICA_URL", _default_replica_url(app.config["SQLALCHEMY_DATABASE_URI"]))
+    app.config.setdefault("READ_YOUR_WRITES_WINDOW", 5)
+
+    pragmas = tuple(app.config["SQLITE_PRAGMAS"])
+    recent_writers = LRUCache(100000, app.config["READ_YOUR_WRITES_WINDOW"])
+    if app.config["DATABASE_REPLICA_URL"]:
+        binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+        binds[REPLICA] = app.config["DATABASE_REPLICA_URL"]
+        app.config["SQLALCHEMY_BINDS"] = binds
+
+# A SQLite file is its own replica: read-only connections to it never take
+# the write lock, and in WAL mode they see every committed write
+def _default_replica_url(url):
+    if not url.startswith("sqlite:///") or url.endswith(":memory:"):
+        return None
+    return url + ("&" if "?" in url else "?") + "mode=ro"
+
+# Marks a DAO function as read-only, so the statements it runs go to the
+# replica. Returned generators are read from the replica as well.
+def read_only(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with _reading():
+            result = fn(*args, **kwargs)
+        if isinstance(result, types.GeneratorType):
+            return _read_only_iter(result)
+        return result
+    return wrapper
+
+@contextmanager
+def _reading():
+    if not has_app_context():
+        yield
+        return
+    g.read_depth = g.get("read_depth", 0) + 1
+    try:
+        yield
+    finally:
+        g.read_depth -= 1
+
+def _is_reading():
+    return has_app_context() and g.get("read_depth", 0) > 0
+
+def _read_only_iter(items):
+    with _reading():
+        for item in items:
+            yield item
+
+def _client():
+    return request.headers.get("Authorization") or request.remote_addr
+
+def _count(route):
+    with _lock:
+        routing_counts[route] += 1
+
+@event.listens_for(Engine, "connect")
+def _apply_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas:
+        cursor.execute("PRAGMA %s = %s" % (name, value))
+    cursor.close()
+
+# create_engine() arguments NullPool and StaticPool refuse
+QUEUE_POOL_OPTIONS = ("pool_size", "max_overflow", "pool_timeout")
+
+# Flask-SQLAlchemy 2.3 only knows NullPool for SQLite files, which opens a
+# new connection (and re-reads the schema) on every checkout. With a pool
+# size configured, SQLite files get a QueuePool like server databases do.
+class Database(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        super(Database, self).apply_driver_hacks(app, info, options)
+        if info.drivername != "sqlite":
+            return
+        connect_args = options.setdefault("connect_args", {})
+        connect_args.setdefault("cached_statements", app.config["SQLITE_STATEMENT_CACHE_SIZE"])
+        # pysqlite in SQLAlchemy 1.3 has no URI filenames, so read-only
+        # connections are opened by hand
+        if info.query.pop("mode", None) == "ro":
+            options["creator"] = functools.partial(
+                sqlite3.connect,
+                "file:%s?mode=ro" % pathname2url(info.database),
+                uri=True,
+                check_same_thread=False,
+                cached_statements=connect_args["cached_statements"]
+            )
+        if options.get("pool_size") and options.get("poolclass") is not StaticPool:
+            options["poolclass"] = QueuePool
+            # Pooled connections move between request threads, one at a time
+            connect_args["check_same_thread"] = False
+        else:
+            for name in QUEUE_POOL_OPTIONS:
+                options.pop(name, None)
+
+# Session that sends the reads of read-only DAO functions to the replica,
+# unless the session holds unflushed or uncommitted writes, or the
+# requesting client wrote recently
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        self.db = db
+        self.has_writes = False
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._writes(clause):
+            self.has_writes = True
+            _count("writes")
+        elif self._use_replica():
+            _count("replica_reads")
+            return self.db.get_engine(self.app, bind=REPLICA)
+        else:
+            _count("primary_reads")
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    # Raw SQL and bare connections are only trusted to read inside
+    # read-only functions
+    def _writes(self, clause):
+        if self._flushing or isinstance(clause, UpdateBase):
+            return True
+        return not isinstance(clause, SelectBase) and not _is_reading()
+
+    def _use_replica(self):
+        if not _is_reading() or REPLICA not in (self.app.config["SQLALCHEMY_BINDS"] or {}):
+            return False
+        if self.has_writes or self.new or self.dirty or self.deleted:
+            return False
+        return not (has_request_context() and recent_writers.get(_client()) is not None)
+
+@event.listens_for(RoutingSession, "after_commit")
+def _remember_writer(session):
+    if session.has_writes and has_request_context():
+        recent_writers.set(_client(), True)
+    session.has_writes = False
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _forget_writes(session):
+    session.has_writes = False
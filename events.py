@@ -0,0 +1,187 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+from db import db, OrderEvent
+
+logger = logging.getLogger(__name__)
+
+# Raised when a client would go over EVENTS_MAX_SUBSCRIBERS in this process
+# or EVENTS_MAX_PER_CLIENT of its own; callers should answer 503
+class TooManySubscribers(Exception):
+    pass
+
+# One client waiting on one order's status events. Only the latest few are
+# kept: a status event supersedes the ones before it.
+class Subscription(object):
+    def __init__(self, order_id, client):
+        self.order_id = order_id
+        self.client = client
+        self._events = deque(maxlen=8)
+        self._condition = threading.Condition()
+
+    def put(self, event):
+        with self._condition:
+            self._events.append(event)
+            self._condition.notify()
+
+    # The next event, or None after timeout seconds without one
+    def get(self, timeout):
+        with self._condition:
+            if not self._events:
+                self._condition.wait(timeout)
+            return self._events.popleft() if self._events else None
+
+# In-process fan-out of order status events to the subscriptions of each order
+class Hub(object):
+    def __init__(self, max_subscribers=1000, max_per_client=5):
+        self.max_subscribers = max_subscribers
+        self.max_per_client = max_per_client
+        self._orders = {}
+        self._clients = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self.published = self.delivered = self.rejected = 0
+
+    def subscribe(self, order_id, client):
+        with self._lock:
+            if self._count >= self.max_subscribers or self._clients.get(client, 0) >= self.max_per_client:
+                self.rejected += 1
+                raise TooManySubscribers()
+            subscription = Subscription(order_id, client)
+            self._orders.setdefault(order_id, set()).add(subscription)
+            self._clients[client] = self._clients.get(client, 0) + 1
+            self._count += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._orders.get(subscription.order_id)
+            if subscriptions is None or subscription not in subscriptions:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._orders[subscription.order_id]
+            self._clients[subscription.client] -= 1
+            if not self._clients[subscription.client]:
+                del self._clients[subscription.client]
+            self._count -= 1
+
+    def publish(self, event):
+        with self._lock:
+            subscriptions = list(self._orders.get(event["id"], ()))
+            self.published += 1
+            self.delivered += len(subscriptions)
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    def stats(self):
+        return {
+            "subscribers": self._count,
+            "published": self.published,
+            "delivered": self.delivered,
+            "rejected": self.rejected,
+        }
+
+# Hands events straight to this process's hub
+class MemoryBroker(object):
+    def __init__(self, hub):
+        self.hub = hub
+
+    def publish(self, events):
+        for event in events:
+            self.hub.publish(event)
+
+    def start(self):
+        pass
+
+# Shares events between processes through the order_event table: publishing
+# inserts a row, and each process tails the table from a background thread,
+# started by its first subscriber, handing new rows to its hub. Rows older than
+# retention_seconds are deleted as the tail goes by.
+class DatabaseBroker(object):
+    def __init__(self, hub, app, poll_seconds=0.5, retention_seconds=3600):
+        self.hub = hub
+        self.app = app
+        self.poll_seconds = poll_seconds
+        self.retention_seconds = retention_seconds
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def publish(self, events):
+        now = time.time()
+        db.session.execute(OrderEvent.__table__.insert(), [
+            {"order_id": event["id"], "payload": json.dumps(event), "created_at": now} for event in events
+        ])
+        db.session.commit()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._tail, name="order-events", daemon=True)
+                self._thread.start()
+
+    def _tail(self):
+        table = OrderEvent.__table__
+        with self.app.app_context():
+            last_id = db.session.query(db.func.max(table.c.id)).scalar() or 0
+            db.session.remove()
+            pruned_at = 0
+            while True:
+                time.sleep(self.poll_seconds)
+                try:
+                    rows = db.session.execute(
+                        db.select([table.c.id, table.c.payload]).where(table.c.id > last_id).order_by(table.c.id)
+                    ).fetchall()
+                    if time.monotonic() - pruned_at > self.retention_seconds / 10.0:
+                        db.session.execute(table.delete().where(table.c.created_at < time.time() - self.retention_seconds))
+                        db.session.commit()
+                        pruned_at = time.monotonic()
+                except Exception:
+                    logger.exception("Reading order events failed")
+                    rows = []
+                finally:
+                    db.session.remove()
+                for event_id, payload in rows:
+                    last_id = event_id
+                    self.hub.publish(json.loads(payload))
+
+hub = Hub()
+broker = MemoryBroker(hub)
+HEARTBEAT_SECONDS = 15
+STREAM_SECONDS = 300
+LONG_POLL_SECONDS = 30
+
+def init_app(app):
+    global hub, broker, HEARTBEAT_SECONDS, STREAM_SECONDS, LONG_POLL_SECONDS
+    app.config.setdefault("EVENTS_BACKEND", "memory")
+    app.config.setdefault("EVENTS_MAX_SUBSCRIBERS", 1000)
+    app.config.setdefault("EVENTS_MAX_PER_CLIENT", 5)
+    app.config.setdefault("EVENTS_HEARTBEAT_SECONDS", 15)
+    app.config.setdefault("EVENTS_STREAM_SECONDS", 300)
+    app.config.setdefault("EVENTS_LONG_POLL_SECONDS", 30)
+    app.config.setdefault("EVENTS_POLL_SECONDS", 0.5)
+    app.config.setdefault("EVENTS_RETENTION_SECONDS", 3600)
+
+    HEARTBEAT_SECONDS = app.config["EVENTS_HEARTBEAT_SECONDS"]
+    STREAM_SECONDS = app.config["EVENTS_STREAM_SECONDS"]
+    LONG_POLL_SECONDS = app.config["EVENTS_LONG_POLL_SECONDS"]
+    hub = Hub(app.config["EVENTS_MAX_SUBSCRIBERS"], app.config["EVENTS_MAX_PER_CLIENT"])
+    backend = app.config["EVENTS_BACKEND"]
+    if backend == "memory":
+        broker = MemoryBroker(hub)
+    elif backend == "database":
+        broker = DatabaseBroker(hub, app, app.config["EVENTS_POLL_SECONDS"], app.config["EVENTS_RETENTION_SECONDS"])
+    else:
+        raise ValueError("Unknown EVENTS_BACKEND %r." % backend)
+
+# Publishes order status events ({"id", "paid", "delivered", "driver_id",
+# "version"}); call after the write that changed them committed
+def publish(*statuses):
+    if statuses:
+        broker.publish(statuses)
+
+def subscribe(order_id, client):
+    broker.start()
+    return hub.subscribe(order_id, client)
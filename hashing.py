@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+from concurrent import futures
+import bcrypt
+
+# Raised when every worker is busy and the queue is full; callers should
+# answer 503 and ask the client to retry after RETRY_AFTER seconds
+class PoolFull(Exception):
+    pass
+
+# Raised when a hash waited longer than the pool's timeout; answered like
+# PoolFull, so a request thread never blocks on a backed up pool for long
+class HashTimeout(PoolFull):
+    pass
+
+# bcrypt releases the GIL while hashing, so a thread pool is enough to keep
+# hashing off the request threads' CPU budget
+class HashingPool(object):
+    def __init__(self, workers, queue_size, timeout=None):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._executor = futures.ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self.in_flight = self.submitted = self.rejected = self.timed_out = self.completed = 0
+        self.wait_seconds = self.run_seconds = 0.0
+        self.max_wait_seconds = self.max_run_seconds = 0.0
+
+    def run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise PoolFull()
+        with self._lock:
+            self.submitted += 1
+            self.in_flight += 1
+        future = self._executor.submit(self._timed, time.monotonic(), fn, *args)
+        # The slot is held until the hash finishes or is cancelled, not
+        # just while a caller waits for it
+        future.add_done_callback(self._release)
+        try:
+            return future.result(self.timeout)
+        except futures.TimeoutError:
+            future.cancel()
+            with self._lock:
+                self.timed_out += 1
+            raise HashTimeout()
+
+    def _release(self, future):
+        self._slots.release()
+        with self._lock:
+            self.in_flight -= 1
+
+    def _timed(self, queued_at, fn, *args):
+        started = time.monotonic()
+        try:
+            return fn(*args)
+        finally:
+            waited, ran = started - queued_at, time.monotonic() - started
+            with self._lock:
+                self.completed += 1
+                self.wait_seconds += waited
+                self.run_seconds += ran
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+                self.max_run_seconds = max(self.max_run_seconds, ran)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "in_flight": self.in_flight,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "completed": self.completed,
+            "wait_seconds": self.wait_seconds,
+            "run_seconds": self.run_seconds,
+            "max_wait_seconds": self.max_wait_seconds,
+            "max_run_seconds": self.max_run_seconds,
+        }
+
+ROUNDS = 13
+RETRY_AFTER = 1
+pool = HashingPool(os.cpu_count() or 1, 32, 10)
+
+def init_app(app):
+    global ROUNDS, RETRY_AFTER, pool
+    app.config.setdefault("BCRYPT_ROUNDS", 13)
+    app.config.setdefault("HASHING_WORKERS", os.cpu_count() or 1)
+    app.config.setdefault("HASHING_QUEUE_SIZE", 32)
+    app.config.setdefault("HASHING_RETRY_AFTER", 1)
+    app.config.setdefault("HASHING_TIMEOUT", 10)
+
+    ROUNDS = app.config["BCRYPT_ROUNDS"]
+    RETRY_AFTER = app.config["HASHING_RETRY_AFTER"]
+    pool = HashingPool(app.config["HASHING_WORKERS"], app.config["HASHING_QUEUE_SIZE"], app.config["HASHING_TIMEOUT"])
+
+def _digest_bytes(digest):
+    return digest.encode("utf8") if isinstance(digest, str) else digest
+
+def hash_password(password):
+    return pool.run(bcrypt.hashpw, password.encode("utf8"), bcrypt.gensalt(rounds=ROUNDS))
+
+def check_password(password, digest):
+    try:
+        return pool.run(bcrypt.checkpw, password.encode("utf8"), _digest_bytes(digest))
+    except ValueError:
+        return False
+
+# True when the digest was made with a different work factor than the
+# configured one, e.g. after BCRYPT_ROUNDS changed
+def needs_rehash(digest):
+    parts = _digest_bytes(digest).split(b"$")
+    return len(parts) < 3 or parts[2] != b"%02d" % ROUNDS
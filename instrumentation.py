@@ -0,0 +1,178 @@
+import logging
+import threading
+import time
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Mapper
+import auth
+import cache
+import dispatch
+import encoding
+import engine
+import events
+import hashing
+import jobs
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SLOW_QUERY_SECONDS = 0.1
+
+# Per-endpoint request latencies, SQL statements, SQL time and ORM rows
+# loaded while handling requests
+endpoints = {}
+slow_queries = 0
+_lock = threading.Lock()
+
+def init_app(app):
+    global SLOW_QUERY_SECONDS
+    app.config.setdefault("SLOW_QUERY_SECONDS", 0.1)
+
+    SLOW_QUERY_SECONDS = app.config["SLOW_QUERY_SECONDS"]
+    app.before_request(_start_request)
+    app.after_request(_record_request)
+
+def _start_request():
+    g.request_started = time.perf_counter()
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _record_query(conn, cursor, statement, parameters, context, executemany):
+    global slow_queries
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    if has_app_context():
+        g.query_count = g.get("query_count", 0) + 1
+        g.sql_seconds = g.get("sql_seconds", 0) + elapsed
+    if elapsed >= SLOW_QUERY_SECONDS:
+        with _lock:
+            slow_queries += 1
+        logger.warning("Slow query (%.3fs): %s -- parameters %s", elapsed, " ".join(statement.split()),
+            _parameter_shape(parameters, executemany))
+
+@event.listens_for(Mapper, "load")
+def _count_row(target, context):
+    if has_app_context():
+        g.rows_loaded = g.get("rows_loaded", 0) + 1
+
+# Names and types of bound parameters, never their values
+def _parameter_shape(parameters, executemany):
+    if executemany:
+        return "%d x %s" % (len(parameters), _parameter_shape(parameters[0], False) if parameters else "()")
+    if isinstance(parameters, dict):
+        return "{%s}" % ", ".join("%s: %s" % (key, type(value).__name__) for key, value in sorted(parameters.items()))
+    return "(%s)" % ", ".join(type(value).__name__ for value in parameters)
+
+def _record_request(response):
+    latency = time.perf_counter() - g.get("request_started", time.perf_counter())
+    count = g.get("query_count", 0)
+    with _lock:
+        stats = endpoints.get(request.endpoint)
+        if stats is None:
+            stats = endpoints[request.endpoint] = {
+                "requests": 0, "latency_seconds": 0.0, "latency_buckets": [0] * len(LATENCY_BUCKETS),
+                "queries": 0, "max_queries": 0, "sql_seconds": 0.0, "rows": 0
+            }
+        stats["requests"] += 1
+        stats["latency_seconds"] += latency
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                stats["latency_buckets"][i] += 1
+        stats["queries"] += count
+        stats["max_queries"] = max(stats["max_queries"], count)
+        stats["sql_seconds"] += g.get("sql_seconds", 0)
+        stats["rows"] += g.get("rows_loaded", 0)
+    response.headers["X-Query-Count"] = str(count)
+    return response
+
+def _sample(lines, name, value, **labels):
+    if labels:
+        name += "{%s}" % ",".join('%s="%s"' % (key, labels[key]) for key in sorted(labels))
+    lines.append("%s %s" % (name, value))
+
+def _metric(lines, name, kind, help):
+    lines.append("# HELP %s %s" % (name, help))
+    lines.append("# TYPE %s %s" % (name, kind))
+
+# Everything above, plus the cache, fragment, session, hashing pool,
+# read/write routing, dispatcher, order event and job queue counters, in the
+# Prometheus text exposition format
+def render_metrics():
+    with _lock:
+        snapshot = dict((endpoint, dict(stats, latency_buckets=list(stats["latency_buckets"])))
+            for endpoint, stats in endpoints.items())
+    lines = []
+
+    _metric(lines, "dingdong_request_duration_seconds", "histogram", "Time spent handling requests.")
+    for endpoint, stats in sorted(snapshot.items(), key=lambda item: str(item[0])):
+        for bound, count in zip(LATENCY_BUCKETS, stats["latency_buckets"]):
+            _sample(lines, "dingdong_request_duration_seconds_bucket", count, endpoint=endpoint, le=bound)
+        _sample(lines, "dingdong_request_duration_seconds_bucket", stats["requests"], endpoint=endpoint, le="+Inf")
+        _sample(lines, "dingdong_request_duration_seconds_sum", stats["latency_seconds"], endpoint=endpoint)
+        _sample(lines, "dingdong_request_duration_seconds_count", stats["requests"], endpoint=endpoint)
+    for name, key, kind, help in (
+        ("dingdong_sql_queries_total", "queries", "counter", "SQL statements issued by requests."),
+        ("dingdong_sql_queries_max", "max_queries", "gauge", "Most SQL statements issued by one request."),
+        ("dingdong_sql_seconds_total", "sql_seconds", "counter", "Time spent executing SQL statements."),
+        ("dingdong_rows_loaded_total", "rows", "counter", "ORM entities loaded from query results."),
+    ):
+        _metric(lines, name, kind, help)
+        for endpoint, stats in sorted(snapshot.items(), key=lambda item: str(item[0])):
+            _sample(lines, name, stats[key], endpoint=endpoint)
+
+    _metric(lines, "dingdong_slow_queries_total", "counter", "SQL statements slower than SLOW_QUERY_SECONDS.")
+    _sample(lines, "dingdong_slow_queries_total", slow_queries)
+    _metric(lines, "dingdong_db_statements_total", "counter", "SQL statements by read/write routing.")
+    for route, count in sorted(engine.routing_counts.items()):
+        _sample(lines, "dingdong_db_statements_total", count, route=route)
+    for name, store in (("entity", cache.entities), ("fragment", encoding.fragments), ("session", auth.sessions)):
+        for key, value in sorted(store.stats().items()):
+            kind = "gauge" if key in ("size", "bytes") else "counter"
+            metric = "dingdong_%s_cache_%s" % (name, key if kind == "gauge" else key + "_total")
+            _metric(lines, metric, kind, "%s cache %s." % (name.capitalize(), key))
+            _sample(lines, metric, value)
+    pool = hashing.pool.stats()
+    for key, kind in (("in_flight", "gauge"), ("submitted", "counter"), ("rejected", "counter"),
+            ("timed_out", "counter"), ("completed", "counter"), ("wait_seconds", "counter"), ("run_seconds", "counter")):
+        metric = "dingdong_hashing_%s" % (key if kind == "gauge" else key + "_total")
+        _metric(lines, metric, kind, "Password hashing pool %s." % key.replace("_", " "))
+        _sample(lines, metric, pool[key])
+    dispatcher = dispatch.dispatcher.stats()
+    for key, kind, help in (("drivers", "gauge", "Drivers in the dispatch index."),
+            ("active_orders", "gauge", "Undelivered orders charged to drivers."),
+            ("max_load", "gauge", "Most undelivered orders held by one driver."),
+            ("assigned", "counter", "Orders given a driver by the dispatcher."),
+            ("unassigned", "counter", "Orders left without a driver for lack of drivers."),
+            ("rebuilds", "counter", "Rebuilds of the dispatch index from the order table.")):
+        metric = "dingdong_dispatch_%s" % (key if kind == "gauge" else key + "_total")
+        _metric(lines, metric, kind, help)
+        _sample(lines, metric, dispatcher[key])
+    hub = events.hub.stats()
+    for key, kind, help in (("subscribers", "gauge", "Open order event streams and long polls."),
+            ("published", "counter", "Order status events published."),
+            ("delivered", "counter", "Order status events handed to subscribers."),
+            ("rejected", "counter", "Subscriptions refused by the connection limits.")):
+        metric = "dingdong_order_events_%s" % (key if kind == "gauge" else key + "_total")
+        _metric(lines, metric, kind, help)
+        _sample(lines, metric, hub[key])
+    counts, oldest = jobs.queue.depth()
+    _metric(lines, "dingdong_jobs", "gauge", "Background jobs by status.")
+    for status, count in sorted(counts.items()):
+        _sample(lines, "dingdong_jobs", count, status=status)
+    _metric(lines, "dingdong_jobs_oldest_due_seconds", "gauge", "How long the oldest due pending job has waited.")
+    _sample(lines, "dingdong_jobs_oldest_due_seconds", oldest)
+    queue = jobs.queue.stats()
+    for key, kind, help in (("workers", "gauge", "Job worker threads in this process."),
+            ("completed", "counter", "Jobs run to completion."),
+            ("retried", "counter", "Job runs that failed and were rescheduled."),
+            ("failed", "counter", "Jobs given up on after JOBS_MAX_ATTEMPTS runs."),
+            ("wait_seconds", "counter", "Time completed jobs waited after coming due."),
+            ("run_seconds", "counter", "Time spent running completed jobs.")):
+        metric = "dingdong_jobs_%s" % (key if kind == "gauge" else key + "_total")
+        _metric(lines, metric, kind, help)
+        _sample(lines, metric, queue[key])
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,229 @@
+import json
+import logging
+import threading
+import time
+from sqlalchemy.exc import IntegrityError
+from db import db, Job
+
+logger = logging.getLogger(__name__)
+
+PENDING, RUNNING, DONE, FAILED = "pending", "running", "done", "failed"
+
+# Job kind -> function run with the job's payload as keyword arguments
+handlers = {}
+
+def handler(kind):
+    def register(fn):
+        handlers[kind] = fn
+        return fn
+    return register
+
+# Queues one job per payload in the caller's transaction, so the workers
+# only see them once it commits, and never if it rolls back. With
+# dedupe_on, a job is skipped while a pending job of the same kind has the
+# same value of that payload field: many writes to one restaurant queue
+# one refresh. The jobs come due after delay seconds.
+def enqueue(kind, payloads, dedupe_on=None, delay=0):
+    now = time.time()
+    rows = [{
+        "kind": kind,
+        "key": None if dedupe_on is None else str(payload[dedupe_on]),
+        "payload": json.dumps(payload),
+        "status": PENDING,
+        "attempts": 0,
+        "created_at": now,
+        "run_at": now + delay,
+    } for payload in payloads]
+    if rows:
+        _execute_skipping_duplicates(Job.__table__.insert(), rows)
+
+def _ignores_duplicates_in_sql():
+    return db.engine.dialect.name == "sqlite"
+
+# Runs statement once per parameter set, skipping the ones that would give a
+# key a second pending job: with OR IGNORE on SQLite, elsewhere by running
+# each in a savepoint that is rolled back on the unique index's error
+def _execute_skipping_duplicates(statement, params):
+    if _ignores_duplicates_in_sql():
+        db.session.execute(statement.prefix_with("OR IGNORE"), params)
+        return
+    for one in params:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(statement, one)
+        except IntegrityError:
+            pass
+
+# Workers claim the oldest due job with a conditional UPDATE, so two workers
+# (or processes) never run the same one. A failed job is retried after
+# 2 ** attempts seconds until max_attempts, then kept as failed. A job left
+# running longer than lease_seconds, e.g. by a crashed process, goes back to
+# pending. Finished jobs are deleted after retention_seconds.
+class JobQueue(object):
+    def __init__(self, app, workers=2, poll_seconds=0.5, max_attempts=5, lease_seconds=300, retention_seconds=86400):
+        self.app = app
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.retention_seconds = retention_seconds
+        self._threads = []
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self.completed = self.failed = self.retried = 0
+        self.wait_seconds = self.run_seconds = 0.0
+
+    def start(self, workers=None):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers if workers is None else workers):
+                thread = threading.Thread(target=self._work, name="jobs-%d" % i, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._stopping.clear()
+
+    def _work(self):
+        pruned_at = 0
+        with self.app.app_context():
+            while not self._stopping.is_set():
+                try:
+                    ran = self.run_once()
+                    if time.monotonic() - pruned_at > 60:
+                        self.prune()
+                        pruned_at = time.monotonic()
+                except Exception:
+                    logger.exception("Job worker failed")
+                    ran = False
+                finally:
+                    db.session.remove()
+                if not ran:
+                    self._stopping.wait(self.poll_seconds)
+
+    def _claim(self):
+        table = Job.__table__
+        now = time.time()
+        row = db.session.execute(db.select([table.c.id, table.c.attempts]).where(
+            db.and_(table.c.status == PENDING, table.c.run_at <= now)
+        ).order_by(table.c.run_at).limit(1)).first()
+        if row is None:
+            db.session.rollback()
+            return None
+        job_id, attempts = row
+        claimed = db.session.execute(table.update().where(db.and_(
+            table.c.id == job_id, table.c.status == PENDING, table.c.attempts == attempts
+        )).values(status=RUNNING, attempts=attempts + 1, started_at=now)).rowcount
+        db.session.commit()
+        return Job.query.get(job_id) if claimed else None
+
+    # Claims and runs one due job; returns whether there was one
+    def run_once(self):
+        job = self._claim()
+        if job is None:
+            return False
+        started = time.time()
+        waited = started - job.run_at
+        try:
+            handlers[job.kind](**json.loads(job.payload))
+        except Exception as e:
+            db.session.rollback()
+            logger.exception("Job %d (%s) failed", job.id, job.kind)
+            retry = job.attempts < self.max_attempts
+            if retry and self._superseded(job):
+                db.session.delete(job)
+            else:
+                job.status = PENDING if retry else FAILED
+                job.run_at = time.time() + 2 ** job.attempts
+                job.error = "%s: %s" % (type(e).__name__, e)
+                job.finished_at = None if retry else time.time()
+            db.session.commit()
+            with self._lock:
+                if retry:
+                    self.retried += 1
+                else:
+                    self.failed += 1
+            return True
+        job.status = DONE
+        job.finished_at = time.time()
+        db.session.commit()
+        with self._lock:
+            self.completed += 1
+            self.wait_seconds += waited
+            self.run_seconds += job.finished_at - started
+        return True
+
+    # Whether a pending job with the same kind and key was queued while this
+    # one ran; it redoes the work, and pending keys are unique
+    def _superseded(self, job):
+        return job.key is not None and Job.query.filter_by(kind=job.kind, key=job.key, status=PENDING).count() > 0
+
+    # Runs due jobs until none are left, e.g. from the jobs CLI command
+    def drain(self):
+        self.prune()
+        count = 0
+        while self.run_once():
+            count += 1
+            db.session.remove()
+        return count
+
+    # Returns jobs whose lease expired to pending and deletes old finished ones
+    def prune(self):
+        table = Job.__table__
+        now = time.time()
+        expired = db.and_(table.c.status == RUNNING, table.c.started_at < now - self.lease_seconds)
+        expired_ids = [{"job_id": id} for id, in db.session.query(table.c.id).filter(expired)]
+        if expired_ids:
+            _execute_skipping_duplicates(table.update().where(table.c.id == db.bindparam("job_id")).values(
+                status=PENDING, run_at=now
+            ), expired_ids)
+        # Expired jobs left running have a pending job of their key to redo them
+        db.session.execute(table.delete().where(expired))
+        db.session.execute(table.delete().where(db.and_(
+            table.c.status == DONE, table.c.finished_at < now - self.retention_seconds
+        )))
+        db.session.commit()
+
+    # Pending, running and failed job counts and the age of the oldest due
+    # job, read from the table so they cover every process. Done jobs are
+    # left out: counting them would walk the whole retention window.
+    def depth(self):
+        table = Job.__table__
+        counts = dict((status, 0) for status in (PENDING, RUNNING, FAILED))
+        counts.update(db.session.query(table.c.status, db.func.count(table.c.id)).filter(
+            table.c.status.in_(counts)
+        ).group_by(table.c.status))
+        oldest = db.session.query(db.func.min(table.c.run_at)).filter(
+            table.c.status == PENDING, table.c.run_at <= time.time()
+        ).scalar()
+        return counts, (time.time() - oldest if oldest is not None else 0)
+
+    def stats(self):
+        return {
+            "workers": len(self._threads),
+            "completed": self.completed,
+            "failed": self.failed,
+            "retried": self.retried,
+            "wait_seconds": self.wait_seconds,
+            "run_seconds": self.run_seconds,
+        }
+
+queue = None
+
+def init_app(app):
+    global queue
+    app.config.setdefault("JOBS_WORKERS", 2)
+    app.config.setdefault("JOBS_POLL_SECONDS", 0.5)
+    app.config.setdefault("JOBS_MAX_ATTEMPTS", 5)
+    app.config.setdefault("JOBS_LEASE_SECONDS", 300)
+    app.config.setdefault("JOBS_RETENTION_SECONDS", 86400)
+
+    queue = JobQueue(app, app.config["JOBS_WORKERS"], app.config["JOBS_POLL_SECONDS"], app.config["JOBS_MAX_ATTEMPTS"],
+        app.config["JOBS_LEASE_SECONDS"], app.config["JOBS_RETENTION_SECONDS"])
+    # Workers start with the first request, not for every CLI command
+    app.before_first_request(queue.start)
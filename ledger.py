@@ -0,0 +1,127 @@
+import logging
+import time
+from sqlalchemy import event
+from db import db, User, BalanceEntry
+from engine import RoutingSession
+import jobs
+
+logger = logging.getLogger(__name__)
+
+OPENING, TOP_UP, ADJUSTMENT, CHECKOUT = "opening", "top_up", "adjustment", "checkout"
+
+# Seconds between reconciliation passes over every balance; None turns them off
+RECONCILE_INTERVAL_SECONDS = 3600
+RECONCILE_BATCH_SIZE = 1000
+
+# Adds amount_cents to a user's balance with a single UPDATE ... SET
+# balance_cents = balance_cents + ?, so concurrent changes add up instead of
+# overwriting each other, and nothing is read first. With minimum, the
+# change only happens if the balance stays at or above it. Returns whether
+# the balance changed.
+def apply(user_id, amount_cents, minimum=None):
+    users = User.__table__
+    condition = users.c.id == user_id
+    if minimum is not None:
+        condition = db.and_(condition, users.c.balance_cents + amount_cents >= minimum)
+    return db.session.execute(users.update().where(condition).values(
+        balance_cents=users.c.balance_cents + amount_cents
+    )).rowcount > 0
+
+# Queues a ledger entry for the current transaction. Its entries are
+# inserted with one executemany right before it commits, and dropped if it
+# rolls back.
+def append(user_id, amount_cents, kind, order_id=None):
+    db.session.info.setdefault("ledger", []).append({
+        "user_id": user_id,
+        "amount_cents": amount_cents,
+        "kind": kind,
+        "order_id": order_id,
+        "created_at": time.time(),
+    })
+
+# apply() with its ledger entry, which is only written if the balance changed
+def record(user_id, amount_cents, kind, order_id=None, minimum=None):
+    changed = apply(user_id, amount_cents, minimum)
+    if changed:
+        append(user_id, amount_cents, kind, order_id)
+    return changed
+
+@event.listens_for(RoutingSession, "before_commit")
+def _write_entries(session):
+    entries = session.info.pop("ledger", None)
+    if entries:
+        session.execute(BalanceEntry.__table__.insert(), entries)
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _drop_entries(session):
+    session.info.pop("ledger", None)
+
+# Checks the balances of at most batch (default RECONCILE_BATCH_SIZE) users
+# with ids above after against the sums of their ledger entries, in one
+# transaction. Accounts open with an opening entry, so a user without one
+# predates the ledger: it gets one for what its balance holds beyond its
+# entries. Any other balance that drifted from its entries is reset to
+# their sum and logged. Returns the last id checked, how many were checked
+# and the ids of the reset balances, or None when no users are left.
+def reconcile(after=0, batch=None):
+    users, entries = User.__table__, BalanceEntry.__table__
+    in_batch = users.c.id.in_(
+        db.select([users.c.id]).where(users.c.id > after).order_by(users.c.id).limit(batch or RECONCILE_BATCH_SIZE)
+    )
+    ledger_total = db.select([db.func.coalesce(db.func.sum(entries.c.amount_cents), 0)]).where(
+        entries.c.user_id == users.c.id
+    ).as_scalar()
+    # Writing first takes the write lock, so no balance can change between
+    # the sums below and the resets
+    db.session.execute(entries.insert().from_select(
+        ["user_id", "amount_cents", "kind", "created_at"],
+        db.select([users.c.id, users.c.balance_cents - ledger_total, db.literal(OPENING), db.literal(time.time())]).where(
+            db.and_(in_batch, ~db.exists().where(db.and_(entries.c.user_id == users.c.id, entries.c.kind == OPENING)))
+        )
+    ))
+    rows = db.session.execute(
+        db.select([users.c.id, users.c.balance_cents, ledger_total]).where(in_batch).order_by(users.c.id)
+    ).fetchall()
+    if not rows:
+        db.session.rollback()
+        return None
+    drifted = [{"uid": id, "total": total_cents} for id, balance_cents, total_cents in rows if balance_cents != total_cents]
+    for row in drifted:
+        logger.warning("Balance of user %d drifted from its ledger; reset to %d cents", row["uid"], row["total"])
+    if drifted:
+        db.session.execute(
+            users.update().where(users.c.id == db.bindparam("uid")).values(balance_cents=db.bindparam("total")),
+            drifted
+        )
+    db.session.commit()
+    return rows[-1][0], len(rows), [row["uid"] for row in drifted]
+
+# Reconciles one batch per job, so no job holds the write lock for long. A
+# full batch queues the next one straight away; otherwise the next pass
+# starts over from the first user RECONCILE_INTERVAL_SECONDS later.
+@jobs.handler("reconcile_balances")
+def reconcile_batch(after=0):
+    if RECONCILE_INTERVAL_SECONDS is None:
+        return
+    checked = reconcile(after)
+    if checked is not None and checked[1] == RECONCILE_BATCH_SIZE:
+        jobs.enqueue("reconcile_balances", [{"after": checked[0]}], dedupe_on="after")
+    else:
+        jobs.enqueue("reconcile_balances", [{"after": 0}], dedupe_on="after", delay=RECONCILE_INTERVAL_SECONDS)
+    db.session.commit()
+
+# Queues the first pass, unless one is already pending
+def schedule():
+    if RECONCILE_INTERVAL_SECONDS is None:
+        return
+    jobs.enqueue("reconcile_balances", [{"after": 0}], dedupe_on="after")
+    db.session.commit()
+
+def init_app(app):
+    global RECONCILE_INTERVAL_SECONDS, RECONCILE_BATCH_SIZE
+    app.config.setdefault("BALANCE_RECONCILE_INTERVAL_SECONDS", 3600)
+    app.config.setdefault("BALANCE_RECONCILE_BATCH_SIZE", 1000)
+
+    RECONCILE_INTERVAL_SECONDS = app.config["BALANCE_RECONCILE_INTERVAL_SECONDS"]
+    RECONCILE_BATCH_SIZE = app.config["BALANCE_RECONCILE_BATCH_SIZE"]
+    app.before_first_request(schedule)
@@ -0,0 +1,191 @@
+import datetime
+import random
+import time
+from db import db, BalanceEntry, User, Restaurant, Dish, Order, Driver, Review, Category, association_order_dishes, association_restaurant_categories
+import dao
+import dispatch
+import hashing
+import ledger
+
+# Rows generated at scale 1
+DEFAULT_COUNTS = {
+    "users": 100000,
+    "drivers": 2000,
+    "restaurants": 10000,
+    "categories": 40,
+    "dishes": 500000,
+    "orders": 5000000,
+    "reviews": 1000000,
+}
+# Rows per INSERT ... executemany, and per commit
+CHUNK_SIZE = 10000
+# Every seeded user logs in with this password
+PASSWORD = "password"
+# Orders are spread over the year before this date, so a given seed always
+# produces the same data
+EPOCH = datetime.datetime(2024, 1, 1)
+
+FIRST_NAMES = ["Alex", "Sam", "Jordan", "Taylor", "Morgan", "Casey", "Riley", "Jamie", "Avery", "Quinn", "Drew", "Reese"]
+CUISINES = [
+    "Thai", "Chinese", "Mexican", "Italian", "Indian", "Japanese", "Korean", "Vietnamese", "Greek", "Lebanese",
+    "Ethiopian", "French", "Spanish", "Turkish", "American", "Caribbean", "Peruvian", "Brazilian", "Moroccan", "German",
+]
+ADJECTIVES = ["Golden", "Happy", "Little", "Royal", "Spicy", "Lucky", "Corner", "Green", "Red", "Blue", "Old Town", "Sunny"]
+PLACES = ["Kitchen", "House", "Garden", "Grill", "Express", "Bistro", "Cafe", "Palace", "Table", "Corner"]
+DISHES = [
+    "pad thai", "green curry", "fried rice", "dumplings", "lo mein", "burrito", "tacos", "quesadilla", "margherita pizza",
+    "lasagna", "carbonara", "butter chicken", "chana masala", "naan", "ramen", "sushi roll", "bibimbap", "pho", "banh mi",
+    "gyro", "falafel wrap", "hummus plate", "injera platter", "croque monsieur", "paella", "doner kebab", "cheeseburger",
+    "jerk chicken", "ceviche", "feijoada", "tagine", "schnitzel", "caesar salad", "mac and cheese", "chicken wings",
+]
+DISH_STYLES = ["", "spicy ", "vegan ", "classic ", "house ", "large ", "crispy ", "family size "]
+REVIEW_WORDS = ["great", "tasty", "slow", "cold", "fresh", "friendly", "late", "amazing", "okay", "salty", "generous", "bland"]
+
+def scaled_counts(scale=1.0, **overrides):
+    counts = dict((name, max(1, int(count * scale))) for name, count in DEFAULT_COUNTS.items())
+    counts.update((name, count) for name, count in overrides.items() if count is not None)
+    return counts
+
+def _next_id(table):
+    return (db.session.execute(db.select([db.func.max(table.c.id)])).scalar() or 0) + 1
+
+def _insert(table, rows):
+    if rows:
+        db.session.execute(table.insert(), rows)
+        db.session.commit()
+
+def _chunks(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# Bulk-inserts a synthetic data set with Core executemany in CHUNK_SIZE
+# batches, appending after any rows already there. Orders only hold dishes
+# of their restaurant and carry matching totals, and restaurant ratings are
+# recomputed from the reviews before their page snapshots are built.
+# Returns the (first, last) id of each kind.
+def seed(counts, random_seed=0, log=print):
+    rng = random.Random(random_seed)
+    ids = {}
+    for name, model in (("users", User), ("drivers", Driver), ("restaurants", Restaurant),
+            ("categories", Category), ("dishes", Dish), ("orders", Order), ("reviews", Review)):
+        first = _next_id(model.__table__)
+        ids[name] = (first, first + counts[name] - 1)
+
+    digest = hashing.hash_password(PASSWORD)
+    # Sessions are live, as if every user had just logged in
+    expiration = datetime.datetime.now() + datetime.timedelta(days=1)
+    first_user = ids["users"][0]
+    log("Seeding %d users" % counts["users"])
+    for chunk in _chunks({
+        "id": first_user + i,
+        "name": "%s %d" % (rng.choice(FIRST_NAMES), first_user + i),
+        "username": "user%d" % (first_user + i),
+        "balance_cents": rng.randint(0, 500) * 100,
+        "email": "user%d@example.com" % (first_user + i),
+        "password_digest": digest,
+        "session_token": "%040x" % rng.getrandbits(160),
+        "session_expiration": expiration,
+        "update_token": "%040x" % rng.getrandbits(160),
+    } for i in range(counts["users"])):
+        _insert(User.__table__, chunk)
+        _insert(BalanceEntry.__table__, [{
+            "user_id": user["id"], "amount_cents": user["balance_cents"], "kind": ledger.OPENING, "created_at": time.time()
+        } for user in chunk])
+
+    first_driver = ids["drivers"][0]
+    log("Seeding %d drivers" % counts["drivers"])
+    for chunk in _chunks({
+        "id": first_driver + i,
+        "name": "%s %d" % (rng.choice(FIRST_NAMES), first_driver + i),
+        "license_plate_number": "".join(rng.choice("ABCDEFGHJKLMNPRSTUVWXYZ") for _ in range(3)) + "%04d" % rng.randint(0, 9999),
+    } for i in range(counts["drivers"])):
+        _insert(Driver.__table__, chunk)
+
+    first_restaurant = ids["restaurants"][0]
+    log("Seeding %d restaurants" % counts["restaurants"])
+    for chunk in _chunks({
+        "id": first_restaurant + i,
+        "name": "%s %s %s" % (rng.choice(ADJECTIVES), rng.choice(CUISINES), rng.choice(PLACES)),
+        "rating": 0, "rating_sum": 0, "rating_count": 0,
+    } for i in range(counts["restaurants"])):
+        _insert(Restaurant.__table__, chunk)
+
+    first_category = ids["categories"][0]
+    log("Seeding %d categories" % counts["categories"])
+    _insert(Category.__table__, [{
+        "id": first_category + i,
+        "description": CUISINES[i % len(CUISINES)] + ("" if i < len(CUISINES) else " %d" % (i // len(CUISINES))),
+    } for i in range(counts["categories"])])
+    for chunk in _chunks(
+        {"restaurant_id": first_restaurant + i, "category_id": category_id}
+        for i in range(counts["restaurants"])
+        for category_id in rng.sample(range(first_category, first_category + counts["categories"]), min(2, counts["categories"]))
+    ):
+        _insert(association_restaurant_categories, chunk)
+
+    # Dish i belongs to restaurant i % restaurants, so a restaurant's dishes
+    # are found without a lookup table
+    first_dish = ids["dishes"][0]
+    prices = [rng.randint(300, 3000) for _ in range(counts["dishes"])]
+    log("Seeding %d dishes" % counts["dishes"])
+    for chunk in _chunks({
+        "id": first_dish + i,
+        "name": rng.choice(DISH_STYLES) + rng.choice(DISHES),
+        "price_cents": prices[i],
+        "sold_out": rng.random() < 0.05,
+        "restaurant_id": first_restaurant + i % counts["restaurants"],
+    } for i in range(counts["dishes"])):
+        _insert(Dish.__table__, chunk)
+
+    first_order = ids["orders"][0]
+    log("Seeding %d orders" % counts["orders"])
+    orders, items = [], []
+    for i in range(counts["orders"]):
+        # Popular restaurants take more of the orders
+        restaurant = int(counts["restaurants"] * rng.random() ** 2)
+        menu_size = len(range(restaurant, counts["dishes"], counts["restaurants"]))
+        total = 0
+        for position in rng.sample(range(menu_size), min(menu_size, rng.randint(1, 4))):
+            dish = restaurant + position * counts["restaurants"]
+            quantity = rng.randint(1, 3)
+            total += prices[dish] * quantity
+            items.append({"order_id": first_order + i, "dish_id": first_dish + dish, "quantity": quantity})
+        placed = EPOCH - datetime.timedelta(seconds=rng.randint(0, 365 * 24 * 3600))
+        delivered = placed < EPOCH - datetime.timedelta(days=1) or rng.random() < 0.5
+        orders.append({
+            "id": first_order + i,
+            "date_time": placed,
+            "total_cents": total,
+            "paid": delivered or rng.random() < 0.5,
+            "delivered": delivered,
+            "user_id": rng.randint(*ids["users"]),
+            "restaurant_id": first_restaurant + restaurant,
+            "driver_id": rng.randint(*ids["drivers"]),
+        })
+        if len(orders) == CHUNK_SIZE or i == counts["orders"] - 1:
+            db.session.execute(Order.__table__.insert(), orders)
+            _insert(association_order_dishes, items)
+            orders, items = [], []
+
+    first_review = ids["reviews"][0]
+    log("Seeding %d reviews" % counts["reviews"])
+    for chunk in _chunks({
+        "id": first_review + i,
+        "rating": rng.choice((1, 2, 3, 3, 4, 4, 4, 5, 5, 5)),
+        "content": " and ".join(rng.sample(REVIEW_WORDS, 2)),
+        "user_id": rng.randint(*ids["users"]),
+        "restaurant_id": first_restaurant + int(counts["restaurants"] * rng.random() ** 2),
+    } for i in range(counts["reviews"])):
+        _insert(Review.__table__, chunk)
+    dao.recompute_ratings()
+    first, last = ids["restaurants"]
+    dao._rebuild_snapshots(*range(first, last + 1))
+    db.session.commit()
+    dispatch.dispatcher.reset()
+    return ids
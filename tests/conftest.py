@@ -0,0 +1,50 @@
+import json
+import os
+import sys
+import tempfile
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# app.py configures itself from the environment when it is imported
+os.environ["DATABASE_URL"] = "sqlite:///%s" % os.path.join(tempfile.mkdtemp(), "test.db")
+os.environ["JOBS_WORKERS"] = "0"
+os.environ["BCRYPT_ROUNDS"] = "4"
+
+from app import app as flask_app
+from db import db
+import auth
+import cache
+import dispatch
+import encoding
+import engine
+
+# The app with empty tables and caches
+@pytest.fixture
+def app():
+    with flask_app.app_context():
+        for table in reversed(db.Model.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.execute("DELETE FROM search_index")
+        db.session.commit()
+    for store in (cache.entities, encoding.fragments, auth.sessions, auth.revoked, engine.recent_writers):
+        store.clear()
+    dispatch.dispatcher.reset()
+    yield flask_app
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+# Registers a user and returns their id with the tokens /register/ answered
+@pytest.fixture
+def register(app, client):
+    def register(username="ann", password="secret"):
+        response = client.post("/register/", data=json.dumps({
+            "name": username.title(), "username": username, "email": username + "@example.com", "password": password
+        }))
+        tokens = json.loads(response.data)
+        with app.app_context():
+            tokens["id"] = db.session.execute("SELECT id FROM user WHERE username = :u", {"u": username}).scalar()
+        return tokens
+    return register
@@ -0,0 +1,56 @@
+import json
+import time
+import pytest
+import archive
+import jobs
+from db import db, Job, Order, OrderArchive, association_order_dishes
+
+def post(client, path, body):
+    return json.loads(client.post(path, data=json.dumps(body)).data)["data"]
+
+# Three orders with two soups each: delivered two years ago, delivered
+# today, and placed two years ago but not delivered
+@pytest.fixture
+def orders(app, client, register):
+    user_id = register()["id"]
+    driver_id = post(client, "/driver/", {"name": "Ann", "license_plate_number": "ABC1234"})["id"]
+    restaurant_id = post(client, "/restaurant/", {"name": "Diner"})["id"]
+    dish_id = post(client, "/restaurants/%d/dish/" % restaurant_id, {"name": "Soup", "price": 4.5})["id"]
+    order_ids = []
+    for _ in range(3):
+        order_id = post(client, "/user/%d/restaurant/%d/order/" % (user_id, restaurant_id), {"driver_id": driver_id})["id"]
+        post(client, "/order/%d/dishes/" % order_id, {"dishes": [{"dish_id": dish_id, "quantity": 2}]})
+        order_ids.append(order_id)
+    old, recent, open_order = order_ids
+    with app.app_context():
+        db.session.execute("UPDATE \"order\" SET date_time = '2020-01-01 12:00:00' WHERE id IN (:a, :b)", {"a": old, "b": open_order})
+        db.session.execute("UPDATE \"order\" SET delivered = 1 WHERE id IN (:a, :b)", {"a": old, "b": recent})
+        db.session.commit()
+    return restaurant_id, dish_id, order_ids
+
+def test_delivered_orders_past_the_window_move_to_the_archive(app, client, orders, monkeypatch):
+    restaurant_id, dish_id, (old, recent, open_order) = orders
+    etag = client.get("/restaurant/%d/" % restaurant_id).headers["ETag"]
+    monkeypatch.setattr(archive, "ARCHIVE_DAYS", 365)
+    with app.app_context():
+        archive.schedule()
+        jobs.queue.drain()
+        assert sorted(id for id, in db.session.query(Order.id)) == [recent, open_order]
+        archived = OrderArchive.query.one()
+        assert (archived.id, archived.total_cents, json.loads(archived.items)) == (old, 900, [{"dish_id": dish_id, "quantity": 2}])
+        link = association_order_dishes
+        assert db.session.query(link.c.order_id).filter(link.c.order_id == old).count() == 0
+    assert client.get("/order/%d/" % old).status_code == 404
+    assert client.get("/restaurant/%d/" % restaurant_id).headers["ETag"] != etag
+
+def test_archival_moves_one_batch_per_job(app, orders, monkeypatch):
+    monkeypatch.setattr(archive, "ARCHIVE_DAYS", 0)
+    monkeypatch.setattr(archive, "BATCH_SIZE", 1)
+    with app.app_context():
+        jobs.queue.drain()
+        archive.schedule()
+        # Two full batches, then one that finds nothing left and waits for the next pass
+        assert jobs.queue.drain() == 3
+        assert db.session.query(OrderArchive.id).count() == 2
+        next_pass = Job.query.filter_by(kind="archive_orders", status=jobs.PENDING).one()
+        assert (json.loads(next_pass.payload), next_pass.run_at > time.time()) == ({"after": 0}, True)
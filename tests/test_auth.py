@@ -0,0 +1,60 @@
+import json
+import time
+import pytest
+import auth
+from db import db, RevokedSession
+
+@pytest.fixture(params=["opaque", "signed"])
+def mode(request, app):
+    app.config.update(SESSION_TOKEN_MODE=request.param, SECRET_KEY="test")
+    auth.init_app(app)
+    yield request.param
+    app.config["SESSION_TOKEN_MODE"] = "opaque"
+    auth.init_app(app)
+
+def secret(client, session_token):
+    response = client.get("/secret/", headers={"Authorization": "Bearer " + session_token})
+    return "message" in json.loads(response.data)
+
+def renew(client, update_token):
+    return json.loads(client.post("/session/", headers={"Authorization": "Bearer " + update_token}).data)
+
+def test_session_checked_once_then_served_from_the_cache(client, register, mode):
+    session_token = register()["session_token"]
+    assert secret(client, session_token)
+    assert (auth.sessions.get(session_token) is not None) == (mode == "opaque")
+    assert secret(client, session_token)
+    assert not secret(client, session_token + "x")
+
+def test_renewing_revokes_the_old_session(client, register, mode):
+    tokens = register()
+    assert secret(client, tokens["session_token"])
+
+    renewed = renew(client, tokens["update_token"])
+    assert renewed["session_token"] != tokens["session_token"]
+    assert not secret(client, tokens["session_token"])
+    assert secret(client, renewed["session_token"])
+
+def test_revocations_outlive_a_restart(app, client, register, mode):
+    tokens = register()
+    renew(client, tokens["update_token"])
+    auth.init_app(app)
+    assert not secret(client, tokens["session_token"])
+
+# Another worker revoked the token; this one reads it in on its next poll
+def test_revocations_reach_other_processes(app, client, register, mode, monkeypatch):
+    monkeypatch.setattr(auth, "REVOCATION_POLL_SECONDS", 0)
+    session_token = register()["session_token"]
+    assert secret(client, session_token)
+    with app.app_context():
+        db.session.execute(RevokedSession.__table__.insert().values(token=session_token, expires_at=time.time() + 60))
+        db.session.commit()
+
+    misses = auth.sessions.misses
+    refused = not secret(client, session_token)
+    assert session_token in auth.revoked
+    if mode == "signed":
+        assert refused
+    else:
+        # The cached session was dropped and checked against the database again
+        assert auth.sessions.misses == misses + 1
@@ -0,0 +1,40 @@
+import json
+import pytest
+
+def ndjson(*records):
+    return "".join(json.dumps(record) + "\n" for record in records)
+
+def import_records(client, path, records):
+    response = client.post(path + "?mode=upsert", data=ndjson(*records), content_type="application/x-ndjson")
+    assert response.status_code == 201, response.data
+    return json.loads(response.data)["data"]
+
+def export_records(client, path):
+    return [json.loads(line) for line in client.get(path).data.decode().splitlines()]
+
+@pytest.mark.parametrize("kind, first, second, changed", [
+    ("restaurants", {"name": "Noodle Bar"}, {"name": "Noodle Bar"}, None),
+    ("categories", {"description": "Thai"}, {"description": "Thai"}, None),
+    ("drivers", {"name": "Ann", "license_plate_number": "ABC1234"}, {"name": "Ann", "license_plate_number": "XYZ9876"},
+        "license_plate_number"),
+])
+def test_upsert_twice_updates_instead_of_duplicating(client, kind, first, second, changed):
+    assert import_records(client, "/%s/import/" % kind, [first]) == {"inserted": 1, "updated": 0}
+    assert import_records(client, "/%s/import/" % kind, [second]) == {"inserted": 0, "updated": 1}
+    rows = export_records(client, "/%s/export/" % kind)
+    assert len(rows) == 1
+    if changed is not None:
+        assert rows[0][changed] == second[changed]
+
+def test_menu_upsert_twice_updates_dish_and_bumps_version(client):
+    restaurant_id = json.loads(client.post("/restaurant/", data=json.dumps({"name": "Diner"})).data)["data"]["id"]
+    path = "/restaurant/%d/menu/import/" % restaurant_id
+    assert import_records(client, path, [{"name": "Soup", "price": 4.5}]) == {"inserted": 1, "updated": 0}
+    dish = export_records(client, "/restaurant/%d/menu/export/" % restaurant_id)[0]
+    etag = client.get("/dish/%d/" % dish["id"]).headers["ETag"]
+
+    assert import_records(client, path, [{"name": "Soup", "price": 5, "sold_out": True}]) == {"inserted": 0, "updated": 1}
+    response = client.get("/dish/%d/" % dish["id"])
+    assert response.headers["ETag"] != etag
+    assert json.loads(response.data)["data"]["price"] == 5.0
+    assert json.loads(response.data)["data"]["sold_out"] is True
@@ -0,0 +1,30 @@
+import json
+import cache
+import encoding
+
+def test_byte_bounded_cache_evicts_by_total_length():
+    store = cache.LRUCache(100, 60, max_bytes=10)
+    store.set("a", "xxxx")
+    store.set("b", "xxxx")
+    store.get("a")
+    store.set("c", "xxxx")
+    assert (store.get("a"), store.get("b"), store.get("c")) == ("xxxx", None, "xxxx")
+    assert store.stats()["bytes"] == 8
+
+    store.set("a", "xx")
+    store.delete("c")
+    assert store.stats()["bytes"] == 2
+
+def test_byte_bounded_cache_skips_values_longer_than_the_bound():
+    store = cache.LRUCache(100, 60, max_bytes=10)
+    store.set("a", "xxxx")
+    store.set("a", "x" * 11)
+    assert store.get("a") is None
+    assert (store.stats()["bytes"], store.stats()["oversized"]) == (0, 1)
+
+def test_fragments_stay_within_the_byte_bound(app, client, monkeypatch):
+    restaurant_id = json.loads(client.post("/restaurant/", data=json.dumps({"name": "Diner"})).data)["data"]["id"]
+    monkeypatch.setattr(encoding, "fragments", cache.LRUCache(100, 60, max_bytes=20))
+    assert client.get("/restaurant/%d/" % restaurant_id).status_code == 200
+    assert encoding.fragments.stats()["bytes"] <= 20
+    assert encoding.fragments.stats()["oversized"] == 1
@@ -0,0 +1,35 @@
+import json
+from db import db
+
+def post(client, path, body):
+    return json.loads(client.post(path, data=json.dumps(body)).data)["data"]
+
+def set_rating(app, restaurant_id, rating):
+    with app.app_context():
+        db.session.execute("UPDATE restaurant SET rating = :rating WHERE id = :id", {"rating": rating, "id": restaurant_id})
+        db.session.commit()
+
+def test_restaurants_in_category_best_rated_first_one_page_at_a_time(app, client):
+    category_id = post(client, "/category/", {"description": "Thai"})["id"]
+    ids = [post(client, "/restaurant/", {"name": name})["id"] for name in ("A", "B", "C")]
+    set_rating(app, ids[0], 4.5)
+    for restaurant_id in ids:
+        post(client, "/category/%d/add/" % category_id, {"restaurant_id": restaurant_id})
+    # Ratings that change after linking reach the listing too
+    set_rating(app, ids[2], 3)
+
+    first = json.loads(client.get("/category/%d/restaurants/?limit=2" % category_id).data)
+    assert [r["id"] for r in first["data"]] == [ids[0], ids[2]]
+    second = json.loads(client.get("/category/%d/restaurants/?limit=2&after=%s" % (category_id, first["next"])).data)
+    assert [r["id"] for r in second["data"]] == [ids[1]]
+    assert second["next"] is None
+
+def test_restaurants_in_category_expand_on_request(client):
+    category_id = post(client, "/category/", {"description": "Thai"})["id"]
+    restaurant_id = post(client, "/restaurant/", {"name": "A"})["id"]
+    post(client, "/category/%d/add/" % category_id, {"restaurant_id": restaurant_id})
+
+    narrow = json.loads(client.get("/category/%d/restaurants/" % category_id).data)["data"][0]
+    assert set(narrow) == {"id", "name", "rating"}
+    full = json.loads(client.get("/category/%d/restaurants/?expand=1" % category_id).data)["data"][0]
+    assert "menu" in full and "reviews" in full
@@ -0,0 +1,22 @@
+import json
+import events
+
+def post(client, path, body):
+    return json.loads(client.post(path, data=json.dumps(body)).data)["data"]
+
+def test_deleting_a_driver_publishes_their_orders_new_status(client, register):
+    user_id = register()["id"]
+    driver_id = post(client, "/driver/", {"name": "Ann", "license_plate_number": "ABC1234"})["id"]
+    restaurant_id = post(client, "/restaurant/", {"name": "Diner"})["id"]
+    order_id = post(client, "/user/%d/restaurant/%d/order/" % (user_id, restaurant_id), {"driver_id": driver_id})["id"]
+    etag = client.get("/order/%d/status/" % order_id).headers["ETag"]
+    subscription = events.subscribe(order_id, "test")
+
+    assert client.delete("/driver/%d/" % driver_id).status_code == 200
+    response = client.get("/order/%d/status/" % order_id, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert json.loads(response.data)["data"]["driver_id"] is None
+    event = subscription.get(0)
+    assert event["driver_id"] is None and '"%d"' % event["version"] == response.headers["ETag"]
+    events.hub.unsubscribe(subscription)
@@ -0,0 +1,51 @@
+import json
+from db import db
+
+def create_restaurant(client, name="Diner"):
+    return json.loads(client.post("/restaurant/", data=json.dumps({"name": name})).data)["data"]["id"]
+
+def test_matching_if_none_match_is_not_modified(client):
+    restaurant_id = create_restaurant(client)
+    response = client.get("/restaurant/%d/" % restaurant_id)
+    assert response.status_code == 200
+
+    cached = client.get("/restaurant/%d/" % restaurant_id, headers={"If-None-Match": response.headers["ETag"]})
+    assert cached.status_code == 304
+    assert cached.data == b""
+    assert cached.headers["ETag"] == response.headers["ETag"]
+
+def test_etag_changes_after_an_update(client):
+    restaurant_id = create_restaurant(client)
+    etag = client.get("/restaurant/%d/" % restaurant_id).headers["ETag"]
+
+    client.post("/restaurant/%d/" % restaurant_id, data=json.dumps({"name": "Bistro"}))
+    response = client.get("/restaurant/%d/" % restaurant_id, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert json.loads(response.data)["data"]["name"] == "Bistro"
+
+# Another process writes the row, so this one's cached body is never
+# invalidated; its version still tells it the body is stale
+def test_body_matches_etag_after_a_write_elsewhere(app, client):
+    restaurant_id = create_restaurant(client)
+    etag = client.get("/restaurant/%d/" % restaurant_id).headers["ETag"]
+
+    with app.app_context():
+        db.session.execute("UPDATE restaurant SET name = 'Bistro', version = version + 1 WHERE id = :id", {"id": restaurant_id})
+        db.session.commit()
+    response = client.get("/restaurant/%d/" % restaurant_id)
+    assert response.headers["ETag"] != etag
+    assert json.loads(response.data)["data"]["name"] == "Bistro"
+
+def test_projections_have_their_own_etags(client):
+    restaurant_id = create_restaurant(client)
+    path = "/restaurant/%d/" % restaurant_id
+    etags = [client.get(path + query).headers["ETag"] for query in ("", "?fields=name,rating", "?fields=rating,name", "?expand=0")]
+    assert len(set(etags)) == 3
+    assert etags[1] == etags[2]
+
+    # A client that cached one projection refetches another
+    response = client.get(path, headers={"If-None-Match": etags[1]})
+    assert response.status_code == 200
+    assert "menu" in json.loads(response.data)["data"]
+    assert client.get(path + "?fields=name,rating", headers={"If-None-Match": etags[1]}).status_code == 304
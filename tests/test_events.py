@@ -0,0 +1,54 @@
+import json
+import threading
+import time
+import pytest
+
+def post(client, path, body):
+    return json.loads(client.post(path, data=json.dumps(body)).data)["data"]
+
+@pytest.fixture
+def order_id(client, register):
+    user_id = register()["id"]
+    driver_id = post(client, "/driver/", {"name": "Ann", "license_plate_number": "ABC1234"})["id"]
+    restaurant_id = post(client, "/restaurant/", {"name": "Diner"})["id"]
+    return post(client, "/user/%d/restaurant/%d/order/" % (user_id, restaurant_id), {"driver_id": driver_id})["id"]
+
+def status(client, order_id, etag=None, wait=None):
+    path = "/order/%d/status/" % order_id + ("" if wait is None else "?wait=%s" % wait)
+    return client.get(path, headers={} if etag is None else {"If-None-Match": etag})
+
+def test_status_is_not_modified_until_the_order_changes(client, order_id):
+    response = status(client, order_id)
+    assert json.loads(response.data)["data"]["paid"] is False
+    etag = response.headers["ETag"]
+    assert status(client, order_id, etag).status_code == 304
+    assert status(client, order_id, '"0"').status_code == 200
+
+    post(client, "/order/%d/" % order_id, {"paid": True})
+    response = status(client, order_id, etag)
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert json.loads(response.data)["data"]["paid"] is True
+
+def test_long_poll_answers_with_the_change_it_waited_for(app, client, order_id):
+    etag = status(client, order_id).headers["ETag"]
+    def pay():
+        time.sleep(0.2)
+        post(app.test_client(), "/order/%d/" % order_id, {"paid": True})
+    payer = threading.Thread(target=pay)
+    payer.start()
+    started = time.monotonic()
+    response = status(client, order_id, etag, wait=5)
+    payer.join()
+    assert response.status_code == 200
+    assert time.monotonic() - started < 5
+    assert json.loads(response.data)["data"]["paid"] is True
+    assert response.headers["ETag"] == status(client, order_id).headers["ETag"] != etag
+
+def test_long_poll_without_a_change_times_out_not_modified(client, order_id):
+    etag = status(client, order_id).headers["ETag"]
+    started = time.monotonic()
+    response = status(client, order_id, etag, wait=0.2)
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert time.monotonic() - started >= 0.2
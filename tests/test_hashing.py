@@ -0,0 +1,24 @@
+import json
+import threading
+import pytest
+import hashing
+
+@pytest.fixture
+def busy_pool(monkeypatch):
+    pool = hashing.HashingPool(1, 1, 0.1)
+    monkeypatch.setattr(hashing, "pool", pool)
+    # Keeps the only worker busy
+    release = threading.Event()
+    pool._executor.submit(release.wait)
+    yield pool
+    release.set()
+
+def test_a_hash_waiting_past_the_timeout_answers_busy(client, busy_pool):
+    response = client.post("/register/", data=json.dumps({
+        "name": "Ann", "username": "ann", "email": "ann@example.com", "password": "secret"
+    }))
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(hashing.RETRY_AFTER)
+    assert busy_pool.timed_out == 1
+    # The abandoned hash gave its queue slot back
+    assert busy_pool.in_flight == 0
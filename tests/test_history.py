@@ -0,0 +1,46 @@
+import json
+from datetime import datetime, timedelta
+import pytest
+
+def post(client, path, body):
+    return json.loads(client.post(path, data=json.dumps(body)).data)["data"]
+
+@pytest.fixture
+def order(client, register):
+    user_id = register()["id"]
+    driver_id = post(client, "/driver/", {"name": "Ann", "license_plate_number": "ABC1234"})["id"]
+    restaurant_id = post(client, "/restaurant/", {"name": "Diner"})["id"]
+    return user_id, post(client, "/user/%d/restaurant/%d/order/" % (user_id, restaurant_id), {"driver_id": driver_id})["id"]
+
+@pytest.mark.parametrize("format", ["%Y-%m-%d", "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S.%f"])
+def test_history_takes_iso_dates_and_times(client, order, format):
+    user_id, order_id = order
+    now = datetime.now()
+    path = "/user/%d/orders/?since=%s&until=%s" % (
+        user_id, (now - timedelta(days=1)).strftime(format), (now + timedelta(days=1)).strftime(format)
+    )
+    response = client.get(path)
+    assert response.status_code == 200
+    assert [o["id"] for o in json.loads(response.data)["data"]] == [order_id]
+
+def test_history_rejects_other_dates(client, order):
+    response = client.get("/user/%d/orders/?since=01/05/2024" % order[0])
+    assert response.status_code == 400
+
+def test_accounts_embed_their_newest_orders_with_a_cursor_to_the_rest(client, register):
+    ann, bob = register("ann")["id"], register("bob")["id"]
+    driver_id = post(client, "/driver/", {"name": "Ann", "license_plate_number": "ABC1234"})["id"]
+    restaurant_id = post(client, "/restaurant/", {"name": "Diner"})["id"]
+    order_ids = [post(client, "/user/%d/restaurant/%d/order/" % (ann, restaurant_id), {"driver_id": driver_id})["id"] for _ in range(25)]
+    bob_order = post(client, "/user/%d/restaurant/%d/order/" % (bob, restaurant_id), {"driver_id": driver_id})["id"]
+
+    user = json.loads(client.get("/user/%d/" % ann).data)["data"]
+    assert [o["id"] for o in user["orders"]] == order_ids[:-21:-1]
+    rest = json.loads(client.get("/user/%d/orders/?after=%s" % (ann, user["orders_next"])).data)["data"]
+    assert [o["id"] for o in rest] == order_ids[4::-1]
+    driver = json.loads(client.get("/driver/%d/" % driver_id).data)["data"]
+    assert [o["id"] for o in driver["orders"]] == [bob_order] + order_ids[:-20:-1]
+
+    # Listing accounts bounds each one's orders on its own
+    users = json.loads(client.get("/users/").data)["data"]
+    assert [(len(u["orders"]), u["orders_next"] is None) for u in users] == [(20, False), (1, True)]
@@ -0,0 +1,80 @@
+import time
+import pytest
+import jobs
+from db import db, Job
+
+runs = []
+
+@jobs.handler("test")
+def run_test_job(id, fail=False, requeue=False):
+    runs.append(id)
+    # A write queues the job again while it runs
+    if requeue:
+        jobs.enqueue("test", [{"id": id}], dedupe_on="id", delay=60)
+        db.session.commit()
+    if fail:
+        raise ValueError("failed %d" % id)
+
+@pytest.fixture
+def queue(app):
+    del runs[:]
+    with app.app_context():
+        yield jobs.queue
+        db.session.remove()
+
+def enqueue(payloads, **kwargs):
+    jobs.enqueue("test", payloads, dedupe_on="id", **kwargs)
+    db.session.commit()
+
+def pending(app):
+    with app.app_context():
+        return [(job.kind, job.key) for job in Job.query.filter_by(status=jobs.PENDING).order_by(Job.id)]
+
+@pytest.mark.parametrize("in_sql", [True, False])
+def test_jobs_repeating_a_pending_one_are_skipped(app, monkeypatch, in_sql):
+    monkeypatch.setattr(jobs, "_ignores_duplicates_in_sql", lambda: in_sql)
+    with app.app_context():
+        jobs.enqueue("test", [{"id": 1}, {"id": 2}], dedupe_on="id")
+        jobs.enqueue("test", [{"id": 1}, {"id": 3}], dedupe_on="id")
+        db.session.commit()
+    assert pending(app) == [("test", "1"), ("test", "2"), ("test", "3")]
+
+def test_due_jobs_are_claimed_once(queue):
+    enqueue([{"id": 1}])
+    enqueue([{"id": 2}], delay=60)
+    job = queue._claim()
+    assert (job.status, job.attempts) == (jobs.RUNNING, 1)
+    # Another worker finds nothing due: the first job is running, the second not due yet
+    assert queue._claim() is None
+
+def test_failed_jobs_are_retried_with_backoff_then_kept(queue, monkeypatch):
+    enqueue([{"id": 1, "fail": True}])
+    assert queue.run_once()
+    job = Job.query.one()
+    assert (job.status, job.attempts, job.error) == (jobs.PENDING, 1, "ValueError: failed 1")
+    assert job.run_at > time.time() + 1
+
+    monkeypatch.setattr(queue, "max_attempts", 2)
+    Job.query.update({Job.run_at: 0})
+    db.session.commit()
+    assert queue.run_once()
+    assert not queue.run_once()
+    job = Job.query.one()
+    assert (job.status, job.attempts) == (jobs.FAILED, 2)
+    assert runs == [1, 1]
+
+def test_a_failed_job_with_a_newer_pending_one_is_dropped(queue):
+    enqueue([{"id": 1, "fail": True, "requeue": True}])
+    assert queue.run_once()
+    assert [(job.status, job.payload) for job in Job.query] == [(jobs.PENDING, '{"id": 1}')]
+
+def test_expired_leases_run_again_unless_a_pending_job_covers_them(queue):
+    enqueue([{"id": 1}, {"id": 2}])
+    first, second = queue._claim(), queue._claim()
+    enqueue([{"id": int(second.key)}])
+    Job.query.filter(Job.id.in_([first.id, second.id])).update({Job.started_at: 0}, synchronize_session=False)
+    db.session.commit()
+    queue.prune()
+    assert sorted((job.key, job.status) for job in Job.query) == [("1", jobs.PENDING), ("2", jobs.PENDING)]
+    assert queue.drain() == 2
+    assert sorted(runs) == [1, 2]
@@ -0,0 +1,67 @@
+import json
+import pytest
+from db import db
+
+def post(client, path, body, **kwargs):
+    return client.post(path, data=json.dumps(body), **kwargs)
+
+def entries(app, user_id):
+    with app.app_context():
+        return [tuple(row) for row in db.session.execute(
+            "SELECT kind, amount_cents, order_id FROM balance_ledger WHERE user_id = :u ORDER BY id", {"u": user_id}
+        )]
+
+def balance(client, user_id):
+    return json.loads(client.get("/user/%d/" % user_id).data)["data"]["balance"]
+
+@pytest.fixture
+def menu(client):
+    restaurant_id = json.loads(post(client, "/restaurant/", {"name": "Diner"}).data)["data"]["id"]
+    dish_id = json.loads(post(client, "/restaurants/%d/dish/" % restaurant_id, {"name": "Soup", "price": 4.5}).data)["data"]["id"]
+    post(client, "/driver/", {"name": "Ann", "license_plate_number": "ABC1234"})
+    return restaurant_id, dish_id
+
+def top_up(client, user, amount):
+    return post(client, "/user/%d/balance/" % user["id"], {"amount": amount},
+        headers={"Authorization": "Bearer " + user["session_token"]})
+
+def test_checkout_debits_the_balance_with_a_ledger_entry(app, client, register, menu):
+    user = register()
+    restaurant_id, dish_id = menu
+    top_up(client, user, 10)
+
+    response = post(client, "/user/%d/restaurant/%d/checkout/" % (user["id"], restaurant_id),
+        {"dishes": [{"dish_id": dish_id, "quantity": 2}]})
+    assert response.status_code == 201
+    order_id = json.loads(response.data)["data"]["id"]
+    assert balance(client, user["id"]) == 1
+    assert entries(app, user["id"]) == [("opening", 0, None), ("top_up", 1000, None), ("checkout", -900, order_id)]
+
+def test_checkout_beyond_the_balance_changes_nothing(app, client, register, menu):
+    user = register()
+    restaurant_id, dish_id = menu
+    top_up(client, user, 5)
+
+    response = post(client, "/user/%d/restaurant/%d/checkout/" % (user["id"], restaurant_id),
+        {"dishes": [{"dish_id": dish_id, "quantity": 2}]})
+    assert response.status_code == 400
+    assert balance(client, user["id"]) == 5
+    assert entries(app, user["id"]) == [("opening", 0, None), ("top_up", 500, None)]
+    with app.app_context():
+        assert db.session.execute("SELECT count(*) FROM \"order\"").scalar() == 0
+
+def test_balance_edits_are_recorded_as_adjustments(app, client, register):
+    user = register()
+    top_up(client, user, 3)
+    post(client, "/user/%d/" % user["id"], {"balance": 2.25}, headers={"Authorization": "Bearer " + user["session_token"]})
+    assert balance(client, user["id"]) == 2.25
+    assert entries(app, user["id"]) == [("opening", 0, None), ("top_up", 300, None), ("adjustment", -75, None)]
+
+@pytest.mark.parametrize("dishes", [[{"dish_id": "1"}], [{"dish_id": 1, "quantity": -1}], [{"dish_id": 1, "quantity": 0.5}], "soup"])
+def test_checkout_rejects_malformed_dishes(app, client, register, menu, dishes):
+    user = register()
+    restaurant_id, _ = menu
+    top_up(client, user, 10)
+    response = post(client, "/user/%d/restaurant/%d/checkout/" % (user["id"], restaurant_id), {"dishes": dishes})
+    assert response.status_code == 400
+    assert balance(client, user["id"]) == 10
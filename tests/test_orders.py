@@ -0,0 +1,74 @@
+import json
+import pytest
+from db import db
+
+def post(client, path, body):
+    return client.post(path, data=json.dumps(body))
+
+@pytest.fixture
+def order(client, register):
+    user_id = register()["id"]
+    driver_id = json.loads(post(client, "/driver/", {"name": "Ann", "license_plate_number": "ABC1234"}).data)["data"]["id"]
+    restaurant_id = json.loads(post(client, "/restaurant/", {"name": "Diner"}).data)["data"]["id"]
+    dish_id = json.loads(post(client, "/restaurants/%d/dish/" % restaurant_id, {"name": "Soup", "price": 4.5}).data)["data"]["id"]
+    order_id = json.loads(post(client, "/user/%d/restaurant/%d/order/" % (user_id, restaurant_id), {"driver_id": driver_id}).data)["data"]["id"]
+    return order_id, dish_id
+
+def test_order_dishes_move_the_total(client, order):
+    order_id, dish_id = order
+    assert post(client, "/order/%d/add/" % order_id, {"dish_id": dish_id}).status_code == 200
+    response = post(client, "/order/%d/dishes/" % order_id, {"dishes": [{"dish_id": dish_id, "quantity": 2}]})
+    assert json.loads(response.data)["data"]["total"] == 13.5
+    response = post(client, "/order/%d/dishes/" % order_id, {"dishes": [{"dish_id": dish_id, "quantity": -1}]})
+    assert json.loads(response.data)["data"]["total"] == 9
+
+@pytest.mark.parametrize("dishes", [
+    {"dish_id": 1},
+    [{"dish_id": "1"}],
+    [{"dish_id": 0}],
+    [{"quantity": 2}],
+    [{"dish_id": True}],
+    ["soup"],
+])
+def test_malformed_order_dishes_are_rejected(client, order, dishes):
+    order_id, _ = order
+    assert post(client, "/order/%d/dishes/" % order_id, {"dishes": dishes}).status_code == 400
+
+@pytest.mark.parametrize("quantity", [0, 1.5, "2", None, True])
+def test_order_dish_quantities_must_be_non_zero_integers(client, order, quantity):
+    order_id, dish_id = order
+    assert post(client, "/order/%d/dishes/" % order_id, {"dishes": [{"dish_id": dish_id, "quantity": quantity}]}).status_code == 400
+
+def test_adding_a_malformed_dish_is_rejected(client, order):
+    order_id, _ = order
+    assert post(client, "/order/%d/add/" % order_id, {"dish_id": "soup"}).status_code == 400
+    assert post(client, "/order/%d/add/" % order_id, {}).status_code == 400
+
+def test_orders_with_a_missing_driver_are_not_found(client, register, order):
+    order_id, _ = order
+    user_id = register("bob")["id"]
+    restaurant_id = json.loads(post(client, "/restaurant/", {"name": "Bistro"}).data)["data"]["id"]
+    assert post(client, "/user/%d/restaurant/%d/order/" % (user_id, restaurant_id), {"driver_id": 999}).status_code == 404
+    assert post(client, "/order/%d/" % order_id, {"driver_id": 999}).status_code == 404
+
+def test_check_foreign_keys_lists_rows_written_without_enforcement(app, order):
+    order_id, _ = order
+    runner = app.test_cli_runner()
+    assert runner.invoke(args=["check-foreign-keys"]).exit_code == 0
+    with app.app_context():
+        connection = db.engine.raw_connection()
+        connection.execute("PRAGMA foreign_keys = OFF")
+        connection.execute("UPDATE \"order\" SET driver_id = 999 WHERE id = ?", (order_id,))
+        connection.commit()
+        connection.execute("PRAGMA foreign_keys = ON")
+        connection.close()
+    result = runner.invoke(args=["check-foreign-keys"])
+    assert result.exit_code == 1
+    assert "order: 1 rows point at missing driver rows" in result.output
+
+def test_removing_a_dish_after_its_price_changed(client, order):
+    order_id, dish_id = order
+    post(client, "/order/%d/add/" % order_id, {"dish_id": dish_id})
+    assert json.loads(post(client, "/dish/%d/" % dish_id, {"price": 10}).data)["data"]["price"] == 10
+    response = post(client, "/order/%d/dishes/" % order_id, {"dishes": [{"dish_id": dish_id, "quantity": -1}]})
+    assert json.loads(response.data)["data"]["total"] == 0
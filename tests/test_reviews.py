@@ -0,0 +1,43 @@
+import json
+import jobs
+
+def post(client, path, body):
+    return json.loads(client.post(path, data=json.dumps(body)).data)["data"]
+
+def rating(client, restaurant_id):
+    return json.loads(client.get("/restaurant/%d/" % restaurant_id).data)["data"]["rating"]
+
+def page_rating(client, restaurant_id):
+    return json.loads(client.get("/restaurant/%d/menu/" % restaurant_id).data)["data"]["rating"]
+
+def test_review_writes_move_the_rating_in_their_transaction(client, register):
+    user_id = register()["id"]
+    restaurant_id = post(client, "/restaurant/", {"name": "Diner"})["id"]
+
+    first = post(client, "/restaurant/%d/review/" % restaurant_id, {"user_id": user_id, "rating": 4, "content": "Good"})
+    post(client, "/restaurant/%d/review/" % restaurant_id, {"user_id": user_id, "rating": 2, "content": "Meh"})
+    assert rating(client, restaurant_id) == 3
+    post(client, "/review/%d/" % first["id"], {"rating": 5})
+    assert rating(client, restaurant_id) == 3.5
+    client.delete("/review/%d/" % first["id"])
+    assert rating(client, restaurant_id) == 2
+
+def test_review_writes_queue_the_page_rebuild(app, client, register):
+    user_id = register()["id"]
+    restaurant_id = post(client, "/restaurant/", {"name": "Diner"})["id"]
+
+    post(client, "/restaurant/%d/review/" % restaurant_id, {"user_id": user_id, "rating": 4, "content": "Good"})
+    post(client, "/restaurant/%d/review/" % restaurant_id, {"user_id": user_id, "rating": 5, "content": "Great"})
+    assert page_rating(client, restaurant_id)["count"] == 0
+    with app.app_context():
+        assert jobs.queue.drain() == 1
+    assert page_rating(client, restaurant_id) == {"average": 4.5, "count": 2}
+
+def test_deleting_a_user_takes_their_reviews_out_of_the_rating(client, register):
+    ann, bob = register("ann"), register("bob")["id"]
+    restaurant_id = post(client, "/restaurant/", {"name": "Diner"})["id"]
+    post(client, "/restaurant/%d/review/" % restaurant_id, {"user_id": ann["id"], "rating": 1, "content": "Bad"})
+    post(client, "/restaurant/%d/review/" % restaurant_id, {"user_id": bob, "rating": 5, "content": "Great"})
+
+    client.delete("/user/%d/" % ann["id"], headers={"Authorization": "Bearer " + ann["session_token"]})
+    assert rating(client, restaurant_id) == 5
@@ -0,0 +1,82 @@
+import json
+import pytest
+import dao
+import jobs
+
+def post(client, path, body):
+    return json.loads(client.post(path, data=json.dumps(body)).data)["data"]
+
+def page(client, restaurant_id):
+    response = client.get("/restaurant/%d/menu/" % restaurant_id)
+    return response.headers.get("ETag"), json.loads(response.data)["data"]
+
+@pytest.fixture
+def restaurant(client, register):
+    restaurant_id = post(client, "/restaurant/", {"name": "Diner"})["id"]
+    category_id = post(client, "/category/", {"description": "Soups"})["id"]
+    post(client, "/category/%d/add/" % category_id, {"restaurant_id": restaurant_id})
+    post(client, "/restaurants/%d/dish/" % restaurant_id, {"name": "Soup", "price": 4.1})
+    dish_id = post(client, "/restaurants/%d/dish/" % restaurant_id, {"name": "Stew", "price": 12})["id"]
+    post(client, "/dish/%d/" % dish_id, {"sold_out": True})
+    user_id = register()["id"]
+    for rating in (4, 5, 5):
+        post(client, "/restaurant/%d/review/" % restaurant_id, {"user_id": user_id, "rating": rating, "content": "Good"})
+    return restaurant_id
+
+# Databases without SQLite's JSON functions get the same documents from Python
+def test_pages_built_in_python_match_the_sql_ones(app, client, restaurant):
+    with app.app_context():
+        jobs.queue.drain()
+        sql = dao.db.session.execute(dao.SELECT_PAGES, {"ids": [restaurant]}).first()[1]
+        assert dao._page_documents([restaurant]) == {restaurant: sql}
+
+def test_snapshots_written_from_python(app, client, restaurant, monkeypatch):
+    monkeypatch.setattr(dao, "_pages_in_sql", lambda: False)
+    etag, before = page(client, restaurant)
+    post(client, "/restaurants/%d/dish/" % restaurant, {"name": "Bread", "price": 2})
+    new_etag, after = page(client, restaurant)
+    assert new_etag != etag
+    assert [dish["name"] for dish in after["menu"]] == [dish["name"] for dish in before["menu"]] + ["Bread"]
+
+def test_menu_writes_rebuild_the_page_in_their_transaction(client, restaurant):
+    etag, data = page(client, restaurant)
+    soup, stew = [dish["id"] for dish in data["menu"]]
+
+    post(client, "/dish/%d/" % soup, {"price": 5, "sold_out": True})
+    new_etag, data = page(client, restaurant)
+    assert new_etag != etag
+    assert data["menu"][0] == {"id": soup, "name": "Soup", "price": 5.0, "sold_out": True}
+
+    client.delete("/dish/%d/" % stew)
+    assert [dish["id"] for dish in page(client, restaurant)[1]["menu"]] == [soup]
+
+def test_category_writes_rebuild_the_page(client, restaurant):
+    etag, data = page(client, restaurant)
+    category_id = post(client, "/category/", {"description": "Stews"})["id"]
+    post(client, "/category/%d/add/" % category_id, {"restaurant_id": restaurant})
+    new_etag, data = page(client, restaurant)
+    assert new_etag != etag
+    assert [c["description"] for c in data["categories"]] == ["Soups", "Stews"]
+
+    client.delete("/category/%d/" % category_id)
+    assert [c["description"] for c in page(client, restaurant)[1]["categories"]] == ["Soups"]
+
+def test_review_writes_rebuild_the_page_from_a_job(app, client, register, restaurant):
+    with app.app_context():
+        jobs.queue.drain()
+    etag, data = page(client, restaurant)
+    assert data["rating"] == {"average": 4.67, "count": 3}
+
+    review = post(client, "/restaurant/%d/review/" % restaurant, {"user_id": register("bob")["id"], "rating": 1, "content": "Bad"})
+    post(client, "/review/%d/" % review["id"], {"rating": 2})
+    assert page(client, restaurant) == (etag, data)
+    with app.app_context():
+        assert jobs.queue.drain() == 1
+    new_etag, data = page(client, restaurant)
+    assert new_etag != etag
+    assert data["rating"] == {"average": 4.0, "count": 4}
+
+    client.delete("/review/%d/" % review["id"])
+    with app.app_context():
+        jobs.queue.drain()
+    assert page(client, restaurant)[1]["rating"] == {"average": 4.67, "count": 3}
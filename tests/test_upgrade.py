@@ -0,0 +1,54 @@
+import os
+import shutil
+import sqlite3
+import pytest
+from sqlalchemy import create_engine
+from db import db
+import upgrade
+
+# delivery.db is the database the first release shipped, before prices were
+# kept in cents and ratings as aggregates
+FIRST_RELEASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "delivery.db")
+
+@pytest.fixture
+def old_database(tmp_path):
+    path = str(tmp_path / "old.db")
+    shutil.copy(FIRST_RELEASE, path)
+    connection = sqlite3.connect(path)
+    connection.executescript("""
+        UPDATE user SET balance = 12.34;
+        INSERT INTO driver (id, name, license_plate_number) VALUES (1, 'Ann', 'ABC1234');
+        INSERT INTO category (id, description) VALUES (1, 'Fries');
+        INSERT INTO association_restaurant_categories VALUES (1, 1), (1, 1);
+        INSERT INTO dish (id, name, price, sold_out, restaurant_id) VALUES (1, 'Fries', 4.1, 0, 1);
+        INSERT INTO "order" (id, date_time, total, paid, delivered, user_id, restaurant_id, driver_id)
+            VALUES (1, 1600000000, 8.2, 1, 0, 1, 1, 1);
+        INSERT INTO association_order_dishes VALUES (1, 1), (1, 1);
+        INSERT INTO review (id, rating, content, user_id, restaurant_id) VALUES (1, 4, 'Good', 1, 1), (2, 5, 'Great', 1, 1);
+    """)
+    connection.commit()
+    connection.close()
+    return path
+
+def test_upgrade_carries_rows_over_into_the_new_columns(old_database):
+    assert set(upgrade.upgrade_tables(old_database)) >= {
+        "user", "restaurant", "dish", "order", "association_order_dishes", "association_restaurant_categories"
+    }
+    db.Model.metadata.create_all(create_engine("sqlite:///" + old_database))
+
+    connection = sqlite3.connect(old_database)
+    query = lambda sql: connection.execute(sql).fetchall()
+    assert query("SELECT balance_cents FROM user") == [(1234,)]
+    assert query("SELECT price_cents, version FROM dish") == [(410, 1)]
+    assert query('SELECT total_cents, driver_id, version FROM "order"') == [(820, 1, 1)]
+    assert query("SELECT rating, rating_sum, rating_count, version FROM restaurant") == [(4.5, 9, 2, 1)]
+    assert query("SELECT order_id, dish_id, quantity FROM association_order_dishes") == [(1, 1, 2)]
+    assert query("SELECT restaurant_id, category_id, rating FROM association_restaurant_categories") == [(1, 1, 4.5)]
+    assert query("PRAGMA foreign_key_check") == []
+    assert query("SELECT name FROM sqlite_master WHERE name = 'ix_review_user_id'") == [("ix_review_user_id",)]
+    # The link table's rating now follows the restaurant's
+    connection.execute("UPDATE restaurant SET rating = 3 WHERE id = 1")
+    assert query("SELECT rating FROM association_restaurant_categories") == [(3,)]
+    connection.close()
+
+    assert upgrade.upgrade_tables(old_database) == []
@@ -0,0 +1,121 @@
+import logging
+import sqlite3
+from sqlalchemy.schema import CreateIndex, CreateTable
+from sqlalchemy.dialects import sqlite
+from db import db
+
+logger = logging.getLogger(__name__)
+
+# Values for columns added since the first release, as SQL over the old row
+# (aliased old). Added columns missing here take their server default, like
+# the version columns, which start at 1.
+BACKFILLS = {
+    "user": {"balance_cents": "CAST(ROUND(old.balance * 100) AS INTEGER)"},
+    "dish": {"price_cents": "CAST(ROUND(old.price * 100) AS INTEGER)"},
+    "order": {"total_cents": "CAST(ROUND(old.total * 100) AS INTEGER)"},
+    "restaurant": {
+        "rating_sum": "(SELECT COALESCE(SUM(rating), 0) FROM review WHERE restaurant_id = old.id)",
+        "rating_count": "(SELECT COUNT(*) FROM review WHERE restaurant_id = old.id)",
+        "rating": "COALESCE((SELECT AVG(rating) FROM review WHERE restaurant_id = old.id), 0)",
+    },
+    "association_order_dishes": {"quantity": "COUNT(*)"},
+    "association_restaurant_categories": {"rating": "(SELECT rating FROM restaurant WHERE id = old.restaurant_id)"},
+}
+
+# Link tables that held one row per dish added or per link made, and are now
+# unique on these columns; their old rows are folded together
+GROUPED = {
+    "association_order_dishes": ("order_id", "dish_id"),
+    "association_restaurant_categories": ("category_id", "restaurant_id"),
+}
+
+# Brings a database written by an earlier release up to the models: tables
+# whose columns changed are rebuilt with their rows carried over, then
+# create_all adds the missing tables, indexes and triggers. Returns the
+# names of the rebuilt tables; running it again does nothing.
+def upgrade():
+    rebuilt = []
+    url = db.engine.url
+    if url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:"):
+        rebuilt = upgrade_tables(url.database)
+    existing = set(db.engine.table_names())
+    db.create_all()
+    # Imported here, as dao needs the app set up
+    import dao
+    if "search_index" not in existing:
+        dao.rebuild_search_index()
+    if "restaurant_snapshot" not in existing or rebuilt:
+        dao.rebuild_snapshots()
+    return rebuilt
+
+# Rebuilds the outdated tables of the SQLite database at path in one
+# transaction, the way https://www.sqlite.org/lang_altertable.html#otheralter
+# describes, and adds the indexes the others lack. Returns the rebuilt
+# tables' names.
+def upgrade_tables(path):
+    connection = sqlite3.connect(path, isolation_level=None)
+    try:
+        connection.execute("PRAGMA busy_timeout = 5000")
+        # Both only take effect outside a transaction: the first lets rows
+        # point at tables that are being rebuilt, the second keeps renames
+        # from rewriting other tables' references to the renamed table
+        connection.execute("PRAGMA foreign_keys = OFF")
+        connection.execute("PRAGMA legacy_alter_table = ON")
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            rebuilt = [table.name for table in db.Model.metadata.sorted_tables if _rebuild(connection, table)]
+            violations = connection.execute("PRAGMA foreign_key_check").fetchall()
+            if violations and rebuilt:
+                logger.warning("%d rows point at missing rows; see flask check-foreign-keys", len(violations))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+    finally:
+        connection.close()
+    if rebuilt:
+        logger.info("Upgraded tables %s", ", ".join(rebuilt))
+    return rebuilt
+
+def _columns(connection, name):
+    return {row[1]: bool(row[3]) for row in connection.execute('PRAGMA table_info("%s")' % name)}
+
+def _rebuild(connection, table):
+    old = _columns(connection, table.name)
+    wanted = {column.name: not column.nullable for column in table.columns}
+    dialect = sqlite.dialect()
+    if not old:
+        return False
+    if old == wanted:
+        # create_all skips the indexes of tables that exist
+        indexes = set(row[1] for row in connection.execute('PRAGMA index_list("%s")' % table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                connection.execute(str(CreateIndex(index).compile(dialect=dialect)))
+        return False
+
+    backfills = BACKFILLS.get(table.name, {})
+    values = {}
+    for column in table.columns:
+        if column.name in backfills:
+            values[column.name] = backfills[column.name]
+        elif column.name in old:
+            values[column.name] = 'old."%s"' % column.name
+        elif column.server_default is None and not column.nullable:
+            raise RuntimeError("No value for the new column %s.%s" % (table.name, column.name))
+
+    for index, origin in [(row[1], row[3]) for row in connection.execute('PRAGMA index_list("%s")' % table.name)]:
+        if origin == "c":
+            connection.execute('DROP INDEX "%s"' % index)
+    connection.execute('ALTER TABLE "%s" RENAME TO "_old_%s"' % (table.name, table.name))
+    connection.execute(str(CreateTable(table).compile(dialect=dialect)))
+    select = 'SELECT %s FROM "_old_%s" AS old' % (", ".join(values.values()), table.name)
+    if table.name in GROUPED:
+        select += " GROUP BY %s" % ", ".join("old.%s" % column for column in GROUPED[table.name])
+    connection.execute('INSERT INTO "%s" (%s) %s' % (
+        table.name, ", ".join('"%s"' % name for name in values), select
+    ))
+    connection.execute('DROP TABLE "_old_%s"' % table.name)
+    for index in table.indexes:
+        connection.execute(str(CreateIndex(index).compile(dialect=dialect)))
+    return True
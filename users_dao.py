@@ -1,4 +1,7 @@
 from db import db, User
+import auth
+import hashing
+import ledger
 
 def get_user_by_email(email):
     return User.query.filter(User.email == email).first()
@@ -8,6 +11,16 @@ def get_user_by_session_token(session_token):
     return User.query.filter(User.session_token == session_token).first()
 
 
+def get_session(session_token):
+    return db.session.query(User.id, User.session_expiration).filter(User.session_token == session_token).first()
+
+
+# Returns the id of the session token's user, or None if the token is invalid
+# or expired. Verified tokens are cached, so this rarely touches the database.
+def verify_session(session_token):
+    return auth.verify(session_token, get_session)
+
+
 def get_user_by_update_token(update_token):
     return User.query.filter(User.update_token == update_token).first()
 
@@ -17,7 +30,14 @@ def verify_credentials(email, password):
     if user is None:
         return False, None
     
-    return user.verify_password(password),user
+    if not user.verify_password(password):
+        return False, user
+
+    # Transparently moves the digest to the configured work factor
+    if hashing.needs_rehash(user.password_digest):
+        user.password_digest = hashing.hash_password(password)
+        db.session.commit()
+    return True, user
 
 
 def create_user(name, username, email, password):
@@ -25,9 +45,13 @@ def create_user(name, username, email, password):
     if user is not None:
         return False, user
 
-    new_user = User(name=name, username=username, email=email, password=password)
+    password_digest = hashing.hash_password(password)
+    new_user = User(name=name, username=username, email=email, password_digest=password_digest)
 
     db.session.add(new_user)
+    db.session.flush()
+    ledger.append(new_user.id, new_user.balance_cents, ledger.OPENING)
+    auth.issue(new_user)
     db.session.commit()
     return True, new_user
 
@@ -37,6 +61,9 @@ def renew_session(update_token):
     if user is None:
         raise Exception("Invalid update token.")
 
+    session_token = user.session_token
     user.renew_session()
+    auth.issue(user)
     db.session.commit()
+    auth.revoke(session_token)
     return user